@@ -0,0 +1,158 @@
+import threading
+import time
+
+from Metrics import SUBMISSIONS
+
+# Listings walked when importing a subreddit, in order
+LISTINGS = ('all', 'year', 'month')
+
+# Submissions fetched, hashed and written between checkpoints
+CHUNK_SIZE = 100
+
+# Seconds to wait before restarting a backfill that failed
+RETRY_DELAY = 300
+
+
+class Backfill:
+    # Imports a subreddit's top listings on a background thread so the main
+    # loop keeps running ingestNew for everything else. Submission ids are
+    # deduplicated across listings before anything is downloaded, progress
+    # is checkpointed per listing in BackfillCheckpoint so a restart resumes
+    # where it stopped, and the subreddit is only marked imported once every
+    # listing has completed.
+
+    def __init__(self, sentinel, redditFactory):
+        self.sentinel = sentinel
+        self.redditFactory = redditFactory
+        self.logger = sentinel.logger
+        self.threads = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def running(self, subname):
+        with self.lock:
+            thread = self.threads.get(subname)
+            return thread is not None and thread.is_alive()
+
+    # Start importing a subreddit unless it's already running or recently failed
+    def start(self, settings):
+        subname = settings.subname
+        with self.lock:
+            thread = self.threads.get(subname)
+            if thread is not None and thread.is_alive():
+                return
+            if time.time() - self.failures.get(subname, 0) < RETRY_DELAY:
+                return
+            thread = threading.Thread(target=self.run, args=(settings,), name='backfill-{0}'.format(subname),
+                                      daemon=True)
+            self.threads[subname] = thread
+        thread.start()
+
+    def run(self, settings):
+        subname = settings.subname
+        try:
+            # praw isn't thread safe, every backfill gets its own instance
+            r = self.redditFactory()
+            started = time.time()
+            self.logger.info('Starting backfill of r/{0}'.format(subname))
+
+            checkpoints = self.loadCheckpoints(subname)
+            listings = self.collectListings(r, subname, checkpoints)
+
+            posts = 0
+            mediaBytes = 0
+            for listing, submissions in listings:
+                listingPosts, listingBytes = self.runListing(r, settings, listing, submissions)
+                posts += listingPosts
+                mediaBytes += listingBytes
+
+            self.sentinel.db.execute('UPDATE SubredditSettings SET imported=TRUE WHERE subname=%s', (subname,))
+            self.logger.info('Finished backfill of r/{0}: {1}'.format(
+                subname, self.throughput(posts, mediaBytes, time.time() - started)))
+        except Exception as e:
+            self.logger.error('Backfill of r/{0} failed, retrying in {1}s - {2}'.format(subname, RETRY_DELAY, e))
+            with self.lock:
+                self.failures[subname] = time.time()
+
+    # {listing: (last fullname, completed)} saved by earlier runs
+    def loadCheckpoints(self, subname):
+        rows = self.sentinel.db.fetchall(
+            'SELECT listing, last_fullname, completed FROM BackfillCheckpoint WHERE subname=%s', (subname,))
+        return {listing: (lastFullname, completed) for listing, lastFullname, completed in rows}
+
+    def saveCheckpoint(self, subname, listing, lastFullname, completed):
+        self.sentinel.db.execute(
+            'INSERT INTO BackfillCheckpoint(subname, listing, last_fullname, completed) VALUES(%s, %s, %s, %s) '
+            'ON CONFLICT (subname, listing) DO UPDATE SET last_fullname=EXCLUDED.last_fullname, '
+            'completed=EXCLUDED.completed',
+            (subname, listing, lastFullname, completed))
+
+    # Walk every incomplete listing up front and return [(listing, submissions)]
+    # with each submission id appearing once across all of them. Listing
+    # pages are cheap next to downloading the media they point at.
+    def collectListings(self, r, subname, checkpoints):
+        seen = set()
+        listings = []
+        for listing in LISTINGS:
+            lastFullname, completed = checkpoints.get(listing, (None, False))
+            if completed:
+                continue
+
+            params = {'after': lastFullname} if lastFullname else {}
+            submissions = []
+            for submission in r.subreddit(subname).top(time_filter=listing, limit=None, params=params):
+                if submission.id in seen:
+                    continue
+                seen.add(submission.id)
+                submissions.append(submission)
+
+            self.logger.info('Backfill of r/{0} found {1} new submissions in top/{2}'.format(
+                subname, len(submissions), listing))
+            listings.append((listing, submissions))
+        return listings
+
+    # Download, hash and write a listing in chunks, checkpointing after each.
+    # Returns (posts, media bytes) processed.
+    def runListing(self, r, settings, listing, submissions):
+        subname = settings.subname
+        started = time.time()
+        posts = 0
+        mediaBytes = 0
+
+        for offset in range(0, len(submissions), CHUNK_SIZE):
+            chunk = submissions[offset:offset + CHUNK_SIZE]
+            SUBMISSIONS.inc(len(chunk), subreddit=subname, outcome='seen')
+            indexed = self.sentinel.indexedSubmissions([submission.id for submission in chunk])
+
+            # Queue every download in the chunk before waiting on any of them
+            pending = [
+                (submission, self.sentinel.fetchMedia(submission, settings))
+                for submission in chunk
+                if not self.sentinel.skipSubmission(submission, settings, indexed)
+            ]
+
+            records = []
+            for submission, mediaFutures in pending:
+                record = self.sentinel.buildRecord(r, submission, settings, False, mediaFutures)
+                if record is not None:
+                    records.append(record)
+                    # Animation frames all carry the size of the whole file
+                    mediaBytes += sum(
+                        mediaData[8] for mediaData in record[0] if mediaData[4] == 1 or mediaData[3] == 1)
+            if records:
+                self.sentinel.writeBatch(records)
+
+            posts += len(chunk)
+            self.saveCheckpoint(subname, listing, chunk[-1].fullname, False)
+            self.logger.info('Backfill of r/{0} top/{1}: {2}/{3} - {4}'.format(
+                subname, listing, posts, len(submissions),
+                self.throughput(posts, mediaBytes, time.time() - started)))
+
+        self.saveCheckpoint(subname, listing, submissions[-1].fullname if submissions else None, True)
+        return posts, mediaBytes
+
+    @staticmethod
+    def throughput(posts, mediaBytes, elapsed):
+        elapsed = max(elapsed, 0.001)
+        return '{0} posts in {1:.0f}s ({2:.1f} posts/s, {3:.2f} MB/s)'.format(
+            posts, elapsed, posts / elapsed, mediaBytes / elapsed / 1024 / 1024)
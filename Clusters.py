@@ -0,0 +1,292 @@
+import array
+import csv
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy
+
+from HashIndex import TABLE_ENTRIES, flipMasks, neighbours, planBlocks, popcount, toUnsigned
+from HashSnapshot import ID_DTYPE, ID_WIDTH
+
+# Candidate pairs one task expands at a time, bounds each worker's memory
+TASK_CANDIDATES = 2000000
+# Rows written per slice of the sorted output
+WRITE_BATCH = 10000
+
+CSV_FIELDS = ('cluster', 'posts', 'subreddit', 'submission_id', 'created', 'hash', 'ref_count', 'distance')
+
+
+class MediaRows:
+    # Every single image Media row of some subreddits as flat numpy arrays,
+    # about 40 bytes a row instead of a Python tuple each
+
+    def __init__(self, db, subreddits):
+        hashes = array.array('Q')
+        created = array.array('d')
+        refs = array.array('q')
+        codes = array.array('H')
+        ids = bytearray()
+        self.subreddits = []
+        subredditCodes = {}
+
+        rows = db.iterate(
+            'SELECT subreddit, submission_id, hash, created, ref_count FROM Media '
+            'WHERE subreddit = ANY(%s) AND frame_count = 1',
+            (list(subreddits),))
+        for subreddit, submissionId, mediaHash, timestamp, refCount in rows:
+            code = subredditCodes.get(subreddit)
+            if code is None:
+                code = subredditCodes[subreddit] = len(self.subreddits)
+                self.subreddits.append(subreddit)
+            hashes.append(toUnsigned(mediaHash))
+            created.append(timestamp or 0)
+            refs.append(refCount)
+            codes.append(code)
+            ids += submissionId.encode('ascii').ljust(ID_WIDTH, b'\0')
+
+        self.hashes = numpy.frombuffer(hashes, dtype=numpy.uint64)
+        self.created = numpy.frombuffer(created, dtype=numpy.float64)
+        self.refs = numpy.frombuffer(refs, dtype=numpy.int64)
+        self.codes = numpy.frombuffer(codes, dtype=numpy.uint16)
+        self.ids = numpy.frombuffer(ids, dtype=ID_DTYPE)
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+# Worker state, set once per process by initWorker
+_hashes = None
+_plan = None
+_radius = None
+_block = None
+
+
+def initWorker(hashes, plan, radius):
+    global _hashes, _plan, _radius, _block
+    _hashes = hashes
+    _plan = plan
+    _radius = radius
+    _block = None
+
+
+# Every hash's row sorted by its value on one block, with the first
+# sorted position of each block value when there are few enough of them
+# for a direct lookup, only the block being worked on is kept
+def blockIndex(block):
+    global _block
+    if _block is None or _block[0] != block:
+        _block = None
+        shift, width, blockRadius = _plan[block]
+        values = (_hashes >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+        order = numpy.argsort(values, kind='stable')
+        sortedValues = values[order]
+        del values
+        starts = None
+        if 1 << width <= TABLE_ENTRIES * max(1, len(_hashes)):
+            starts = numpy.searchsorted(sortedValues, numpy.arange((1 << width) + 1, dtype=numpy.uint64))
+        _block = (block, order, sortedValues, starts, flipMasks(width, blockRadius))
+    return _block[1:]
+
+
+# Pairs (i, j), i < j, within radius bits for the rows at sorted positions
+# start to stop of a block. Rows are looked up in block order so the
+# lookups walk the sorted values instead of jumping around them. A pair is
+# only returned by the first block it's close enough on.
+def blockPairs(block, start, stop):
+    order, sortedValues, starts, masks = blockIndex(block)
+    rows = order[start:stop]
+    lefts = []
+    rights = []
+    for mask in masks:
+        keys = sortedValues[start:stop] ^ mask
+        if starts is not None:
+            keys = keys.astype(numpy.intp)
+            lows = starts[keys]
+            counts = starts[keys + 1] - lows
+        else:
+            lows = numpy.searchsorted(sortedValues, keys, 'left')
+            counts = numpy.searchsorted(sortedValues, keys, 'right') - lows
+        total = int(counts.sum())
+        if not total:
+            continue
+        ends = numpy.cumsum(counts)
+        candidates = order[numpy.arange(total) + numpy.repeat(lows - (ends - counts), counts)]
+        sources = numpy.repeat(rows, counts)
+        keep = candidates > sources
+        sources = sources[keep]
+        candidates = candidates[keep]
+
+        differences = _hashes[sources] ^ _hashes[candidates]
+        keep = popcount(differences) <= _radius
+        for shift, width, blockRadius in _plan[:block]:
+            blockBits = (differences >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+            keep &= popcount(blockBits) > blockRadius
+        lefts.append(sources[keep].astype(numpy.int32 if len(_hashes) < 2 ** 31 else numpy.int64))
+        rights.append(candidates[keep].astype(lefts[-1].dtype))
+    if not lefts:
+        return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.int64)
+    return numpy.concatenate(lefts), numpy.concatenate(rights)
+
+
+class UnionFind:
+    # Disjoint sets over 0..size-1 with every operation vectorized over
+    # arrays of items. Roots are always the smallest item of their set, so
+    # conflicting writes in one union step can't make a cycle and are just
+    # retried.
+
+    def __init__(self, size):
+        self.parent = numpy.arange(size)
+
+    def find(self, items):
+        roots = self.parent[items]
+        while True:
+            parents = self.parent[roots]
+            if numpy.array_equal(parents, roots):
+                break
+            roots = parents
+        self.parent[items] = roots
+        return roots
+
+    def union(self, lefts, rights):
+        while len(lefts):
+            a = self.find(lefts)
+            b = self.find(rights)
+            apart = a != b
+            lefts = lefts[apart]
+            rights = rights[apart]
+            a = a[apart]
+            b = b[apart]
+            self.parent[numpy.maximum(a, b)] = numpy.minimum(a, b)
+
+    def roots(self):
+        return self.find(numpy.arange(len(self.parent)))
+
+
+# Root of every unique hash's cluster of hashes chained together by pairs
+# within radius bits. Blocks are searched in chunks of rows on a pool of
+# worker processes while this process unions the pairs they find, with at
+# most two chunks per worker in flight so finished pairs don't pile up.
+def clusterHashes(hashes, radius, workers=1, logger=None):
+    sets = UnionFind(len(hashes))
+    if radius < 1 or len(hashes) < 2:
+        return sets.roots()
+
+    plan = planBlocks(len(hashes), radius)
+    tasks = []
+    for block, (shift, width, blockRadius) in enumerate(plan):
+        expected = neighbours(width, blockRadius) * (1 + len(hashes) / 2.0 ** width)
+        chunk = max(1, int(TASK_CANDIDATES / expected))
+        tasks.extend((block, start, min(start + chunk, len(hashes))) for start in range(0, len(hashes), chunk))
+    if logger:
+        logger.info('Searching {0} hashes within {1} bits in {2} blocks of {3} bits, {4} tasks'.format(
+            len(hashes), radius, len(plan), '/'.join(str(width) for _, width, _ in plan), len(tasks)))
+
+    pairs = 0
+    if workers <= 1:
+        initWorker(hashes, plan, radius)
+        for task in tasks:
+            lefts, rights = blockPairs(*task)
+            pairs += len(lefts)
+            sets.union(lefts, rights)
+        initWorker(None, None, None)
+    else:
+        with ProcessPoolExecutor(workers, initializer=initWorker, initargs=(hashes, plan, radius)) as executor:
+            pending = set()
+            remaining = iter(tasks)
+            while True:
+                for task in remaining:
+                    pending.add(executor.submit(blockPairs, *task))
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    lefts, rights = future.result()
+                    pairs += len(lefts)
+                    sets.union(lefts, rights)
+    if logger:
+        logger.info('Found {0} near duplicate pairs'.format(pairs))
+    return sets.roots()
+
+
+# Cluster the single images of subreddits, exact duplicates first by value
+# and the distinct hashes with clusterHashes, then write every cluster of
+# at least minPosts posts to output, most posts first. Memory is a few
+# flat arrays per row, no matter how many pairs are found.
+def clusterMedia(db, subreddits, radius, output, format='csv', workers=1, minPosts=2, top=None, logger=None):
+    started = time.time()
+    media = MediaRows(db, subreddits)
+    uniqueHashes, inverse = numpy.unique(media.hashes, return_inverse=True)
+    if logger:
+        logger.info('Loaded {0} images ({1} distinct hashes) of {2} subreddits in {3:.1f}s'.format(
+            len(media), len(uniqueHashes), len(media.subreddits), time.time() - started))
+
+    labels = clusterHashes(uniqueHashes, radius, workers, logger)[inverse.reshape(-1)]
+    posts = numpy.bincount(labels, weights=media.refs, minlength=len(uniqueHashes)).astype(numpy.int64)
+    rows = numpy.flatnonzero(posts[labels] >= minPosts)
+    # Biggest clusters first, then each cluster's media oldest first
+    rows = rows[numpy.lexsort((media.created[rows], labels[rows], -posts[labels[rows]]))]
+    if top is not None:
+        # Cluster labels are contiguous in rows, keep the first top of them
+        starts = numpy.flatnonzero(numpy.diff(labels[rows], prepend=-1))
+        if len(starts) > top:
+            rows = rows[:starts[top]]
+
+    writer = ClusterWriter(output, format, media)
+    for start in range(0, len(rows), WRITE_BATCH):
+        batch = rows[start:start + WRITE_BATCH]
+        writer.write(batch, labels[batch], posts[labels[batch]])
+    writer.close()
+    if logger:
+        logger.info('Wrote {0} clusters of {1} images in {2:.1f}s'.format(
+            writer.clusters, len(rows), time.time() - started))
+    return writer.clusters
+
+
+class ClusterWriter:
+    # Streams sorted cluster rows as CSV, one row per image with each
+    # cluster's distance from its oldest image, or as JSON lines, one
+    # object per cluster
+
+    def __init__(self, output, format, media):
+        self.output = output
+        self.format = format
+        self.media = media
+        self.clusters = 0
+        self.label = None
+        self.first = None
+        self.current = None
+        if format == 'csv':
+            self.csv = csv.writer(output)
+            self.csv.writerow(CSV_FIELDS)
+
+    def write(self, rows, labels, posts):
+        media = self.media
+        columns = zip(labels.tolist(), posts.tolist(), media.codes[rows].tolist(), media.ids[rows].tolist(),
+                      media.created[rows].tolist(), media.hashes[rows].tolist(), media.refs[rows].tolist())
+        for label, count, code, submissionId, created, mediaHash, refCount in columns:
+            if label != self.label:
+                self.finishCluster()
+                self.clusters += 1
+                self.label = label
+                self.first = mediaHash
+                self.current = {'cluster': self.clusters, 'posts': count, 'subreddits': [], 'media': []}
+            image = (media.subreddits[code], submissionId.decode('ascii'), created, '{0:016x}'.format(mediaHash),
+                     refCount, bin(mediaHash ^ self.first).count('1'))
+            if self.format == 'csv':
+                self.csv.writerow((self.clusters, count) + image)
+            else:
+                if image[0] not in self.current['subreddits']:
+                    self.current['subreddits'].append(image[0])
+                self.current['media'].append(dict(zip(CSV_FIELDS[2:], image)))
+
+    def finishCluster(self):
+        if self.format == 'json' and self.current is not None:
+            self.output.write(json.dumps(self.current) + '\n')
+        self.current = None
+
+    def close(self):
+        self.finishCluster()
+        self.output.flush()
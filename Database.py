@@ -0,0 +1,173 @@
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2.extras import execute_values
+
+from Metrics import DB_QUERY_SECONDS
+
+# Errors after which a connection is thrown away and the work retried
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    # Connection remembering which statements have been prepared on it
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Database:
+    # Pooled Postgres access. Work runs in a transaction on a pooled
+    # connection and is retried on a fresh connection when the old one
+    # dies, instead of the bot exiting.
+
+    def __init__(self, config, logger, minConnections=1, maxConnections=8, retries=5):
+        self.config = config
+        self.logger = logger
+        self.minConnections = minConnections
+        self.maxConnections = maxConnections
+        self.retries = retries
+        self.pool = None
+        # Threads waiting on a free connection block here
+        self.available = threading.BoundedSemaphore(maxConnections)
+        self.statements = {}
+        self.cursorNames = itertools.count()
+
+    def connect(self):
+        for attempt in itertools.count(1):
+            try:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minConnections,
+                    self.maxConnections,
+                    dbname=self.config['DB_NAME'],
+                    user=self.config['DB_USER'],
+                    host=self.config['DB_HOST'],
+                    password=self.config['DB_PASS'],
+                    connection_factory=PreparingConnection
+                )
+                return
+            except CONNECTION_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                self.logger.error('Error connecting to DB, retrying in {0}s: \n{1}'.format(
+                    self.backoff(attempt), e))
+                time.sleep(self.backoff(attempt))
+
+    # Dedicated connection outside the pool subscribed to a notification
+    # channel, for a listener thread to select() on
+    def listen(self, channel):
+        connection = psycopg2.connect(
+            dbname=self.config['DB_NAME'],
+            user=self.config['DB_USER'],
+            host=self.config['DB_HOST'],
+            password=self.config['DB_PASS']
+        )
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cur:
+            cur.execute('LISTEN {0}'.format(channel))
+        return connection
+
+    @staticmethod
+    def backoff(attempt):
+        return min(2 ** attempt, 60)
+
+    # Register a statement to be run with PREPARE/EXECUTE, use the name in
+    # place of the query. Placeholders are written as %s like everywhere else.
+    def prepare(self, name, query):
+        counter = itertools.count(1)
+        self.statements[name] = re.sub('%s', lambda match: '${0}'.format(next(counter)), query)
+
+    def executeOn(self, cur, query, params=None):
+        statement = self.statements.get(query)
+        if statement is None:
+            cur.execute(query, params)
+            return
+        if query not in cur.connection.prepared:
+            cur.execute('PREPARE {0} AS {1}'.format(query, statement))
+            cur.connection.prepared.add(query)
+        if params:
+            cur.execute('EXECUTE {0} ({1})'.format(query, ', '.join(['%s'] * len(params))), params)
+        else:
+            cur.execute('EXECUTE {0}'.format(query))
+
+    # Label a query is timed under, the statement name for prepared
+    # statements and the leading keyword for everything else
+    def queryName(self, query):
+        if query in self.statements:
+            return query
+        return query.split(None, 1)[0].lower()
+
+    # Check a connection out of the pool, waiting for one to come back when
+    # they're all in use instead of failing with PoolError. Connections
+    # that failed are closed rather than returned.
+    @contextmanager
+    def connection(self):
+        with self.available:
+            connection = self.pool.getconn()
+            try:
+                yield connection
+            except CONNECTION_ERRORS:
+                self.pool.putconn(connection, close=True)
+                raise
+            except BaseException:
+                self.pool.putconn(connection)
+                raise
+            self.pool.putconn(connection)
+
+    # Run work(cursor) in one transaction, retrying on a new connection when
+    # the connection fails. Returns whatever work returns.
+    def run(self, work, name='transaction'):
+        for attempt in itertools.count(1):
+            try:
+                with self.connection() as connection:
+                    with DB_QUERY_SECONDS.time(query=name), connection:
+                        with connection.cursor() as cur:
+                            return work(cur)
+            except CONNECTION_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                self.logger.warning('DB connection error, retrying in {0}s - {1}'.format(
+                    self.backoff(attempt), e))
+                time.sleep(self.backoff(attempt))
+
+    def execute(self, query, params=None):
+        self.run(lambda cur: self.executeOn(cur, query, params), self.queryName(query))
+
+    def fetchone(self, query, params=None):
+        def work(cur):
+            self.executeOn(cur, query, params)
+            return cur.fetchone()
+        return self.run(work, self.queryName(query))
+
+    def fetchall(self, query, params=None):
+        def work(cur):
+            self.executeOn(cur, query, params)
+            return cur.fetchall()
+        return self.run(work, self.queryName(query))
+
+    # Multi-row INSERT ... VALUES %s for batches
+    @staticmethod
+    def executeValues(cur, query, rows, pageSize=1000):
+        execute_values(cur, query, rows, page_size=pageSize)
+
+    # Stream a large result through a server side cursor. Not retried, a
+    # connection failure part way through is raised to the caller.
+    def iterate(self, query, params=None, itersize=10000):
+        with self.connection() as connection:
+            with connection:
+                with connection.cursor(name='stream_{0}'.format(next(self.cursorNames))) as cur:
+                    cur.itersize = itersize
+                    cur.execute(query, params)
+                    for row in cur:
+                        yield row
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
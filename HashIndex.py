@@ -0,0 +1,503 @@
+import itertools
+import threading
+import time
+
+import numpy
+
+
+HASH_BITS = 64
+
+# Media rows before a snapshot's watermark read again on load
+SNAPSHOT_OVERLAP = 10000
+
+# Largest direct lookup table of block values, in entries per hash
+TABLE_ENTRIES = 4
+# Cost of a binary search lookup relative to a table lookup or checking a
+# candidate, measured on 2M hashes
+SEARCH_COST = 3
+# Hashes in a group below which a scan is as fast as a BlockIndex, measured
+# with benchmarks/matcher.py
+MULTI_INDEX_MIN = 150000
+
+# Set bits per byte, used when numpy has no native popcount
+_POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+# Number of differing bits between two 64 bit hashes
+def hammingDistance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Media.hash is a signed BIGINT, hashes are unsigned everywhere in Python
+def toSigned(mediaHash):
+    if mediaHash >= 1 << (HASH_BITS - 1):
+        return mediaHash - (1 << HASH_BITS)
+    return mediaHash
+
+
+def toUnsigned(mediaHash):
+    if mediaHash < 0:
+        return mediaHash + (1 << HASH_BITS)
+    return mediaHash
+
+
+# Vectorized number of set bits for every element of a uint64 array
+def popcount(values):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1, dtype=numpy.uint8)
+
+
+# Indices of the entries within radius bits given every entry's distance,
+# closest first with ties in insertion order, at most limit of them
+def nearest(distances, radius, limit=None):
+    candidates = numpy.flatnonzero(distances <= radius)
+    if limit is not None and len(candidates) > limit:
+        # Everything up to the limit-th smallest distance, the stable sort
+        # then keeps the oldest of the entries tied at it
+        cutoff = numpy.partition(distances[candidates], limit - 1)[limit - 1]
+        candidates = candidates[distances[candidates] <= cutoff]
+    return candidates[numpy.argsort(distances[candidates], kind='stable')][:limit]
+
+
+# n choose k, math.comb is python 3.8+
+def binomial(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+# Number of width bit values within radius bits of a value
+def neighbours(width, radius):
+    return sum(binomial(width, bits) for bits in range(radius + 1))
+
+
+# Every width bit mask with at most radius bits set
+def flipMasks(width, radius):
+    masks = [0]
+    for bits in range(1, radius + 1):
+        masks.extend(sum(1 << bit for bit in chosen)
+                     for chosen in itertools.combinations(range(width), bits))
+    return numpy.array(masks, dtype=numpy.uint64)
+
+
+# Split the hash bits for a multi-index search of count hashes at radius.
+# Two hashes within radius bits are within radius // blocks bits of each
+# other on at least one block, so every pair is found by looking up each
+# hash's block value and its neighbours among the sorted values of the
+# block. More blocks make for fewer lookups but bigger buckets of
+# candidates to check, the split with the least expected work wins.
+# Returns (shift, width, block radius) per block.
+def planBlocks(count, radius):
+    best = None
+    for blocks in range(1, min(radius + 1, HASH_BITS) + 1):
+        widths = [HASH_BITS // blocks + (1 if i < HASH_BITS % blocks else 0) for i in range(blocks)]
+        blockRadius = radius // blocks
+        cost = 0
+        for width in widths:
+            lookup = 1 if 1 << width <= TABLE_ENTRIES * max(1, count) else SEARCH_COST
+            cost += neighbours(width, blockRadius) * (lookup + count / 2.0 ** width)
+        if best is None or cost < best[0]:
+            shifts = [sum(widths[:i]) for i in range(blocks)]
+            best = (cost, [(shift, width, blockRadius) for shift, width in zip(shifts, widths)])
+    return best[1]
+
+
+# Convert a similarity percentage threshold (as stored in SubredditSettings)
+# into the largest bit distance whose similarity is still above it
+def similarityToRadius(threshold):
+    radius = -1
+    for distance in range(HASH_BITS + 1):
+        if int(((HASH_BITS - distance) * 100.0) / HASH_BITS) > threshold:
+            radius = distance
+    return radius
+
+
+# Similarity percentage for a bit distance, matches the report formatting
+def distanceToSimilarity(distance):
+    return int(((HASH_BITS - distance) * 100.0) / HASH_BITS)
+
+
+class BlockIndex:
+    # Multi-index over a fixed array of hashes, split into blocks as
+    # planBlocks plans them for radius. A hash within radius bits of a query
+    # is within radius // blocks bits of it on at least one block, so only
+    # the hashes that close to the query on some block are compared. Each
+    # block keeps the hash positions sorted by block value, with the first
+    # position of each value when there are few enough values for a direct
+    # lookup. Other radii are searched with the same split.
+
+    def __init__(self, hashes, radius):
+        self.size = len(hashes)
+        self.radius = radius
+        positionType = numpy.int32 if self.size < 2 ** 31 else numpy.int64
+        self.blocks = []
+        for shift, width, blockRadius in planBlocks(self.size, radius):
+            values = (hashes >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+            order = numpy.argsort(values, kind='stable').astype(positionType)
+            sortedValues = values[order].astype(numpy.uint32 if width <= 32 else numpy.uint64)
+            del values
+            starts = None
+            if 1 << width <= TABLE_ENTRIES * self.size:
+                starts = numpy.searchsorted(
+                    sortedValues, numpy.arange((1 << width) + 1, dtype=sortedValues.dtype)).astype(positionType)
+            self.blocks.append((shift, width, order, sortedValues, starts))
+        self.masks = {}
+
+    # Sorted positions of the indexed hashes within radius bits, None when
+    # looking up every block would cost more than scanning them
+    def within(self, hashes, mediaHash, radius):
+        blockRadius = radius // len(self.blocks)
+        if sum(neighbours(width, blockRadius) for _, width, _, _, _ in self.blocks) * SEARCH_COST > self.size:
+            return None
+
+        found = []
+        for shift, width, order, sortedValues, starts in self.blocks:
+            masks = self.masks.get((width, blockRadius))
+            if masks is None:
+                masks = self.masks[(width, blockRadius)] = flipMasks(width, blockRadius).astype(sortedValues.dtype)
+            keys = masks ^ sortedValues.dtype.type((mediaHash >> shift) & ((1 << width) - 1))
+            if starts is not None:
+                keys = keys.astype(numpy.intp)
+                lows = starts[keys]
+                counts = starts[keys + 1] - lows
+            else:
+                lows = numpy.searchsorted(sortedValues, keys, 'left')
+                counts = numpy.searchsorted(sortedValues, keys, 'right') - lows
+            total = int(counts.sum())
+            if total:
+                ends = numpy.cumsum(counts)
+                found.append(order[numpy.arange(total) + numpy.repeat(lows - (ends - counts), counts)])
+        if not found:
+            return numpy.empty(0, numpy.intp)
+        # A hash close on several blocks is found more than once, only the
+        # few within radius are worth deduplicating
+        candidates = numpy.concatenate(found)
+        candidates = candidates[popcount(hashes[candidates] ^ numpy.uint64(mediaHash)) <= radius]
+        return numpy.unique(candidates)
+
+
+# The index to search hashes with: none below MULTI_INDEX_MIN of them,
+# the given one while it was planned for radius and hashes added since it
+# was built are under a quarter of it, they're scanned meanwhile, or else
+# a new one
+def refreshIndex(index, hashes, radius):
+    if len(hashes) < MULTI_INDEX_MIN:
+        return None
+    if index is not None and index.radius >= radius and len(hashes) - index.size < index.size // 4:
+        return index
+    return BlockIndex(hashes, radius)
+
+
+# (positions, distances) of the hashes within radius bits, closest first
+# with ties in insertion order, at most limit of them. With an index only
+# the hashes it finds and those added after it are compared.
+def searchHashes(hashes, mediaHash, radius, limit=None, index=None):
+    positions = index.within(hashes, mediaHash, radius) if index is not None else None
+    if positions is None:
+        distances = popcount(hashes ^ numpy.uint64(mediaHash))
+        positions = nearest(distances, radius, limit)
+        return positions, distances[positions]
+    positions = numpy.concatenate((positions, numpy.arange(index.size, len(hashes))))
+    distances = popcount(hashes[positions] ^ numpy.uint64(mediaHash))
+    closest = nearest(distances, radius, limit)
+    return positions[closest], distances[closest]
+
+
+class HashArray:
+    # Brute force matcher keeping hashes in one contiguous uint64 array so a
+    # query is a single vectorized XOR + popcount over the whole subreddit
+
+    def __init__(self, capacity=1024):
+        self.hashes = numpy.empty(capacity, dtype=numpy.uint64)
+        self.submissionIds = []
+        self.size = 0
+
+    def add(self, mediaHash, submissionId):
+        if self.size == len(self.hashes):
+            grown = numpy.empty(len(self.hashes) * 2, dtype=numpy.uint64)
+            grown[:self.size] = self.hashes
+            self.hashes = grown
+        self.hashes[self.size] = mediaHash
+        self.submissionIds.append(submissionId)
+        self.size += 1
+
+    # Return the closest (distance, submission id) pairs within radius bits,
+    # ties are broken by insertion order so older submissions come first
+    def search(self, mediaHash, radius, limit=None):
+        if radius < 0 or self.size == 0:
+            return []
+        positions, distances = searchHashes(self.hashes[:self.size], mediaHash, radius, limit, self.indexFor(radius))
+        return [(distance, self.submissionIds[position])
+                for position, distance in zip(positions.tolist(), distances.tolist())]
+
+    # Scanned whole
+    def indexFor(self, radius):
+        return None
+
+    def __len__(self):
+        return self.size
+
+
+class MultiIndexHashes(HashArray):
+    # HashArray searched through a BlockIndex once it's big enough for the
+    # index to beat the scan. The index is built on a search rather than on
+    # every add, planned for the widest radius searched so far.
+
+    def __init__(self, capacity=1024):
+        super(MultiIndexHashes, self).__init__(capacity)
+        self.index = None
+        self.radius = 0
+
+    def indexFor(self, radius):
+        self.radius = max(self.radius, radius)
+        self.index = refreshIndex(self.index, self.hashes[:self.size], self.radius)
+        return self.index
+
+
+class MappedHashes:
+    # Read only hashes and fixed width submission ids of one group of a
+    # HashSnapshot, views straight into the memory-mapped file. Searched by
+    # a vectorized scan like HashArray, or through a BlockIndex like
+    # MultiIndexHashes once indexed is set.
+
+    def __init__(self, hashes, submissionIds):
+        self.hashes = hashes
+        self.submissionIds = submissionIds
+        self.indexed = False
+        self.index = None
+        self.radius = 0
+
+    def search(self, mediaHash, radius, limit=None):
+        if radius < 0 or len(self.hashes) == 0:
+            return []
+        if self.indexed:
+            self.radius = max(self.radius, radius)
+            self.index = refreshIndex(self.index, self.hashes, self.radius)
+        positions, distances = searchHashes(self.hashes, mediaHash, radius, limit, self.index)
+        return [(distance, self.submissionIds[position].decode('ascii'))
+                for position, distance in zip(positions.tolist(), distances.tolist())]
+
+    # {(hash, submission id)} of the count most recently added entries
+    def newest(self, count):
+        return set(zip(self.hashes[-count:].tolist(),
+                       (submissionId.decode('ascii') for submissionId in self.submissionIds[-count:])))
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class LayeredHashes:
+    # A snapshot group with the hashes added since the snapshot in a matcher
+    # of their own on top. Ties go to the snapshot, it holds the older posts.
+
+    def __init__(self, base, recent):
+        self.base = base
+        self.recent = recent
+
+    def add(self, mediaHash, submissionId):
+        self.recent.add(mediaHash, submissionId)
+
+    def search(self, mediaHash, radius, limit=None):
+        matches = self.base.search(mediaHash, radius, limit) + self.recent.search(mediaHash, radius, limit)
+        matches.sort(key=lambda match: match[0])
+        if limit is not None:
+            matches = matches[:limit]
+        return matches
+
+    def __len__(self):
+        return len(self.base) + len(self.recent)
+
+
+# Available matcher implementations, selected with MATCHER in config.yml
+MATCHERS = {
+    'multiindex': MultiIndexHashes,
+    'numpy': HashArray,
+}
+
+DEFAULT_MATCHER = 'multiindex'
+
+
+class HashIndex:
+    # Per subreddit in-memory index of media hashes. Single images and the
+    # sampled frames of animations are kept apart so they only ever match
+    # their own kind.
+
+    def __init__(self, logger=None, matcher=DEFAULT_MATCHER):
+        if matcher not in MATCHERS:
+            raise ValueError('Unknown matcher {0}, expected one of {1}'.format(matcher, ', '.join(MATCHERS)))
+        self.logger = logger
+        self.matcher = matcher
+        self.subreddits = {}
+        # Subreddits this worker indexes, None for all of them
+        self.shard = None
+        # HashSnapshot the index starts from, None to load everything from Media
+        self.snapshot = None
+        # Index being loaded by reload(), hashes added meanwhile go to it too
+        self.reloading = None
+        # Guards the group dict, each group has its own lock for adds and
+        # searches so subreddits are searched in parallel
+        self.lock = threading.Lock()
+        self.groupLocks = {}
+
+    # Build the index from every hash in the Media table, or only those of
+    # the given subreddits. With a snapshot only the rows after its
+    # watermark are read from Media.
+    def load(self, db, subreddits=None, snapshot=None):
+        if subreddits is not None:
+            self.shard = set(subreddits)
+        self.snapshot = snapshot
+        self.loadHashes(db, subreddits)
+
+    # Restrict the index to the given subreddits, dropping the hashes of
+    # subreddits no longer assigned and loading those of new ones
+    def assign(self, db, subreddits):
+        subreddits = set(subreddits)
+        with self.lock:
+            added = subreddits - self.shard if self.shard is not None else set()
+            self.shard = subreddits
+            for key in [key for key in self.subreddits if key[0] not in subreddits]:
+                del self.subreddits[key]
+                self.groupLocks.pop(key, None)
+        if added:
+            self.loadHashes(db, added)
+
+    # Load the given subreddits again straight from Media, after maintenance
+    # moved rows out of it. The old hashes keep being searched until the new
+    # ones are loaded.
+    def reload(self, db, subreddits):
+        fresh = HashIndex(self.logger, self.matcher)
+        fresh.shard = set(subreddits) if self.shard is None else set(subreddits) & self.shard
+        with self.lock:
+            self.reloading = fresh
+        try:
+            fresh.loadHashes(db, fresh.shard)
+        except Exception:
+            with self.lock:
+                self.reloading = None
+            raise
+        with self.lock:
+            self.reloading = None
+            for key in [key for key in self.subreddits if key[0] in fresh.shard]:
+                del self.subreddits[key]
+            self.subreddits.update(fresh.subreddits)
+
+    def loadHashes(self, db, subreddits=None):
+        started = time.time()
+        count = 0
+        conditions = []
+        params = []
+        if subreddits is not None:
+            conditions.append('subreddit = ANY(%s)')
+            params.append(list(subreddits))
+
+        watermark = None
+        if self.snapshot is not None:
+            watermark = self.snapshot.watermark
+            with self.lock:
+                for key, hashes in self.snapshot.groups.items():
+                    if subreddits is None or key[0] in subreddits:
+                        hashes.indexed = self.matcher == 'multiindex'
+                        self.subreddits[key] = LayeredHashes(hashes, MATCHERS[self.matcher]())
+                        count += len(hashes)
+            # Inserts still in flight when the snapshot was taken commit
+            # with a seq below its watermark, so a little before it is read
+            # again and the rows the snapshot already holds are skipped
+            conditions.append('seq > %s')
+            params.append(watermark - SNAPSHOT_OVERLAP)
+
+        query = 'SELECT hash, submission_id, subreddit, frame_count, seq FROM Media'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        # Streamed through a server side cursor rather than materializing
+        # millions of rows in one fetchall
+        overlap = {}
+        for mediaHash, submissionId, subreddit, frameCount, seq in db.iterate(query, params or None):
+            if watermark is not None and seq <= watermark:
+                overlap.setdefault((subreddit, frameCount > 1), []).append((toUnsigned(mediaHash), submissionId))
+                continue
+            self.add(subreddit, toUnsigned(mediaHash), submissionId, frameCount > 1)
+            count += 1
+
+        # Rows of a group the snapshot holds are its newest, so they're
+        # among as many entries from its end as the group has overlap rows
+        for (subreddit, animated), rows in overlap.items():
+            mapped = self.snapshot.groups.get((subreddit, animated))
+            held = mapped.newest(len(rows)) if mapped is not None else set()
+            for mediaHash, submissionId in rows:
+                if (mediaHash, submissionId) not in held:
+                    self.add(subreddit, mediaHash, submissionId, animated)
+                    count += 1
+
+        if self.logger:
+            self.logger.info('Loaded {0} hashes for {1} subreddits into {2} index in {3:.1f}s'.format(
+                count, len({subreddit for subreddit, animated in self.subreddits}), self.matcher, time.time() - started))
+
+    def add(self, subreddit, mediaHash, submissionId, animated=False):
+        with self.lock:
+            # Other workers index subreddits outside our shard
+            if self.shard is not None and subreddit not in self.shard:
+                return
+            key = (subreddit, animated)
+            hashes = self.subreddits.get(key)
+            if hashes is None:
+                hashes = self.subreddits[key] = MATCHERS[self.matcher]()
+            groupLock = self.groupLocks.setdefault(key, threading.Lock())
+            reloading = self.reloading
+        with groupLock:
+            hashes.add(mediaHash, submissionId)
+        if reloading is not None:
+            reloading.add(subreddit, mediaHash, submissionId, animated)
+
+    # Matches within radius bits sorted by distance, closest first. Only the
+    # subreddit's group is locked while it's searched.
+    def search(self, subreddit, mediaHash, radius, limit=None, animated=False):
+        key = (subreddit, animated)
+        with self.lock:
+            hashes = self.subreddits.get(key)
+            if hashes is None:
+                return []
+            groupLock = self.groupLocks.setdefault(key, threading.Lock())
+        with groupLock:
+            return hashes.search(mediaHash, radius, limit)
+
+
+class SqlHashIndex:
+    # Matcher that leaves the hashes in Postgres and pushes the distance
+    # filter into the query so only candidate rows leave the database.
+    # Requires Postgres 14+ for bit_count.
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.matcher = 'sql'
+        self.db = None
+
+    def load(self, db, subreddits=None, snapshot=None):
+        self.db = db
+        if self.logger:
+            self.logger.info('Using sql matcher, hashes are matched in Postgres')
+
+    # Every query is for one subreddit already, there's nothing to shard
+    def assign(self, db, subreddits):
+        pass
+
+    # Searches always see the current Media
+    def reload(self, db, subreddits):
+        pass
+
+    # Nothing to do, the row inserted into Media is all the state there is
+    def add(self, subreddit, mediaHash, submissionId, animated=False):
+        pass
+
+    def search(self, subreddit, mediaHash, radius, limit=None, animated=False):
+        if radius < 0:
+            return []
+        rows = self.db.fetchall(
+            'SELECT distance, submission_id FROM ('
+            'SELECT bit_count((hash # %s)::BIT(64)) AS distance, submission_id FROM Media '
+            'WHERE frame_count' + ('>1' if animated else '=1') + ' AND subreddit=%s'
+            ') candidates WHERE distance <= %s ORDER BY distance, submission_id LIMIT %s',
+            (toSigned(mediaHash), subreddit, radius, limit))
+        return [(int(distance), submissionId) for distance, submissionId in rows]
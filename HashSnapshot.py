@@ -0,0 +1,132 @@
+import array
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy
+
+from HashIndex import MappedHashes, toUnsigned
+
+MAGIC = b'RSHASH01'
+# magic, watermark, number of groups, offset of the group directory
+HEADER = struct.Struct('<8sqqq')
+# subreddit, animated, count, offset of the hashes, offset of the ids
+ENTRY = struct.Struct('<24s?7xqqq')
+# Submission ids are stored as fixed width ASCII, reddit ids are base 36 and
+# fit in Submissions.id
+ID_WIDTH = 10
+ID_DTYPE = 'S{0}'.format(ID_WIDTH)
+
+
+def pad(handle, alignment=8):
+    handle.write(b'\0' * (-handle.tell() % alignment))
+
+
+class HashSnapshot:
+    # Read only view of a snapshot file written by writeSnapshot. The file
+    # is memory-mapped and shared, so every worker on a host reads the same
+    # page cache and starting up costs no more than opening it. Each
+    # (subreddit, animated) group is a MappedHashes over its own slice.
+    #
+    # Layout, little endian: HEADER, then per group its uint64 hashes and
+    # its ID_WIDTH byte submission ids, each 8 byte aligned, then the
+    # directory of one ENTRY per group.
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.watermark, count, directory = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError('{0} is not a hash snapshot'.format(path))
+
+        self.groups = {}
+        for i in range(count):
+            subreddit, animated, size, hashesOffset, idsOffset = ENTRY.unpack_from(
+                self.map, directory + i * ENTRY.size)
+            self.groups[(subreddit.rstrip(b'\0').decode('ascii'), animated)] = MappedHashes(
+                numpy.frombuffer(self.map, dtype='<u8', count=size, offset=hashesOffset),
+                numpy.frombuffer(self.map, dtype=ID_DTYPE, count=size, offset=idsOffset))
+
+    def __len__(self):
+        return sum(len(hashes) for hashes in self.groups.values())
+
+
+# Seconds since the snapshot at path was written, infinite if there is none
+def snapshotAge(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return float('inf')
+
+
+# Write every Media hash up to the current highest seq to path. Rows are
+# streamed one group at a time so memory is bounded by the largest
+# subreddit, and the file is swapped in atomically so readers never see a
+# partial one. Returns False without writing when another process on the
+# host is already writing it.
+def writeSnapshot(db, path, logger=None):
+    with open(path + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        started = time.time()
+        watermark = db.fetchone('SELECT coalesce(max(seq), 0) FROM Media')[0]
+        rows = db.iterate(
+            'SELECT subreddit, frame_count > 1, hash, submission_id FROM Media WHERE seq <= %s '
+            'ORDER BY subreddit, frame_count > 1, seq',
+            (watermark,))
+
+        entries = []
+        temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as handle:
+                handle.write(HEADER.pack(MAGIC, watermark, 0, 0))
+
+                def flush(key, hashes, ids):
+                    if sys.byteorder != 'little':
+                        hashes.byteswap()
+                    hashesOffset = handle.tell()
+                    handle.write(hashes.tobytes())
+                    idsOffset = handle.tell()
+                    handle.write(ids)
+                    pad(handle)
+                    entries.append((key, len(hashes), hashesOffset, idsOffset))
+
+                key = None
+                hashes = array.array('Q')
+                ids = bytearray()
+                for subreddit, animated, mediaHash, submissionId in rows:
+                    if (subreddit, animated) != key:
+                        if key is not None:
+                            flush(key, hashes, ids)
+                        key = (subreddit, animated)
+                        hashes = array.array('Q')
+                        ids = bytearray()
+                    hashes.append(toUnsigned(mediaHash))
+                    ids += submissionId.encode('ascii').ljust(ID_WIDTH, b'\0')
+                if key is not None:
+                    flush(key, hashes, ids)
+
+                directory = handle.tell()
+                for (subreddit, animated), size, hashesOffset, idsOffset in entries:
+                    handle.write(ENTRY.pack(subreddit.encode('ascii'), animated, size, hashesOffset, idsOffset))
+                handle.seek(0)
+                handle.write(HEADER.pack(MAGIC, watermark, len(entries), directory))
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    if logger:
+        logger.info('Wrote snapshot of {0} hashes in {1} groups up to seq {2} to {3} in {4:.1f}s'.format(
+            sum(size for _, size, _, _ in entries), len(entries), watermark, path, time.time() - started))
+    return True
@@ -0,0 +1,97 @@
+import numpy
+from PIL import Image
+
+# Image.ANTIALIAS was an alias of LANCZOS and is gone from Pillow 10
+RESAMPLE = getattr(Image, 'Resampling', Image).LANCZOS
+
+HASH_SIZE = 8
+# pHash thumbnail side, only its lowest HASH_SIZE x HASH_SIZE frequencies
+# make it into the hash
+PHASH_SIZE = 32
+
+# Pixel indices of the 8x8 thumbnail in the order the hash visits them,
+# left to right on even rows and right to left on odd rows, and the pixel
+# each one is compared against. The first pixel is compared against the
+# bottom left corner. Stored hashes depend on this exact order.
+ORDER = []
+for _row in range(0, HASH_SIZE, 2):
+    ORDER += [_row * HASH_SIZE + col for col in range(HASH_SIZE)]
+    ORDER += [(_row + 1) * HASH_SIZE + col for col in range(HASH_SIZE - 1, -1, -1)]
+PREVIOUS = [(HASH_SIZE - 1) * HASH_SIZE] + ORDER[:-1]
+PAIRS = list(zip(ORDER, PREVIOUS))
+
+_ORDER_ARRAY = numpy.array(ORDER)
+_PREVIOUS_ARRAY = numpy.array(PREVIOUS)
+
+# First HASH_SIZE rows of the DCT-II basis over PHASH_SIZE samples, the low
+# frequencies of a thumbnail are _DCT @ pixels @ _DCT.T
+_DCT = numpy.cos(numpy.pi / PHASH_SIZE * numpy.outer(numpy.arange(HASH_SIZE), numpy.arange(PHASH_SIZE) + 0.5))
+
+# Mirroring an image negates its odd frequencies along the mirrored axis,
+# so flipped pHashes come from the same coefficients. Unflipped, horizontal,
+# vertical and both (a 180 degree rotation), the order of every flip list.
+_PARITY = (-1.0) ** numpy.arange(HASH_SIZE)
+_FLIP_SIGNS = numpy.stack([
+    numpy.ones((HASH_SIZE, HASH_SIZE)),
+    numpy.outer(numpy.ones(HASH_SIZE), _PARITY),
+    numpy.outer(_PARITY, numpy.ones(HASH_SIZE)),
+    numpy.outer(_PARITY, _PARITY),
+])
+
+
+# Grayscale 8x8 thumbnail as 64 row-major bytes
+def thumbnailBytes(img):
+    return img.convert('L').resize((HASH_SIZE, HASH_SIZE), RESAMPLE).tobytes()
+
+
+# 64 bit difference hash, each bit is set when a pixel is at least as bright
+# as the previous pixel along the serpentine path
+def differenceHash(img):
+    pixels = thumbnailBytes(img)
+    differenceHash = 0
+    for pixel, previousPixel in PAIRS:
+        differenceHash = (differenceHash << 1) | (pixels[pixel] >= pixels[previousPixel])
+    return differenceHash
+
+
+# One 64 bit int per row of a (n, 64) boolean array, first column highest
+def packHashes(bits):
+    hashes = numpy.ascontiguousarray(numpy.packbits(bits, axis=1)).view('>u8').ravel()
+    return [int(imgHash) for imgHash in hashes]
+
+
+# Hash many decoded images at once, returns a list of ints in input order
+def differenceHashBatch(images):
+    pixels = numpy.frombuffer(b''.join(thumbnailBytes(img) for img in images), dtype=numpy.uint8)
+    pixels = pixels.reshape(-1, HASH_SIZE * HASH_SIZE)
+    return packHashes(pixels[:, _ORDER_ARRAY] >= pixels[:, _PREVIOUS_ARRAY])
+
+
+# 64 bit perceptual hash, each bit is set when one of the 8x8 lowest DCT
+# frequencies of a 32x32 thumbnail is above their median. Survives crops,
+# rescaling and small rotations better than the dHash.
+def perceptualHash(img):
+    return flipHashes(img)[1][0]
+
+
+# ([dHashes], [pHashes]) of an image and of its horizontal, vertical and
+# both way flips. Each thumbnail is resized once, the flipped dHashes are
+# taken from the mirrored 8x8 pixels and the flipped pHashes from sign
+# flipped DCT coefficients, so the flips cost array shuffles and not more
+# resizes. The first dHash is the same as differenceHash(img).
+def flipHashes(img):
+    gray = img.convert('L')
+
+    thumbnail = numpy.frombuffer(thumbnailBytes(gray), dtype=numpy.uint8).reshape(HASH_SIZE, HASH_SIZE)
+    flipped = numpy.stack([thumbnail, thumbnail[:, ::-1], thumbnail[::-1], thumbnail[::-1, ::-1]])
+    flipped = flipped.reshape(-1, HASH_SIZE * HASH_SIZE)
+    dHashes = packHashes(flipped[:, _ORDER_ARRAY] >= flipped[:, _PREVIOUS_ARRAY])
+
+    # A box reduction to within 2x of the thumbnail first makes the resize
+    # several times cheaper, the low frequencies kept don't notice
+    pixels = numpy.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), RESAMPLE, reducing_gap=2.0), dtype=numpy.float64)
+    coefficients = (_FLIP_SIGNS * (_DCT @ pixels @ _DCT.T)).reshape(len(_FLIP_SIGNS), -1)
+    # The DC term only says how bright the image is, leave it out of the median
+    medians = numpy.median(coefficients[:, 1:], axis=1)
+    pHashes = packHashes(coefficients > medians[:, None])
+    return dHashes, pHashes
@@ -0,0 +1,123 @@
+import math
+import os
+import socket
+import threading
+
+# Lease names, one per subreddit plus one for the inbox
+SUBREDDIT_PREFIX = 'r/'
+MAIL = 'mail'
+
+
+class LeaseManager:
+    # Splits subreddits between worker processes through lease rows in
+    # WorkerLease. Each worker heartbeats on a background thread, renewing
+    # its leases and claiming or releasing them until it holds its share of
+    # the total. Leases of a worker that stops heartbeating expire and are
+    # picked up by the others. Reading the inbox is leased the same way so
+    # only one worker handles mail. Times come from the database clock so
+    # workers on different hosts agree on expiry.
+
+    def __init__(self, db, logger, workerId=None, ttl=60):
+        self.db = db
+        self.logger = logger
+        self.workerId = workerId or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.owned = frozenset()
+        self.stopped = threading.Event()
+        self.thread = None
+        # Called from the heartbeat thread after leases are gained or lost
+        self.listeners = []
+
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=self.run, name='leases', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.ttl / 3):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error('Failed to renew leases for worker {0} - {1}'.format(self.workerId, e))
+
+    # Give up every lease so the other workers don't wait for them to expire
+    def stop(self):
+        self.stopped.set()
+
+        def work(cur):
+            cur.execute('UPDATE WorkerLease SET worker_id=NULL, expires=NULL WHERE worker_id=%s', (self.workerId,))
+            cur.execute('DELETE FROM Worker WHERE worker_id=%s', (self.workerId,))
+
+        self.db.run(work, 'lease_release')
+        self.owned = frozenset()
+
+    def subreddits(self):
+        return {lease[len(SUBREDDIT_PREFIX):] for lease in self.owned if lease.startswith(SUBREDDIT_PREFIX)}
+
+    def ownsSubreddit(self, subname):
+        return SUBREDDIT_PREFIX + subname in self.owned
+
+    def ownsMail(self):
+        return MAIL in self.owned
+
+    def refresh(self):
+        owned = self.db.run(self.rebalance, 'lease_refresh')
+        gained = owned - self.owned
+        lost = self.owned - owned
+        if gained or lost:
+            self.logger.info('Worker {0} holds {1} leases, gained: {2}, lost: {3}'.format(
+                self.workerId, len(owned), ', '.join(sorted(gained)) or 'none', ', '.join(sorted(lost)) or 'none'))
+        self.owned = owned
+        if gained or lost:
+            for listener in self.listeners:
+                listener()
+
+    # Heartbeat, renew our leases and claim or release leases to get to
+    # ceil(leases / live workers). Returns the set of leases held.
+    def rebalance(self, cur):
+        cur.execute(
+            'INSERT INTO Worker(worker_id, heartbeat) VALUES(%s, now()) '
+            'ON CONFLICT (worker_id) DO UPDATE SET heartbeat=EXCLUDED.heartbeat',
+            (self.workerId,))
+        cur.execute("DELETE FROM Worker WHERE heartbeat < now() - %s * INTERVAL '1 second'", (self.ttl,))
+        cur.execute('SELECT count(*) FROM Worker')
+        workers = cur.fetchone()[0]
+
+        # Keep one lease per subreddit in SubredditSettings
+        cur.execute(
+            'INSERT INTO WorkerLease(resource) SELECT %s || subname FROM SubredditSettings '
+            'UNION ALL SELECT %s ON CONFLICT (resource) DO NOTHING',
+            (SUBREDDIT_PREFIX, MAIL))
+        cur.execute(
+            'DELETE FROM WorkerLease WHERE resource <> %s AND substr(resource, %s) NOT IN '
+            '(SELECT subname FROM SubredditSettings)',
+            (MAIL, len(SUBREDDIT_PREFIX) + 1))
+        cur.execute('SELECT count(*) FROM WorkerLease')
+        total = cur.fetchone()[0]
+
+        cur.execute(
+            "UPDATE WorkerLease SET expires=now() + %s * INTERVAL '1 second' WHERE worker_id=%s RETURNING resource",
+            (self.ttl, self.workerId))
+        owned = sorted(row[0] for row in cur.fetchall())
+
+        share = math.ceil(total / max(workers, 1))
+        if len(owned) > share:
+            # Another worker joined, hand back the surplus for it to claim
+            cur.execute(
+                'UPDATE WorkerLease SET worker_id=NULL, expires=NULL WHERE resource = ANY(%s) AND worker_id=%s',
+                (owned[share:], self.workerId))
+            owned = owned[:share]
+        elif len(owned) < share:
+            # Unowned or expired leases nobody else is claiming right now
+            cur.execute(
+                'SELECT resource FROM WorkerLease WHERE worker_id IS NULL OR expires < now() '
+                'ORDER BY resource LIMIT %s FOR UPDATE SKIP LOCKED',
+                (share - len(owned),))
+            claimed = [row[0] for row in cur.fetchall()]
+            if claimed:
+                cur.execute(
+                    "UPDATE WorkerLease SET worker_id=%s, expires=now() + %s * INTERVAL '1 second' "
+                    "WHERE resource = ANY(%s)",
+                    (self.workerId, self.ttl, claimed))
+            owned += claimed
+        return frozenset(owned)
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from urllib.parse import urlsplit
+
+from HashIndex import toSigned, toUnsigned
+
+# Hosts serving immutable files where the query string is only cache busting
+STATIC_HOSTS = ('i.redd.it', 'i.imgur.com', 'i.reddituploads.com')
+
+# Inserts between evictions
+EVICT_EVERY = 1000
+
+
+# Cache key for a url, the scheme and www. are dropped and so is the query
+# on static hosts, so http/https and ?1 variants share one entry
+def urlKey(url):
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    key = host + parts.path
+    if parts.query and host not in STATIC_HOSTS:
+        key += '?' + parts.query
+    return 'url:' + key
+
+
+def contentKey(content):
+    return 'sha256:' + hashlib.sha256(content).hexdigest()
+
+
+class MediaCache:
+    # Maps normalized urls and SHA-256 digests of downloaded bytes to the
+    # (hash, width, height, size, pHash, flips) they produced, so repeat
+    # media costs a lookup instead of a download and decode. Stored in the
+    # MediaCache table and bounded to maxEntries by evicting the least
+    # recently used. Failures are logged and treated as misses, the cache is
+    # never allowed to break ingestion.
+
+    def __init__(self, db, logger, maxEntries=1000000):
+        self.db = db
+        self.logger = logger
+        self.maxEntries = maxEntries
+        self.inserts = 0
+        self.lock = threading.Lock()
+
+    # (hash, width, height, size, pHash, ((flip dHash, flip pHash), ...)) or
+    # None. Entries cached before pHashes and flips were stored are misses,
+    # so they're hashed again and stored complete.
+    def lookup(self, key):
+        try:
+            row = self.db.fetchone(
+                'UPDATE MediaCache SET last_used=%s WHERE key=%s '
+                'RETURNING hash, width, height, file_size, phash, flip_hashes, flip_phashes',
+                (time.time(), key))
+        except Exception as e:
+            self.logger.warning('Media cache lookup failed - {0}'.format(e))
+            return None
+        if row is None or row[4] is None or row[5] is None or row[6] is None:
+            return None
+        flips = tuple((toUnsigned(flipHash), toUnsigned(flipPhash)) for flipHash, flipPhash in zip(row[5], row[6]))
+        return (toUnsigned(row[0]), int(row[1]), int(row[2]), int(row[3]), toUnsigned(row[4]), flips)
+
+    def store(self, keys, mediaHash, width, height, size, phash=None, flips=()):
+        now = time.time()
+        signedPhash = toSigned(phash) if phash is not None else None
+        flipHashes = [toSigned(flipHash) for flipHash, _ in flips]
+        flipPhashes = [toSigned(flipPhash) for _, flipPhash in flips]
+        try:
+            self.db.run(lambda cur: self.db.executeValues(
+                cur,
+                'INSERT INTO MediaCache(key, hash, width, height, file_size, phash, flip_hashes, flip_phashes, '
+                'last_used) VALUES %s '
+                'ON CONFLICT (key) DO UPDATE SET hash=EXCLUDED.hash, width=EXCLUDED.width, '
+                'height=EXCLUDED.height, file_size=EXCLUDED.file_size, phash=EXCLUDED.phash, '
+                'flip_hashes=EXCLUDED.flip_hashes, flip_phashes=EXCLUDED.flip_phashes, '
+                'last_used=EXCLUDED.last_used',
+                [(key, toSigned(mediaHash), width, height, size, signedPhash, flipHashes, flipPhashes, now)
+                 for key in keys]),
+                'media_cache_store')
+        except Exception as e:
+            self.logger.warning('Media cache store failed - {0}'.format(e))
+            return
+
+        with self.lock:
+            self.inserts += len(keys)
+            evict = self.inserts >= EVICT_EVERY
+            if evict:
+                self.inserts = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        try:
+            self.db.execute(
+                'DELETE FROM MediaCache WHERE key IN ('
+                'SELECT key FROM MediaCache ORDER BY last_used DESC OFFSET %s)',
+                (self.maxEntries,))
+        except Exception as e:
+            self.logger.warning('Media cache eviction failed - {0}'.format(e))
@@ -0,0 +1,227 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image, ImageSequence
+from requests.adapters import HTTPAdapter
+
+from ImageHash import differenceHashBatch
+from MediaCache import contentKey, urlKey
+from Metrics import DECODE_SECONDS, DOWNLOAD_SECONDS, HASH_SECONDS
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_5_8) AppleWebKit/534.50.2 (KHTML, like Gecko) Version/5.0.6 Safari/533.22.3'
+
+# frames holds the hashes of the sampled frames of an animation and is
+# empty for single images. Single images also get a pHash and the (dHash,
+# pHash) of their horizontal, vertical and both way flips.
+MediaInfo = namedtuple('MediaInfo', ['hash', 'width', 'height', 'size', 'frames', 'phash', 'flips'])
+MediaInfo.__new__.__defaults__ = ((), None, ())
+
+# Images are decoded at roughly this size before hashing, anything bigger is
+# wasted work for an 8x8 hash
+DECODE_SIZE = (256, 256)
+# Stop trying to read the image header after this many bytes
+HEADER_PROBE_LIMIT = 1024 * 1024
+# Never decode more than this many frames of an animation, whatever the
+# sampling interval, so CPU per post stays bounded
+MAX_DECODED_FRAMES = 500
+# Frame duration assumed when a GIF doesn't give one, in milliseconds
+DEFAULT_FRAME_DURATION = 100
+
+
+# Raised through the future when the media could not be downloaded, so the
+# caller can tell download failures apart from decode failures
+class DownloadError(Exception):
+    pass
+
+
+# Raised when a download goes over the size cap, handled the same way as
+# images PIL refuses to open for being too large
+class MediaTooLarge(Image.DecompressionBombError):
+    pass
+
+
+class MediaFetcher:
+    # Two stage download and hashing pipeline. Downloads run on an I/O pool
+    # sharing one pooled session with a concurrency cap per host, decoding
+    # and hashing run on a separate pool. submit() returns a future so the
+    # caller can write results in submission order. hasher maps a decoded
+    # image to ([dHashes], [pHashes]) of it and its flips, like flipHashes.
+
+    def __init__(self, hasher, fetchWorkers=16, hashWorkers=4, perHost=4, timeout=30, maxBytes=32 * 1024 * 1024,
+                 cache=None, maxFrames=16, frameInterval=1000, logger=None):
+        self.hasher = hasher
+        self.cache = cache
+        self.maxFrames = maxFrames
+        self.frameInterval = frameInterval
+        self.timeout = timeout
+        self.maxBytes = maxBytes
+        self.logger = logger
+        self.perHost = perHost
+        self.hostLimits = {}
+        self.hostLimitsLock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=fetchWorkers, pool_maxsize=fetchWorkers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.fetchPool = ThreadPoolExecutor(fetchWorkers, thread_name_prefix='fetch')
+        self.hashPool = ThreadPoolExecutor(hashWorkers, thread_name_prefix='hash')
+
+    def hostLimit(self, url):
+        host = urlsplit(url).hostname
+        with self.hostLimitsLock:
+            limit = self.hostLimits.get(host)
+            if limit is None:
+                limit = self.hostLimits[host] = threading.BoundedSemaphore(self.perHost)
+            return limit
+
+    # Stream the media into memory, aborting as soon as it goes over the size
+    # cap or its header says it's a decompression bomb
+    def download(self, url):
+        with self.hostLimit(url):
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+
+                contentLength = response.headers.get('Content-Length')
+                if contentLength and contentLength.isdigit() and int(contentLength) > self.maxBytes:
+                    raise MediaTooLarge('Content-Length {0} over limit of {1} bytes'.format(
+                        contentLength, self.maxBytes))
+
+                buffer = BytesIO()
+                headerChecked = False
+                for chunk in response.iter_content(64 * 1024):
+                    buffer.write(chunk)
+                    if buffer.tell() > self.maxBytes:
+                        raise MediaTooLarge('Download over limit of {0} bytes'.format(self.maxBytes))
+                    if not headerChecked:
+                        headerChecked = self.checkHeader(buffer)
+
+        buffer.seek(0)
+        return buffer
+
+    # Returns True once the header has been parsed, Image.open raises
+    # DecompressionBombError from the dimensions alone
+    @staticmethod
+    def checkHeader(buffer):
+        try:
+            Image.open(BytesIO(buffer.getvalue()))
+        except (Image.UnidentifiedImageError, OSError, SyntaxError):
+            return buffer.tell() > HEADER_PROBE_LIMIT
+        return True
+
+    # Download stage. Returns a MediaInfo when the url or the downloaded bytes
+    # are already in the cache, otherwise (buffer, cache keys) to decode.
+    def fetch(self, url):
+        keys = []
+        if self.cache is not None:
+            keys.append(urlKey(url))
+            cached = self.cache.lookup(keys[0])
+            if cached is not None:
+                return MediaInfo(*cached[:4], phash=cached[4], flips=cached[5])
+
+        with DOWNLOAD_SECONDS.time():
+            buffer = self.download(url)
+
+        if self.cache is not None:
+            keys.append(contentKey(buffer.getbuffer()))
+            cached = self.cache.lookup(keys[1])
+            if cached is not None:
+                self.cache.store(keys[:1], *cached)
+                return MediaInfo(*cached[:4], phash=cached[4], flips=cached[5])
+        return buffer, keys
+
+    # Decode stage, caches the result under every key the media was seen as.
+    # Animations aren't cached, the cache only holds a single hash.
+    def decodeAndCache(self, buffer, keys):
+        mediaInfo = self.decode(buffer)
+        if keys and not mediaInfo.frames:
+            self.cache.store(keys, *mediaInfo[:4], phash=mediaInfo.phash, flips=mediaInfo.flips)
+        return mediaInfo
+
+    def decode(self, buffer):
+        with DECODE_SECONDS.time():
+            img = Image.open(buffer)
+            width, height = img.size
+
+            frames = self.sampleFrames(img) if getattr(img, 'is_animated', False) else []
+            if len(frames) <= 1:
+                if frames:
+                    img.seek(0)
+                # JPEGs can be decoded straight to a 1/2 - 1/8 scale, everything
+                # else gets a cheap box reduction first. About one in five large
+                # images hash a bit away from a full decode of them, so rows
+                # hashed before this don't match reposts exactly:
+                # RepostSentinel.BLACKLIST_DISTANCE allows for it and exact
+                # duplicate compaction leaves such pairs uncompacted.
+                img.draft('L', DECODE_SIZE)
+                factor = min(img.size[0] // DECODE_SIZE[0], img.size[1] // DECODE_SIZE[1])
+                if factor > 1:
+                    img = img.reduce(factor)
+                img.load()
+
+        with HASH_SECONDS.time():
+            if len(frames) > 1:
+                frameHashes = differenceHashBatch(frames)
+                return MediaInfo(frameHashes[0], width, height, buffer.getbuffer().nbytes, tuple(frameHashes))
+            dHashes, pHashes = self.hasher(img)
+            return MediaInfo(dHashes[0], width, height, buffer.getbuffer().nbytes, phash=pHashes[0],
+                             flips=tuple(zip(dHashes[1:], pHashes[1:])))
+
+    # Grayscale copies of at most maxFrames frames, one per frameInterval
+    # milliseconds of playback. Frames are decoded one at a time as the
+    # sequence is walked and iteration stops as soon as enough are sampled.
+    def sampleFrames(self, img):
+        frames = []
+        elapsed = 0
+        nextSample = 0
+        for decoded, frame in enumerate(ImageSequence.Iterator(img)):
+            if decoded >= MAX_DECODED_FRAMES or len(frames) >= self.maxFrames:
+                break
+            if elapsed >= nextSample:
+                frames.append(frame.convert('L'))
+                nextSample = elapsed + self.frameInterval
+            elapsed += frame.info.get('duration') or DEFAULT_FRAME_DURATION
+        return frames
+
+    # Queue a url for download and hashing, the future resolves to a
+    # MediaInfo or raises whatever the download or decode raised
+    def submit(self, url):
+        result = Future()
+
+        def decoded(decodeFuture):
+            try:
+                result.set_result(decodeFuture.result())
+            except Exception as e:
+                result.set_exception(e)
+
+        def downloaded(downloadFuture):
+            try:
+                fetched = downloadFuture.result()
+            except Image.DecompressionBombError as e:
+                result.set_exception(e)
+                return
+            except Exception as e:
+                result.set_exception(DownloadError(e))
+                return
+            if isinstance(fetched, MediaInfo):
+                result.set_result(fetched)
+                return
+            try:
+                self.hashPool.submit(self.decodeAndCache, *fetched).add_done_callback(decoded)
+            except Exception as e:
+                # e.g. the pool was shut down, the caller would wait forever
+                result.set_exception(e)
+
+        self.fetchPool.submit(self.fetch, url).add_done_callback(downloaded)
+        return result
+
+    def shutdown(self):
+        self.fetchPool.shutdown()
+        self.hashPool.shutdown()
+        self.session.close()
@@ -0,0 +1,126 @@
+import html
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+# A piece of media to hash. url may point at a reduced preview, width and
+# height are the original's dimensions when reddit reports them, else None.
+MediaSource = namedtuple('MediaSource', ['url', 'width', 'height'])
+
+# Hosts serving images without a file extension in the url
+IMAGE_HOSTS = ('i.redd.it', 'preview.redd.it', 'i.reddituploads.com')
+
+
+# Whether a url points straight at an image we can hash
+def isImageUrl(media):
+    return (
+        (
+            media.endswith(".jpg")
+            or media.endswith(".jpg?1")
+            or media.endswith(".png")
+            or media.endswith("png?1")
+            or media.endswith(".jpeg")
+            or media.endswith(".gif")
+        )
+        or "reddituploads.com" in media
+        or "reutersmedia.net" in media
+        or "500px.org" in media
+        or "redditmedia.com" in media
+        or urlsplit(media).hostname in IMAGE_HOSTS
+    )
+
+
+# A field of the listing data reddit sent for a submission, None when it
+# was left out. praw objects are lazy, reading a missing attribute through
+# getattr makes praw fetch the whole submission again.
+def listingField(submission, name):
+    return vars(submission).get(name)
+
+
+# Pick the smallest of the given (url, width, height) resolutions that is
+# still at least minWidth x minHeight, or None when none are big enough
+def smallestSufficient(resolutions, minWidth, minHeight):
+    sufficient = [
+        resolution for resolution in resolutions
+        if resolution[1] >= minWidth and resolution[2] >= minHeight
+    ]
+    if not sufficient:
+        return None
+    return min(sufficient, key=lambda resolution: resolution[1] * resolution[2])
+
+
+# Every piece of media in a submission, galleries expand to one source per
+# image. Returns an empty list for posts with nothing to hash.
+def resolveMedia(submission, minWidth=0, minHeight=0):
+    minWidth = minWidth or 0
+    minHeight = minHeight or 0
+
+    if listingField(submission, 'is_gallery'):
+        return resolveGallery(submission, minWidth, minHeight)
+
+    media = str(submission.url.replace("m.imgur.com", "i.imgur.com")).lower()
+    if not isImageUrl(media):
+        return []
+
+    # Animations are hashed from the original, previews are a single frame
+    if media.endswith('.gif'):
+        return [MediaSource(media, None, None)]
+
+    preview = resolvePreview(submission, minWidth, minHeight)
+    if preview is not None:
+        return [preview]
+    return [MediaSource(media, None, None)]
+
+
+def resolvePreview(submission, minWidth, minHeight):
+    try:
+        image = listingField(submission, 'preview')['images'][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+    source = image['source']
+    resolutions = [
+        (html.unescape(resolution['url']), resolution['width'], resolution['height'])
+        for resolution in image.get('resolutions', [])
+    ]
+    resolutions.append((html.unescape(source['url']), source['width'], source['height']))
+    chosen = smallestSufficient(resolutions, minWidth, minHeight)
+    if chosen is None:
+        return None
+    return MediaSource(chosen[0], source['width'], source['height'])
+
+
+def resolveGallery(submission, minWidth, minHeight):
+    metadata = listingField(submission, 'media_metadata') or {}
+    galleryData = listingField(submission, 'gallery_data') or {}
+
+    sources = []
+    for item in galleryData.get('items', []):
+        itemMetadata = metadata.get(item.get('media_id'))
+        if not itemMetadata or itemMetadata.get('status') != 'valid':
+            continue
+
+        source = itemMetadata.get('s', {})
+        width = source.get('x')
+        height = source.get('y')
+        # Animated items are hashed from the original GIF like a direct
+        # link to one, their previews are stills. mp4 only items can't be
+        # decoded.
+        if source.get('gif') or source.get('mp4'):
+            if source.get('gif'):
+                sources.append(MediaSource(html.unescape(source['gif']), width, height))
+            continue
+
+        sourceUrl = source.get('u')
+        resolutions = [
+            (html.unescape(preview['u']), preview['x'], preview['y'])
+            for preview in itemMetadata.get('p', [])
+        ]
+        if sourceUrl and width and height:
+            resolutions.append((html.unescape(sourceUrl), width, height))
+
+        chosen = smallestSufficient(resolutions, minWidth, minHeight)
+        if chosen is not None:
+            sources.append(MediaSource(chosen[0], width, height))
+        elif sourceUrl:
+            sources.append(MediaSource(html.unescape(sourceUrl), width, height))
+    return sources
@@ -0,0 +1,154 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a fast DB lookup up to a slow download
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} counter'.format(self.name)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{0}{1} {2}'.format(self.name, formatLabels(self.labels, key), value))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # {label values: [bucket counts..., sum, count]}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} histogram'.format(self.name)]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        self.name, formatLabels(self.labels, key, [('le', bound)]), count))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, formatLabels(self.labels, key, [('le', '+Inf')]), series[-1]))
+                lines.append('{0}_sum{1} {2}'.format(self.name, formatLabels(self.labels, key), series[-2]))
+                lines.append('{0}_count{1} {2}'.format(self.name, formatLabels(self.labels, key), series[-1]))
+        return lines
+
+
+class Registry:
+    # Collects metrics and serves them in the Prometheus text format
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    # Serve /metrics on a background thread
+    def serve(self, port, host=''):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+
+registry = Registry()
+
+DOWNLOAD_SECONDS = registry.histogram(
+    'repostsentinel_download_seconds', 'Time to download one piece of media')
+DECODE_SECONDS = registry.histogram(
+    'repostsentinel_decode_seconds', 'Time to decode downloaded media')
+HASH_SECONDS = registry.histogram(
+    'repostsentinel_hash_seconds', 'Time to hash decoded media')
+MATCH_SECONDS = registry.histogram(
+    'repostsentinel_match_seconds', 'Time to find matches for a submission', ['matcher'])
+DB_QUERY_SECONDS = registry.histogram(
+    'repostsentinel_db_query_seconds', 'Time per DB statement or transaction', ['query'])
+REDDIT_API_SECONDS = registry.histogram(
+    'repostsentinel_reddit_api_seconds', 'Latency of reddit API requests', ['method'])
+CYCLE_SECONDS = registry.histogram(
+    'repostsentinel_cycle_seconds', 'Duration of one iteration of a runtime task', ['task'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+SUBMISSIONS = registry.counter(
+    'repostsentinel_submissions_total', 'Submissions by subreddit and what happened to them',
+    ['subreddit', 'outcome'])
+MAIL_MESSAGES = registry.counter(
+    'repostsentinel_mail_messages_total', 'Inbox messages handled by checkMail', ['action'])
@@ -1,112 +1,260 @@
-import os, praw, psycopg2, time
+import praw, time
+import argparse
+import asyncio
+import math
+import os
 from sys import stdout
 import sys
 from PIL import Image
 import logging
 import yaml
-import requests
 import prawcore
-import urllib3.exceptions
+from Backfill import Backfill
+from Clusters import clusterMedia
+from Database import Database
+from LeaseManager import LeaseManager
+from SubmissionCache import SubmissionCache
+from SubredditSettings import SettingsCache
+from MediaCache import MediaCache
+from MediaResolver import resolveMedia
+from MediaFetcher import MediaFetcher, DownloadError
+from ImageHash import flipHashes
+from HashIndex import DEFAULT_MATCHER, HASH_BITS, HashIndex, SqlHashIndex, distanceToSimilarity, hammingDistance, similarityToRadius, toSigned, toUnsigned
+from HashSnapshot import HashSnapshot, snapshotAge, writeSnapshot
+from Retention import Retention
+from Runtime import Runtime, RateLimiter, REDDIT_EXCEPTIONS, describeError
+from Metrics import registry, MAIL_MESSAGES, MATCH_SECONDS, REDDIT_API_SECONDS, SUBMISSIONS
+
+# Longest joined "a+b+c" subreddit name list per stream, keeps the listing
+# url well under reddit's limits
+STREAM_CHUNK_LENGTH = 1000
+
+# Parents the dHash index shortlists per image and flip for the pHash check
+PREFILTER_LIMIT = 50
+
+# Posts within this many bits of a blacklisted post are removed. Rows hashed
+# before images were decoded at reduced scale can be a bit off the hash of
+# the same image now, see MediaFetcher.decode.
+BLACKLIST_DISTANCE = 1
+
+MEDIA_INSERT = 'INSERT INTO Media(hash, submission_id, subreddit, frame_number, frame_count, frame_width, frame_height, total_pixels, file_size, phash, created) VALUES'
+SUBMISSION_INSERT = 'INSERT INTO Submissions(id, subreddit, timestamp, author, title, url, comments, score, deleted, removed, removal_reason, blacklist, processed) VALUES'
+
+
+# Media row with its hashes as the signed BIGINTs the table stores
+def signedMedia(mediaData):
+    return (toSigned(mediaData[0]),) + mediaData[1:9] + (
+        toSigned(mediaData[9]) if mediaData[9] is not None else None,) + mediaData[10:]
+
+
+class MeteredRequestor(prawcore.Requestor):
+    # Times every HTTP request praw makes and holds it to the quota shared
+    # by every praw instance. Listings are lazy so timing the calls outside
+    # of here would miss most of them.
+
+    def __init__(self, *args, rateLimiter=None, **kwargs):
+        super(MeteredRequestor, self).__init__(*args, **kwargs)
+        self.rateLimiter = rateLimiter
+
+    def request(self, *args, **kwargs):
+        if self.rateLimiter is not None:
+            self.rateLimiter.wait()
+        with REDDIT_API_SECONDS.time(method=args[0] if args else kwargs.get('method', 'GET')):
+            response = super(MeteredRequestor, self).request(*args, **kwargs)
+        if self.rateLimiter is not None:
+            self.rateLimiter.update(response.headers)
+        return response
 
 
 class RepostSentinel:
-    def __init__(self, **kwargs):
-        self.db_connection = None
+    def __init__(self, config=None, **kwargs):
+        self.db = None
         self.subredditSettings = None
+        self.settingsCache = None
+        self.hashIndex = None
+        self.mediaFetcher = None
+        self.backfill = None
+        self.parentCache = None
+        self.retention = None
+        self.leases = None
+        self.shard = None
+        self.runtime = None
+        self.rateLimiter = RateLimiter()
+        self.streams = []
+        self.streamSubreddits = None
         self.logger = None
         self.debug = False
-        self.config = yaml.safe_load(open('config.yml'))
+        self.config = config if config is not None else yaml.safe_load(open('config.yml'))
         super(RepostSentinel, self).__init__(**kwargs)
 
     def start(self):
         self.setup_logging()
 
-        client_id = self.config['CLIENT_ID']
-        client_secret = self.config['CLIENT_SECRET']
-        username = self.config['USER_NAME']
-        password = self.config['USER_PASS']
-        user_agent = self.config['USER_AGENT']
+        metricsPort = self.config.get('METRICS_PORT', 0)
+        if metricsPort:
+            registry.serve(metricsPort)
+            self.logger.info('Serving metrics on port {0}'.format(metricsPort))
 
         # DB Connection
 
         try:
-            self.db_connection = psycopg2.connect(
-                "dbname='{0}' user='{1}' host='{2}' password='{3}'".format(
-                    self.config['DB_NAME'],
-                    self.config['DB_USER'],
-                    self.config['DB_HOST'],
-                    self.config['DB_PASS'])
-            )
-            self.db_connection.autocommit = True
+            self.db = Database(self.config, self.logger, maxConnections=self.config.get('DB_POOL_SIZE', 8))
+            self.db.connect()
+            self.prepareStatements()
+            self.settingsCache = SettingsCache(self.db, self.logger)
+            self.settingsCache.start()
         except Exception as e:
             self.logger.critical('Error connecting to DB: \n{}'.format(e))
             sys.exit(1)
 
-        # Connect to reddit
+        # Connect to reddit, every runtime thread gets its own instance later
 
         try:
-            r = praw.Reddit(client_id=client_id, client_secret=client_secret, password=password, user_agent=user_agent,
-                            username=username)
+            self.connectReddit()
         except Exception as e:
             self.logger.error('Error connecting to reddit: \n{}'.format(e))
             sys.exit(1)
 
-        # ----------- MAIN LOOP ----------- #
-        while True:
-            self.logger.debug("Starting Main Loop")
-            try:
-                self.loadSubredditSettings()
-                if self.subredditSettings:
-                    for settings in self.subredditSettings:
-                        if settings[1] is False:
-                            self.ingestFull(r, settings)
-                            self.loadSubredditSettings()
-                        if settings[1]:
-                            self.ingestNew(r, settings)
-
-                    self.checkMail(r)
-
-            except(
-                    prawcore.exceptions.ResponseException,
-                    prawcore.exceptions.RequestException,
-                    prawcore.exceptions.ServerError,
-                    urllib3.exceptions.TimeoutError,
-                    requests.exceptions.Timeout,
-            ):
-                self.logger.warning(
-                    "HTTP Requests Error. Likely on reddits end due to site issues."
-                )
-                time.sleep(300)
-            except prawcore.exceptions.InvalidToken:
-                self.logger.warning(
-                    "API Token Error. Likely on reddits end. Issue self-resolves."
-                )
-                time.sleep(180)
-            except prawcore.exceptions.BadJSON:
-                self.logger.warning(
-                    "PRAW didn't get good JSON, probably reddit sending bad data due to site issues."
-                )
-                time.sleep(180)
-            except praw.exceptions.APIException:
-                self.logger.error("PRAW/Reddit API Error")
-                time.sleep(30)
-            except praw.exceptions.ClientException:
-                self.logger.error("PRAW Client Error")
-                time.sleep(30)
-            except KeyboardInterrupt as e:
-                self.logger.warning("Caught KeyboardInterrupt - Exiting")
-                sys.exit()
-            except Exception:
-                self.logger.critical("General Exception - Sleeping 5 min")
-                time.sleep(300)
+        # Claim a share of the subreddits when running as one of several workers
+
+        if self.config.get('WORKER_MODE', False):
+            self.leases = LeaseManager(self.db, self.logger, self.config.get('WORKER_ID'),
+                                       self.config.get('LEASE_TTL', 60))
+            self.leases.start()
+            self.shard = self.leases.subreddits()
+
+        # Build the in-memory hash index used for matching, starting from
+        # the snapshot when there is one
+
+        matcher = self.config.get('MATCHER', DEFAULT_MATCHER)
+        if matcher == 'sql':
+            self.hashIndex = SqlHashIndex(self.logger)
+        else:
+            self.hashIndex = HashIndex(self.logger, matcher)
+        self.hashIndex.load(self.db, self.shard, self.openSnapshot())
+
+        # Media download and hashing pipeline
+
+        self.mediaFetcher = MediaFetcher(
+            flipHashes,
+            fetchWorkers=self.config.get('FETCH_WORKERS', 16),
+            hashWorkers=self.config.get('HASH_WORKERS', 4),
+            perHost=self.config.get('FETCH_PER_HOST', 4),
+            timeout=self.config.get('FETCH_TIMEOUT', 30),
+            maxBytes=self.config.get('MAX_MEDIA_BYTES', 32 * 1024 * 1024),
+            maxFrames=self.config.get('MAX_FRAMES', 16),
+            frameInterval=self.config.get('FRAME_INTERVAL', 1000),
+            cache=MediaCache(self.db, self.logger, self.config.get('MEDIA_CACHE_SIZE', 1000000)),
+            logger=self.logger
+        )
+
+        self.backfill = Backfill(self, self.connectReddit)
+
+        self.retention = Retention(
+            self.db, self.logger,
+            months=self.config.get('MEDIA_PARTITION_MONTHS', 12),
+            archive=self.config.get('ARCHIVE_EXPIRED_MEDIA', True),
+            tablespace=self.config.get('ARCHIVE_TABLESPACE') or None
+        )
+
+        self.parentCache = SubmissionCache(
+            maxSize=self.config.get('PARENT_CACHE_SIZE', 10000),
+            ttl=self.config.get('PARENT_CACHE_TTL', 600)
+        )
+
+        # ----------- RUNTIME ----------- #
+        self.runtime = Runtime(
+            self,
+            workers=self.config.get('TASK_WORKERS', 8),
+            ingestInterval=self.config.get('INGEST_INTERVAL', 30),
+            mailInterval=self.config.get('MAIL_INTERVAL', 60),
+            settingsInterval=self.config.get('SETTINGS_INTERVAL', 60),
+            maintenanceInterval=self.config.get('MAINTENANCE_INTERVAL', 86400)
+        )
+        try:
+            asyncio.run(self.runtime.run())
+        except KeyboardInterrupt as e:
+            self.logger.warning("Caught KeyboardInterrupt - Exiting")
+            if self.leases is not None:
+                self.leases.stop()
+            sys.exit()
+
+    def connectReddit(self):
+        return praw.Reddit(
+            client_id=self.config['CLIENT_ID'],
+            client_secret=self.config['CLIENT_SECRET'],
+            password=self.config['USER_PASS'],
+            user_agent=self.config['USER_AGENT'],
+            username=self.config['USER_NAME'],
+            requestor_class=MeteredRequestor,
+            requestor_kwargs={'rateLimiter': self.rateLimiter}
+        )
+
+    # The HashSnapshot at SNAPSHOT_PATH, None when snapshots are off or it
+    # can't be read and the index has to be loaded from Media
+    def openSnapshot(self):
+        path = self.config.get('SNAPSHOT_PATH')
+        if not path or self.config.get('MATCHER', DEFAULT_MATCHER) == 'sql' or snapshotAge(path) == float('inf'):
+            return None
+        try:
+            snapshot = HashSnapshot(path)
+        except Exception as e:
+            self.logger.warning('Ignoring hash index snapshot {0} - {1}'.format(path, e))
+            return None
+        self.logger.info('Mapped snapshot of {0} hashes up to seq {1} from {2}'.format(
+            len(snapshot), snapshot.watermark, path))
+        return snapshot
+
+    # Rewrite the snapshot once it's older than SNAPSHOT_INTERVAL, checked
+    # by every worker sharing the file so only one of them does it
+    def writeSnapshot(self):
+        path = self.config['SNAPSHOT_PATH']
+        if snapshotAge(path) >= self.config.get('SNAPSHOT_INTERVAL', 3600):
+            writeSnapshot(self.db, path, self.logger)
+
+    # Partition, expire and compact Media for this worker's subreddits, then
+    # drop what was moved out of Media from the in-memory index
+    def maintainMedia(self):
+        changed = self.retention.run(self.shardSettings())
+        if not changed:
+            return
+        self.hashIndex.reload(self.db, changed)
+        if self.config.get('SNAPSHOT_PATH') and self.config.get('MATCHER', DEFAULT_MATCHER) != 'sql':
+            writeSnapshot(self.db, self.config['SNAPSHOT_PATH'], self.logger)
+
+    # Statements run for every submission, prepared once per connection
+    def prepareStatements(self):
+        self.db.prepare('indexed_submissions', 'SELECT id FROM Submissions WHERE id = ANY(%s)')
+        self.db.prepare('select_submissions', 'SELECT * FROM Submissions WHERE id = ANY(%s)')
+        self.db.prepare('insert_media', MEDIA_INSERT + '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)')
+        self.db.prepare(
+            'select_phashes',
+            'SELECT submission_id, phash FROM Media WHERE submission_id = ANY(%s) AND subreddit=%s '
+            'AND frame_count=1 AND phash IS NOT NULL')
+        self.db.prepare('insert_submission', SUBMISSION_INSERT + '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)')
+
+    # Write the near duplicate clusters of subreddits' images instead of
+    # running the bot, see Clusters.clusterMedia
+    def cluster(self, subreddits, radius, output, format='csv', workers=1, minPosts=2, top=None):
+        self.setup_logging(stream=sys.stderr)
+        try:
+            self.db = Database(self.config, self.logger, maxConnections=1)
+            self.db.connect()
+        except Exception as e:
+            self.logger.critical('Error connecting to DB: \n{}'.format(e))
+            sys.exit(1)
+        try:
+            clusterMedia(self.db, subreddits, radius, output, format, workers, minPosts, top, self.logger)
+        finally:
+            self.db.close()
 
     # Setup console logger
-    def setup_logging(self):
+    def setup_logging(self, stream=stdout):
         self.logger = logging.getLogger("RepostSentinal")
         formatter = logging.Formatter('[%(asctime)s %(levelname)s] %(message)s')
         # Prevent default handler from being used
         self.logger.propagate = False
-        console_handler = logging.StreamHandler(stream=stdout)
+        console_handler = logging.StreamHandler(stream=stream)
         console_handler.setFormatter(formatter)
         console_handler.setLevel(logging.DEBUG)
         self.logger.addHandler(console_handler)
@@ -118,157 +266,364 @@ class RepostSentinel:
 
     # Import new submissions
     def ingestNew(self, r, settings):
-        self.logger.info('Scanning new for /r/{0}'.format(settings[0]))
-        for submission in r.subreddit(settings[0]).new(limit=200):
+        self.logger.info('Scanning new for /r/{0}'.format(settings.subname))
+        lastSeenId, lastSeenUtc = self.db.fetchone(
+            'SELECT last_seen_id, last_seen_utc FROM IngestState WHERE subname=%s', (settings.subname,)) or (None, 0)
+
+        # New is newest first, so everything after the high-water mark has
+        # already been through here
+        submissions = []
+        for submission in r.subreddit(settings.subname).new(limit=200):
+            if submission.id == lastSeenId or submission.created_utc < lastSeenUtc:
+                break
+            submissions.append(submission)
+
+        if not submissions:
+            self.logger.debug('Nothing new for /r/{0}'.format(settings.subname))
+            return
+
+        # Oldest first, a repost posted in the same batch as its parent is
+        # only caught once the parent has been indexed
+        submissions.reverse()
+
+        SUBMISSIONS.inc(len(submissions), subreddit=settings.subname, outcome='seen')
+        indexed = self.indexedSubmissions([submission.id for submission in submissions])
+
+        pending = []
+        for submission in submissions:
             self.logger.debug('Processing submission {}'.format(submission.fullname))
-            self.indexSubmission(r, submission, settings, True)
-
-    # Import all submissions from all time within a sub
-    def ingestFull(self, r, settings):
-        for topall in r.subreddit(settings[0]).top(time_filter='all'):
-            self.logger.info(
-                f"ingestfull of topall found submission {topall.fullname} for r/{settings[0]}"
-            )
-            self.indexSubmission(r, topall, settings, False)
-        for topyear in r.subreddit(settings[0]).top(time_filter='year'):
-            self.logger.info(
-                f"ingestfull of topyear found submission {topyear.fullname} for r/{settings[0]}"
-            )
-            self.indexSubmission(r, topyear, settings, False)
-        for topmonth in r.subreddit(settings[0]).top(time_filter='month'):
-            self.logger.info(
-                f"ingestfull of topmonth found submission {topmonth.fullname} for r/{settings[0]}"
-            )
-            self.indexSubmission(r, topmonth, settings, False)
+            if self.skipSubmission(submission, settings, indexed):
+                pending.append((submission, None))
+                continue
+            # Media downloads and hashing run in the background, results are
+            # written and enforced in submission order below
+            pending.append((submission, self.fetchMedia(submission, settings)))
+
+        # The high-water mark stops before the first submission that wasn't
+        # stored, so the next scan (maybe by the worker the lease moved to)
+        # picks it up again
+        lastDone = None
+        unstored = False
+        for submission, mediaFutures in pending:
+            if mediaFutures is not None and not self.storeSubmission(r, submission, settings, True, mediaFutures):
+                unstored = True
+            elif not unstored:
+                lastDone = submission
+
+        if lastDone is None:
+            return
+        self.db.execute(
+            'INSERT INTO IngestState(subname, last_seen_id, last_seen_utc) VALUES(%s, %s, %s) '
+            'ON CONFLICT (subname) DO UPDATE SET last_seen_id=EXCLUDED.last_seen_id, last_seen_utc=EXCLUDED.last_seen_utc',
+            (settings.subname, lastDone.id, float(lastDone.created_utc)))
+
+    # Import new submissions for every imported subreddit through combined
+    # "a+b+c" submission streams, each submission is dispatched to the
+    # settings of the subreddit it was posted in
+    def ingestStream(self, r):
+        settingsByName = {
+            settings.subname.lower(): settings for settings in self.shardSettings() if settings.imported
+        }
+        subreddits = sorted(settingsByName)
+        if subreddits != self.streamSubreddits:
+            self.logger.info('Streaming {0} subreddits'.format(len(subreddits)))
+            self.streamSubreddits = subreddits
+            # pause_after=0 makes a stream yield None as soon as a request
+            # comes back with nothing new, so every stream gets polled in turn
+            self.streams = [
+                r.subreddit(chunk).stream.submissions(pause_after=0)
+                for chunk in self.subredditChunks(subreddits)
+            ]
+
+        # A praw stream is finished for good once a request in it fails, the
+        # streams are rebuilt on the next poll and whatever was read before
+        # the failure is still processed
+        submissions = []
+        error = None
+        try:
+            for stream in self.streams:
+                for submission in stream:
+                    if submission is None:
+                        break
+                    submissions.append(submission)
+        except Exception as e:
+            self.streams = []
+            self.streamSubreddits = None
+            error = e
+
+        if submissions:
+            self.processStreamed(r, submissions, settingsByName)
+        if error is not None:
+            raise error
+
+    # Index streamed submissions under the settings of their subreddit
+    def processStreamed(self, r, submissions, settingsByName):
+        indexed = self.indexedSubmissions([submission.id for submission in submissions])
+
+        pending = []
+        for submission in submissions:
+            settings = settingsByName.get(submission.subreddit.display_name.lower())
+            if settings is None:
+                continue
+            SUBMISSIONS.inc(subreddit=settings.subname, outcome='seen')
+            self.logger.debug('Processing submission {}'.format(submission.fullname))
+            if self.skipSubmission(submission, settings, indexed):
+                continue
+            pending.append((submission, settings, self.fetchMedia(submission, settings)))
 
-            # Update DB
+        for submission, settings, mediaFutures in pending:
+            self.storeSubmission(r, submission, settings, True, mediaFutures)
 
-            cur = self.db_connection.cursor()
-            cur.execute('UPDATE SubredditSettings SET imported=TRUE WHERE subname=\'{0}\''.format(settings[0]))
+    # Split subreddit names into "a+b+c" strings of bounded length
+    @staticmethod
+    def subredditChunks(subreddits):
+        chunks = []
+        chunk = []
+        length = 0
+        for subreddit in subreddits:
+            if chunk and length + len(subreddit) + 1 > STREAM_CHUNK_LENGTH:
+                chunks.append('+'.join(chunk))
+                chunk = []
+                length = 0
+            chunk.append(subreddit)
+            length += len(subreddit) + 1
+        if chunk:
+            chunks.append('+'.join(chunk))
+        return chunks
+
+    # Ids out of the given ones that are already in Submissions
+    def indexedSubmissions(self, submissionIds):
+        return {row[0] for row in self.db.fetchall('indexed_submissions', (list(submissionIds),))}
+
+    # Import all submissions from all time within a sub, runs in the
+    # background and sets imported once complete
+    def ingestFull(self, settings):
+        self.backfill.start(settings)
+
+    # Write a batch with multi-row inserts, falling back to one transaction
+    # per record so one bad row doesn't lose the rest
+    def writeBatch(self, records):
+        try:
+            self.writeRecords(records)
+        except Exception as e:
+            self.logger.warning('Batch insert of {0} submissions failed, retrying one by one - {1}'.format(
+                len(records), e))
+            for record in records:
+                try:
+                    self.writeRecords([record])
+                except Exception as e:
+                    self.logger.error('Error adding {0} - {1}'.format(record[1][0], e))
 
-    def indexSubmission(self, r, submission, settings, enforce):
-        self.logger.debug(f"Got connection for indexing submission {submission.fullname}")
+    # Returns True when a submission doesn't need indexing, indexed is an
+    # optional set of ids already known to be in the DB. Blacklisted posts
+    # are indexed whatever their age, retention=False.
+    def skipSubmission(self, submission, settings, indexed=None, retention=True):
         try:
             # Skip self posts
             if submission.is_self:
                 self.logger.debug(
-                f"skipping self post {submission.fullname} for r/{settings[0]}"
+                f"skipping self post {submission.fullname} for r/{settings.subname}"
                 )
-                return
+                SUBMISSIONS.inc(subreddit=settings.subname, outcome='skipped')
+                return True
 
-            cur = self.db_connection.cursor()
+            # Posts past the retention window would only be archived again
+            if retention and settings.retentionDays is not None and (
+                    submission.created < time.time() - settings.retentionDays * 86400):
+                self.logger.debug(
+                f"skipping post past retention {submission.fullname} for r/{settings.subname}"
+                )
+                SUBMISSIONS.inc(subreddit=settings.subname, outcome='skipped')
+                return True
 
             # Check for an existing entry so we don't make a duplicate
             self.logger.debug(
-            f"checking if post already in db {submission.fullname} for r/{settings[0]}"
+            f"checking if post already in db {submission.fullname} for r/{settings.subname}"
             )
-            cur.execute("SELECT id FROM Submissions WHERE id='{0}'".format(submission.id))
-            results = cur.fetchone()
+            if indexed is None:
+                indexed = self.indexedSubmissions([submission.id])
 
-            if results:
+            if submission.id in indexed:
                 self.logger.debug(
-                f"skipping post already in db {submission.fullname} for r/{settings[0]}"
+                f"skipping post already in db {submission.fullname} for r/{settings.subname}"
                 )
-                return
+                SUBMISSIONS.inc(subreddit=settings.subname, outcome='skipped')
+                return True
+        except Exception as e:
+            self.logger.error('Failed to ingest {0} - {1}'.format(submission.id, e))
+            SUBMISSIONS.inc(subreddit=settings.subname, outcome='skipped')
+            return True
+        return False
+
+    # Start downloading and hashing the submission's media in the background,
+    # returns [(MediaSource, future)], empty when there's nothing to hash
+    def fetchMedia(self, submission, settings):
+        return [
+            (source, self.mediaFetcher.submit(source.url))
+            for source in resolveMedia(submission, settings.minWidth, settings.minHeight)
+        ]
+
+    def indexSubmission(self, r, submission, settings, enforce, retention=True):
+        self.logger.debug(f"Got connection for indexing submission {submission.fullname}")
+        SUBMISSIONS.inc(subreddit=settings.subname, outcome='seen')
+        if self.skipSubmission(submission, settings, retention=retention):
+            return
+        self.storeSubmission(r, submission, settings, enforce, self.fetchMedia(submission, settings))
+
+    # Index a submission if it isn't yet and mark it blacklisted. Its media
+    # is brought back from MediaArchive when maintenance already moved it,
+    # with a new seq so index snapshots pick it up.
+    def blacklistSubmission(self, r, submission, settings):
+        self.indexSubmission(r, submission, settings, False, retention=False)
+
+        def work(cur):
+            cur.execute('UPDATE Submissions SET blacklist=TRUE WHERE id=%s', (submission.id,))
+            cur.execute(
+                'WITH restored AS (DELETE FROM MediaArchive WHERE subreddit=%(subname)s AND submission_id=%(id)s '
+                'RETURNING *) INSERT INTO Media(hash, submission_id, subreddit, frame_number, frame_count, '
+                'frame_width, frame_height, total_pixels, file_size, phash, created, ref_count) '
+                'SELECT hash, submission_id, subreddit, frame_number, frame_count, frame_width, frame_height, '
+                'total_pixels, file_size, phash, created, ref_count FROM restored RETURNING hash, frame_count',
+                {'subname': settings.subname, 'id': submission.id})
+            restored = cur.fetchall()
+            cur.execute('SELECT count(*) FROM Media WHERE subreddit=%s AND submission_id=%s',
+                        (settings.subname, submission.id))
+            return restored, cur.fetchone()[0]
+
+        restored, media = self.db.run(work, 'blacklist')
+        for mediaHash, frameCount in restored:
+            self.hashIndex.add(settings.subname, toUnsigned(mediaHash), submission.id, frameCount > 1)
+        if media:
+            self.logger.info('Blacklisted {0}, {1} media rows'.format(submission.fullname, media))
+        else:
+            self.logger.warning('Blacklisted {0} but it has no media to match'.format(submission.fullname))
+
+    # Write a submission and its hashed media to the DB in one transaction,
+    # enforcing first if asked to. Waits on the media futures from fetchMedia.
+    # Returns False when the submission was left unwritten.
+    def storeSubmission(self, r, submission, settings, enforce, mediaFutures):
+        record = self.buildRecord(r, submission, settings, enforce, mediaFutures)
+        if record is None:
+            return False
+        try:
+            self.writeRecords([record])
+        except Exception as e:
+            self.logger.error('Error adding {0} - {1}'.format(submission.id, e))
+            return False
+        return True
 
+    # Hash, enforce and build the (media rows, submission row) to be written
+    def buildRecord(self, r, submission, settings, enforce, mediaFutures):
+        try:
             self.logger.info(f'Indexing submission: {submission.fullname}')
 
-            # Download and process the media
             submissionProcessed = False
+            mediaRows = []
 
-            media = str(submission.url.replace("m.imgur.com", "i.imgur.com")).lower()
-            temp_file = '/tmp/temp_media_file'
-
-            # Check url
-            if (
-                    (
-                    media.endswith(".jpg")
-                    or media.endswith(".jpg?1")
-                    or media.endswith(".png")
-                    or media.endswith("png?1")
-                    or media.endswith(".jpeg")
-                )
-                or "reddituploads.com" in media
-                or "reutersmedia.net" in media
-                or "500px.org" in media
-                or "redditmedia.com" in media
-            ):
+            # Gallery images are numbered by position, animations get one
+            # row per sampled frame, numbered on from the frames of the
+            # animations before them
+            images = []
+            imageInfos = []
+            frames = []
+            frameHashes = []
 
+            for mediaNumber, (source, mediaFuture) in enumerate(mediaFutures, 1):
                 try:
-                    if os.path.isfile(temp_file):
-                        os.remove(temp_file)
-
-                    # Download it
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_5_8) AppleWebKit/534.50.2 (KHTML, like Gecko) Version/5.0.6 Safari/533.22.3'}
-                    response = requests.get(media, headers=headers)
-                    mediaContent = response.content
-
-                    # Save it
-                    f = open(temp_file, 'wb')
-                    f.write(mediaContent)
-                    f.close()
-
-                    try:
-                        img = Image.open(temp_file)
+                    mediaInfo = mediaFuture.result()
+                except DownloadError as e:
+                    self.logger.warning('Failed to download {0} - {1}'.format(submission.fullname, e))
+                    continue
+                except Image.DecompressionBombError as e:
+                    self.logger.warning('File aborting due to size {0} - {1}'.format(
+                        submission.fullname, e
+                        )
+                    )
+                    submissionValues = (
+                        str(submission.id),
+                        settings.subname,
+                        float(submission.created),
+                        None,
+                        str(submission.title),
+                        str(submission.url),
+                        int(submission.num_comments),
+                        int(submission.score),
+                        None,
+                        None,
+                        None,
+                        None,
+                        None
+                    )
+                    return [], submissionValues
+                except Exception as e:
+                    self.logger.error('Error processing {0} - {1}'.format(submission.fullname, e))
+                    continue
 
-                        width, height = img.size
-                        pixels = width * height
-                        size = os.path.getsize(temp_file)
+                # Previews are hashed at reduced size, record the original
+                width = source.width or mediaInfo.width
+                height = source.height or mediaInfo.height
+                pixels = width * height
+                size = mediaInfo.size
 
-                        imgHash = self.DifferenceHash(img)
+                if not settings.accepts(width, height):
+                    continue
 
-                        mediaData = (
+                if mediaInfo.frames:
+                    frames.extend(
+                        (
                             imgHash,
                             str(submission.id),
-                            settings[0],
-                            1,
-                            1,
+                            settings.subname,
+                            frameNumber,
+                            len(mediaInfo.frames),
                             width,
                             height,
                             pixels,
-                            size
+                            size,
+                            None,
+                            float(submission.created)
                         )
+                        for frameNumber, imgHash in enumerate(mediaInfo.frames, len(frames) + 1)
+                    )
+                    frameHashes.append(list(mediaInfo.frames))
+                else:
+                    images.append((
+                        mediaInfo.hash,
+                        str(submission.id),
+                        settings.subname,
+                        mediaNumber,
+                        1,
+                        width,
+                        height,
+                        pixels,
+                        size,
+                        mediaInfo.phash,
+                        float(submission.created)
+                    ))
+                    imageInfos.append(mediaInfo)
+
+            # The lease may have moved to another worker while the media
+            # downloaded, the submission is left for that worker to enforce
+            if enforce and not self.ownsSubreddit(settings.subname):
+                self.logger.info('Leaving {0} to the worker now holding r/{1}'.format(
+                    submission.fullname, settings.subname))
+                return None
+
+            for mediaGroup, mediaHashes in ((images, imageInfos), (frames, frameHashes)):
+                if not mediaGroup:
+                    continue
+                try:
+                    if enforce:
+                        self.enforceSubmission(r, submission, settings, mediaGroup[0], mediaHashes)
 
-                        if width > 200 and height > 200:
-                            if enforce:
-                                self.enforceSubmission(r, submission, settings, mediaData)
-
-                            # Add to DB
-                            cur.execute(
-                                'INSERT INTO Media(hash, submission_id, subreddit, frame_number, frame_count, frame_width, frame_height, total_pixels, file_size) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                                mediaData)
-                            submissionProcessed = True
-
-                    except Image.DecompressionBombError as e:
-                        self.logger.warning('File aborting due to size {0} - {1}'.format(
-                            submission.fullname, e
-                            )
-                        )
-                        submissionValues = (
-                            str(submission.id),
-                            settings[0],
-                            float(submission.created),
-                            str(submission.title),
-                            str(submission.url),
-                            int(submission.num_comments),
-                            int(submission.score)
-                        )
-                        cur.execute(
-                            'INSERT INTO Submissions(id, subreddit, timestamp, title, url, comments, score) VALUES(%s, %s, %s, %s, %s, %s, %s)',
-                            submissionValues)
-                        return
-                    except Exception as e:
-                        self.logger.error('Error processing {0} - {1}'.format(submission.fullname, e))
+                    mediaRows.extend(mediaGroup)
+                    submissionProcessed = True
                 except Exception as e:
-                    self.logger.warning('Failed to download {0} - {1}'.format(submission.fullname, e))
-
-            if os.path.isfile(temp_file):
-                os.remove(temp_file)
+                    self.logger.error('Error processing {0} - {1}'.format(submission.fullname, e))
 
             # Add submission to DB
             submissionDeleted = False
-            if submission.author == '[deleted]':
+            if submission.author is None:
                 submissionDeleted = True
 
             try:
@@ -278,7 +633,7 @@ class RepostSentinel:
 
             submissionValues = (
                 str(submission.id),
-                settings[0],
+                settings.subname,
                 float(submission.created),
                 str(submission.author),
                 str(submission.title),
@@ -291,197 +646,348 @@ class RepostSentinel:
                 False,
                 submissionProcessed
             )
-
-            try:
-                cur.execute(
-                    'INSERT INTO Submissions(id, subreddit, timestamp, author, title, url, comments, score, deleted, removed, removal_reason, blacklist, processed) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                    submissionValues)
-            except:
-                self.logger.error('Error adding {0}'.format(submission.id))
+            return mediaRows, submissionValues
         except Exception as e:
             self.logger.error('Failed to ingest {0} - {1}'.format(submission.id, e))
-
-    def enforceSubmission(self, r, submission, settings, mediaData):
+            return None
+
+    # Insert records from buildRecord in one transaction, then add their
+    # hashes to the index once they're committed
+    def writeRecords(self, records):
+        mediaRows = [mediaData for recordMedia, _ in records for mediaData in recordMedia]
+        submissionRows = [submissionValues for _, submissionValues in records]
+
+        def work(cur):
+            if len(records) == 1:
+                for mediaData in mediaRows:
+                    self.db.executeOn(cur, 'insert_media', signedMedia(mediaData))
+                self.db.executeOn(cur, 'insert_submission', submissionRows[0])
+                return
+            if mediaRows:
+                self.db.executeValues(
+                    cur, MEDIA_INSERT + ' %s',
+                    [signedMedia(mediaData) for mediaData in mediaRows])
+            self.db.executeValues(cur, SUBMISSION_INSERT + ' %s', submissionRows)
+
+        self.db.run(work, 'write_records')
+
+        for mediaData in mediaRows:
+            self.hashIndex.add(mediaData[2], mediaData[0], mediaData[1], mediaData[4] > 1)
+        for submissionValues in submissionRows:
+            SUBMISSIONS.inc(subreddit=submissionValues[1], outcome='indexed')
+
+    # Up to 10 (distance, parent id) matches for a post's images (MediaInfo),
+    # each parent at the distance of its closest image
+    def imageMatches(self, settings, imageInfos, radius):
+        closest = {}
+        with MATCH_SECONDS.time(matcher=self.hashIndex.matcher):
+            for mediaInfo in imageInfos:
+                for parentId, distance in self.imageCandidates(settings, mediaInfo, radius).items():
+                    if parentId not in closest or distance < closest[parentId]:
+                        closest[parentId] = distance
+        return sorted((distance, parentId) for parentId, distance in closest.items())[:10]
+
+    # {parent id: distance} for one image in two stages. The dHash index
+    # shortlists parents within PREFILTER_RADIUS of the image, or within
+    # radius of one of its flips since a mirrored copy is as close to the
+    # flipped hash as an exact copy is to the original. The stored pHashes
+    # of just those parents are then compared with the image's pHash and its
+    # flips. A parent's distance is the smaller of its dHash and pHash
+    # distance, so dHash matches are kept as they were and flipped or
+    # cropped copies are caught by the pHash. Parents indexed before pHashes
+    # were stored have none, for them the flipped dHash distance counts.
+    def imageCandidates(self, settings, mediaInfo, radius):
+        if radius < 0:
+            return {}
+        prefilter = max(radius, self.config.get('PREFILTER_RADIUS', 10))
+
+        matches = {}
+        shortlist = set()
+        for distance, parentId in self.hashIndex.search(settings.subname, mediaInfo.hash, prefilter,
+                                                        limit=PREFILTER_LIMIT):
+            shortlist.add(parentId)
+            if distance <= radius and distance < matches.get(parentId, HASH_BITS + 1):
+                matches[parentId] = distance
+        flipped = {}
+        for flipHash, _ in mediaInfo.flips:
+            for distance, parentId in self.hashIndex.search(settings.subname, flipHash, radius,
+                                                            limit=PREFILTER_LIMIT):
+                shortlist.add(parentId)
+                flipped[parentId] = min(distance, flipped.get(parentId, HASH_BITS + 1))
+
+        if not shortlist:
+            return matches
+        hashed = set()
+        if mediaInfo.phash is not None:
+            pHashes = [mediaInfo.phash] + [flipHash for _, flipHash in mediaInfo.flips]
+            for parentId, parentHash in self.db.fetchall('select_phashes', (list(shortlist), settings.subname)):
+                hashed.add(parentId)
+                distance = min(hammingDistance(toUnsigned(parentHash), pHash) for pHash in pHashes)
+                if distance <= radius and distance < matches.get(parentId, HASH_BITS + 1):
+                    matches[parentId] = distance
+        for parentId, distance in flipped.items():
+            if parentId not in hashed and distance < matches.get(parentId, HASH_BITS + 1):
+                matches[parentId] = distance
+        return matches
+
+    # Up to 10 (distance, parent id) matches for a post's animations, given
+    # as lists of sampled frame hashes. A parent matches an animation when at
+    # least FRAME_MATCH_RATIO of its frames have a frame of the parent within
+    # radius, at the mean distance over those frames, and the post at the
+    # distance of its closest animation.
+    def frameMatches(self, settings, animations, radius):
+        closestMatches = {}
+        with MATCH_SECONDS.time(matcher=self.hashIndex.matcher):
+            for frameHashes in animations:
+                frameDistances = {}
+                for frameHash in frameHashes:
+                    closest = {}
+                    for distance, parentId in self.hashIndex.search(settings.subname, frameHash, radius, limit=100,
+                                                                    animated=True):
+                        closest.setdefault(parentId, distance)
+                    for parentId, distance in closest.items():
+                        frameDistances.setdefault(parentId, []).append(distance)
+
+                required = max(1, math.ceil(len(frameHashes) * self.config.get('FRAME_MATCH_RATIO', 0.5)))
+                for parentId, distances in frameDistances.items():
+                    distance = int(round(sum(distances) / len(distances)))
+                    if len(distances) >= required and distance < closestMatches.get(parentId, HASH_BITS + 1):
+                        closestMatches[parentId] = distance
+        return sorted((distance, parentId) for parentId, distance in closestMatches.items())[:10]
+
+    # mediaData is the first Media row of the post, mediaHashes every hash of
+    # it: the MediaInfo of each gallery image or the sampled frame hashes of
+    # each animation
+    def enforceSubmission(self, r, submission, settings, mediaData, mediaHashes):
 
         try:
             if submission.removed or submission.banned_by:
                 return
 
-            cur = self.db_connection.cursor()
-
             # Check if it's the generic 'deleted image' from imgur
-            if mediaData[0] == '9925021303884596990':
-                submission.report('Image removed from imgur.')
+            if mediaData[0] == 9925021303884596990:
+                self.enforce(r, 'report of {0}'.format(submission.fullname),
+                             lambda r: r.submission(id=submission.id).report('Image removed from imgur.'))
                 return
 
-            # Handle single images
-            if mediaData[4] == 1:
+            # Wide enough to find blacklisted parents whatever the thresholds
+            radius = max(settings.matchRadius, BLACKLIST_DISTANCE)
 
-                cur.execute('SELECT * FROM Media WHERE frame_count=1 AND subreddit=\'{0}\''.format(settings[0]))
-                mediaHashes = cur.fetchall()
-
-                matchInfoTemplate = '**OP:** {0}\n\n**Image Stats:**\n\n* Width: {1}\n\n* Height: {2}\n\n* Pixels: {3}\n\n* Size: {4}\n\n**History:**\n\nUser | Date | Match % | Image | Title | Karma | Comments | Status\n:---|:---|:---|:---|:---|:---|:---|:---\n{5}'
-                matchRowTemplate = '/u/{0} | {1} | {2}% | [{3} x {4}]({5}) | [{6}](https://redd.it/{7}) | {8} | {9} | {10}\n'
-                matchCount = 0
-                matchCountActive = 0
-                matchRows = ''
-                reportSubmission = False
-                removeSubmission = False
-                blacklisted = False
-                sameAuthor = False
-
-                # Find matches
-                for mediaHash in mediaHashes:
-                    if matchCount > 9:
-                        break
+            # Handle single images and galleries
+            if mediaData[4] == 1:
+                mediaMatches = self.imageMatches(settings, mediaHashes, radius)
 
-                    mediaSimilarity = int(
-                        ((64 - bin(mediaData[0] ^ int(mediaHash[0])).count('1')) * 100.0)
-                        / 64.0
+            # Animations match a parent when enough of their frames do
+            else:
+                mediaMatches = self.frameMatches(settings, mediaHashes, radius)
+
+            matchInfoTemplate = '**OP:** {0}\n\n**Image Stats:**\n\n* Width: {1}\n\n* Height: {2}\n\n* Pixels: {3}\n\n* Size: {4}\n\n**History:**\n\nUser | Date | Match % | Image | Title | Karma | Comments | Status\n:---|:---|:---|:---|:---|:---|:---|:---\n{5}'
+            matchRowTemplate = '/u/{0} | {1} | {2}% | [{3} x {4}]({5}) | [{6}](https://redd.it/{7}) | {8} | {9} | {10}\n'
+            matchCount = 0
+            matchCountActive = 0
+            matchRows = ''
+            reportSubmission = False
+            removeSubmission = False
+            blacklisted = False
+            sameAuthor = False
+
+            # Parent rows and their current reddit state for every match
+            # above the report threshold or close enough to be blacklisted,
+            # in one query and one API call
+            reportIds = [
+                parentId for distance, parentId in mediaMatches
+                if distanceToSimilarity(distance) > settings.reportThreshold or distance <= BLACKLIST_DISTANCE
+            ]
+            mediaParents = {}
+            parentStates = {}
+            if reportIds:
+                mediaParents = {row[0]: row for row in self.db.fetchall('select_submissions', (reportIds,))}
+                parentStates = self.parentCache.get(r, list(mediaParents))
+                self.updateParentStatus(mediaParents, parentStates)
+
+            # Find matches
+            for distance, parentId in mediaMatches:
+                mediaSimilarity = distanceToSimilarity(distance)
+
+                mediaParent = mediaParents.get(parentId)
+                parentBlacklist = mediaParent is not None and mediaParent[11]
+
+                # Report threshold
+                if mediaSimilarity > settings.reportThreshold:
+
+                    parentState = parentStates.get(parentId)
+                    if mediaParent is None or parentState is None:
+                        continue
+
+                    currentScore, currentComments, currentStatus = parentState
+
+                    matchRows = matchRows + matchRowTemplate.format(
+                        mediaParent[3],
+                        self.convertDateFormat(mediaParent[2]),
+                        str(mediaSimilarity),
+                        str(mediaData[5]),
+                        str(mediaData[6]),
+                        mediaParent[5],
+                        mediaParent[4],
+                        mediaParent[0],
+                        currentScore,
+                        currentComments,
+                        currentStatus
                     )
 
-                    parentBlacklist = False
-
-                    # Report threshold
-                    if mediaSimilarity > settings[6]:
-
-                        cur.execute('SELECT * FROM Submissions WHERE id=\'{0}\''.format(mediaHash[1]))
-                        mediaParent = cur.fetchone()
-                        parentBlacklist = mediaParent[11]
-
-                        originalSubmission = r.submission(id=mediaParent[0])
-
-                        currentScore = int(originalSubmission.score)
-                        currentComments = int(originalSubmission.num_comments)
-                        currentStatus = 'Active'
-                        if originalSubmission.removed or originalSubmission.banned_by:
-                            currentStatus = 'Removed'
-                        elif originalSubmission.author == '[deleted]':
-                            currentStatus = 'Deleted'
-
-                        matchRows = matchRows + matchRowTemplate.format(
-                            mediaParent[3],
-                            self.convertDateFormat(mediaParent[2]),
-                            str(mediaSimilarity),
-                            str(mediaData[5]),
-                            str(mediaData[6]),
-                            mediaParent[5],
-                            mediaParent[4],
-                            mediaParent[0],
-                            currentScore,
-                            currentComments,
-                            currentStatus
-                        )
-
-                        matchCount = matchCount + 1
-
-                        if currentStatus == 'Active':
-                            matchCountActive = matchCountActive + 1
-
-                        reportSubmission = True
-
-                        if mediaParent[3] == submission.author:
-                            sameAuthor = True
-
-                    # Remove threshold
-                    if mediaSimilarity > settings[8]:
-                        removeSubmission = True
-
-                        # TODO: Add comment count and karma as thresholds
-
-                    # Blacklist
-                    if mediaSimilarity == 100 and parentBlacklist:
-                        blacklisted = True
-
-                # Only report if the submission author is different
-                if reportSubmission and sameAuthor is False:
-
-                    submission.report(
-                        'Possible repost: {0} similar - {1} active'.format(
-                            matchCount, matchCountActive)
-                    )
-                    replyInfo = submission.reply(
-                        matchInfoTemplate.format(
-                            submission.author,
-                            mediaData[5],
-                            mediaData[6],
-                            mediaData[7],
-                            mediaData[8],
-                            matchRows)
-                    )
-                    try:
-                        # TODO second line should be dropped?
-                        replyInfo.mod.remove()
-                        praw.models.reddit.comment.CommentModeration(replyInfo).remove(spam=False)
-                    except prawcore.exceptions.Forbidden:
-                        self.logger.warn('Bot missing perms to enforce submission: {}'.format(replyInfo.fullname))
-
-                if blacklisted:
-                    submission.mod.remove(spam=False)
-                    replyRemove = submission.reply(settings[9])
-                    replyRemove.distinguish(how='yes', sticky=True)
-
-                if removeSubmission:
-                    submission.mod.remove(spam=False)
-                    replyRemove = submission.reply(settings[9])
-                    replyRemove.distinguish(how='yes', sticky=True)
-
-
-        except (prawcore.exceptions.ResponseException,
-                prawcore.exceptions.RequestException,
-                prawcore.exceptions.ServerError,
-                urllib3.exceptions.TimeoutError,
-                requests.exceptions.Timeout):
-            self.logger.warn('HTTP Requests Error. Likely on reddits end due to site issues.')
-            time.sleep(300)
-
-        except prawcore.exceptions.InvalidToken:
-            self.logger.warn('API Token Error. Likely on reddits end. Issue self-resolves.')
-            time.sleep(180)
-
-        except prawcore.exceptions.BadJSON:
-            self.logger.warn('PRAW didn\'t get good JSON, probably reddit sending bad data due to site issues.')
-            time.sleep(180)
-
-        except praw.exceptions.APIException:
-            self.logger.error('PRAW/Reddit API Error')
-            time.sleep(30)
-
-        except praw.exceptions.ClientException:
-            self.logger.error('PRAW Client Error')
-            time.sleep(30)
+                    matchCount = matchCount + 1
+
+                    if currentStatus == 'Active':
+                        matchCountActive = matchCountActive + 1
+
+                    reportSubmission = True
+
+                    if mediaParent[3] == submission.author:
+                        sameAuthor = True
+
+                # Remove threshold
+                if mediaSimilarity > settings.removeThreshold:
+                    removeSubmission = True
+
+                    # TODO: Add comment count and karma as thresholds
+
+                # Blacklist
+                if distance <= BLACKLIST_DISTANCE and parentBlacklist:
+                    blacklisted = True
+
+            # Reddit actions go through the enforcement queue, retried there
+            # with backoff when reddit fails instead of stalling ingest
+
+            # Only report if the submission author is different
+            if reportSubmission and sameAuthor is False:
+                self.enforce(r, 'report of {0}'.format(submission.fullname), lambda r: self.reportSubmission(
+                    r, submission.id, settings.subname,
+                    'Possible repost: {0} similar - {1} active'.format(matchCount, matchCountActive)))
+                matchInfo = matchInfoTemplate.format(
+                    submission.author,
+                    mediaData[5],
+                    mediaData[6],
+                    mediaData[7],
+                    mediaData[8],
+                    matchRows)
+                self.enforce(r, 'match info reply to {0}'.format(submission.fullname),
+                             lambda r: self.replyMatchInfo(r, submission.id, matchInfo))
+
+            if blacklisted:
+                self.enforce(r, 'removal of {0}'.format(submission.fullname),
+                             lambda r: self.removeSubmission(r, submission.id, settings.subname))
+                self.enforce(r, 'removal reply to {0}'.format(submission.fullname),
+                             lambda r: self.replyRemoval(r, submission.id, settings.removeMessage))
+
+            if removeSubmission:
+                self.enforce(r, 'removal of {0}'.format(submission.fullname),
+                             lambda r: self.removeSubmission(r, submission.id, settings.subname))
+                self.enforce(r, 'removal reply to {0}'.format(submission.fullname),
+                             lambda r: self.replyRemoval(r, submission.id, settings.removeMessage))
+
+        except REDDIT_EXCEPTIONS as e:
+            self.logger.warning('{0} - unable to check {1} for reposts - {2}'.format(
+                describeError(e), submission.fullname, e))
+
+    # Run action(r) on the runtime's enforcement task, or right away with
+    # the given praw instance when there's no runtime
+    def enforce(self, r, description, action):
+        if self.runtime is None:
+            action(r)
+            return
+        self.runtime.submit(description, action)
+
+    def reportSubmission(self, r, submissionId, subname, reason):
+        r.submission(id=submissionId).report(reason)
+        SUBMISSIONS.inc(subreddit=subname, outcome='reported')
+
+    # Record parents reddit now shows as deleted or removed, so maintenance
+    # archives the media of deleted posts
+    def updateParentStatus(self, mediaParents, parentStates):
+        changed = []
+        for parentId, state in parentStates.items():
+            mediaParent = mediaParents.get(parentId)
+            deleted = state.status == 'Deleted'
+            removed = state.status == 'Removed'
+            if mediaParent is not None and (bool(mediaParent[8]) != deleted or bool(mediaParent[9]) != removed):
+                changed.append((parentId, deleted, removed))
+        if not changed:
+            return
+        try:
+            self.db.run(lambda cur: self.db.executeValues(
+                cur,
+                'UPDATE Submissions s SET deleted=v.deleted, removed=v.removed '
+                'FROM (VALUES %s) AS v(id, deleted, removed) WHERE s.id = v.id',
+                changed))
+        except Exception as e:
+            self.logger.error('Unable to update status of {0} parents - {1}'.format(len(changed), e))
 
-        except KeyboardInterrupt as e:
-            self.logger.warn('Caught KeyboardInterrupt - Exiting')
-            sys.exit()
+    # Leave the match details as a removed comment, visible to mods only
+    def replyMatchInfo(self, r, submissionId, matchInfo):
+        replyInfo = r.submission(id=submissionId).reply(matchInfo)
+        try:
+            replyInfo.mod.remove()
+        except prawcore.exceptions.Forbidden:
+            self.logger.warning('Bot missing perms to enforce submission: {}'.format(replyInfo.fullname))
+
+    def removeSubmission(self, r, submissionId, subname):
+        r.submission(id=submissionId).mod.remove(spam=False)
+        SUBMISSIONS.inc(subreddit=subname, outcome='removed')
+
+    def replyRemoval(self, r, submissionId, message):
+        replyRemove = r.submission(id=submissionId).reply(message)
+        replyRemove.distinguish(how='yes', sticky=True)
+
+    # Take the latest settings and, when sharded, the subreddits this worker handles.
+    # The shard only changes here, before tasks are rescheduled for it.
+    def refreshSettings(self):
+        self.loadSubredditSettings()
+        if self.leases is not None:
+            self.shard = self.leases.subreddits()
+            self.hashIndex.assign(self.db, self.shard)
+
+    # Get settings of all subreddits, kept current by the settings cache
+    def loadSubredditSettings(self):
+        self.subredditSettings = self.settingsCache.all()
 
+    # Whether this worker currently holds the subreddit, always when it isn't
+    # one of several workers
+    def ownsSubreddit(self, subname):
+        return self.leases is None or self.leases.ownsSubreddit(subname)
 
-    # Get settings of all subreddits from DB
-    def loadSubredditSettings(self):
-        cur = self.db_connection.cursor()
-        cur.execute('SELECT * FROM SubredditSettings')
-        self.subredditSettings = cur.fetchall()
-        self.logger.info("Loaded subreddit settings table")
+    # Settings of the subreddits this worker handles, all of them unless
+    # running as one of several workers
+    def shardSettings(self):
+        if self.shard is None:
+            return self.subredditSettings
+        return [settings for settings in self.subredditSettings if settings.subname in self.shard]
 
     # Check messages for blacklist requests
     def checkMail(self, r):
+        # The mail lease can move between schedule() runs
+        if self.leases is not None and not self.leases.ownsMail():
+            return
         try:
             self.logger.info("Getting Mail")
             for msg in r.inbox.unread(limit=None):
                 if not isinstance(msg, praw.models.Message):
                     msg.mark_read()
+                    MAIL_MESSAGES.inc(action='ignored')
                     continue
 
                 if msg.subject.strip().lower().startswith("moderator message from"):
                     msg.mark_read()
+                    MAIL_MESSAGES.inc(action='ignored')
                     continue
 
                 if "You have been removed as a moderator from " in msg.body:
                     self.removeModStatus(msg)
+                    MAIL_MESSAGES.inc(action='mod_removed')
                     continue
 
                 if msg.subject == 'blacklist':
                     msg.mark_read()
+                    MAIL_MESSAGES.inc(action='blacklist')
                     submissionId = ''
                     if len(msg.body) == 6:
                         submissionId = msg.body
@@ -493,13 +999,10 @@ class RepostSentinel:
                     if len(submissionId) == 6:
                         blacklistSubmission = r.submission(id=submissionId)
                         for settings in self.subredditSettings:
-                            if settings[0] == blacklistSubmission.subreddit:
-                                for moderator in r.subreddit(settings[0]).moderator():
+                            if settings.subname == blacklistSubmission.subreddit:
+                                for moderator in r.subreddit(settings.subname).moderator():
                                     if msg.author == moderator:
-                                        self.indexSubmission(r, blacklistSubmission, settings, False)
-                                        cur = self.db_connection.cursor()
-                                        cur.execute('UPDATE Submissions SET blacklist=TRUE WHERE id=\'{0}\''.format(
-                                            submissionId))
+                                        self.blacklistSubmission(r, blacklistSubmission, settings)
                     else:
                         msg.mark_read()
                     continue
@@ -510,25 +1013,27 @@ class RepostSentinel:
 
     def acceptModInvite(self, message):
         try:
-            cur = self.db_connection.cursor()
             message.mark_read()
             message.subreddit.mod.accept_invite()
 
-            cur.execute(
-                "SELECT * FROM subredditsettings WHERE subname=%s",
-                (str(message.subreddit),),
-            )
-            results = cur.fetchall()
-            if results:
-                cur.execute(
-                    "UPDATE subredditsettings SET enabled=True WHERE subname=%s",
-                    (str(message.subreddit),),
-                )
-            else:
+            def work(cur):
                 cur.execute(
-                    "INSERT INTO subredditsettings (subname) VALUES(%s)",
+                    "SELECT * FROM subredditsettings WHERE subname=%s",
                     (str(message.subreddit),),
                 )
+                results = cur.fetchall()
+                if results:
+                    cur.execute(
+                        "UPDATE subredditsettings SET enabled=True WHERE subname=%s",
+                        (str(message.subreddit),),
+                    )
+                else:
+                    cur.execute(
+                        "INSERT INTO subredditsettings (subname) VALUES(%s)",
+                        (str(message.subreddit),),
+                    )
+
+            self.db.run(work, 'accept_mod_invite')
             self.logger.info("Accepted mod invite for /r/{}".format(message.subreddit))
         except Exception as e:
             self.logger.error(
@@ -539,9 +1044,8 @@ class RepostSentinel:
 
     def removeModStatus(self, message):
         try:
-            cur = self.db_connection.cursor()
             message.mark_read()
-            cur.execute(
+            self.db.execute(
                 "UPDATE subredditsettings SET enabled=False WHERE subname=%s",
                 (str(message.subreddit),),
             )
@@ -553,37 +1057,43 @@ class RepostSentinel:
                 )
             )
 
-    # Hashing function
-    def DifferenceHash(self, theImage):
-
-        theImage = theImage.convert("L")
-        theImage = theImage.resize((8, 8), Image.ANTIALIAS)
-        previousPixel = theImage.getpixel((0, 7))
-        differenceHash = 0
-
-        for row in range(0, 8, 2):
-
-            for col in range(8):
-                differenceHash <<= 1
-                pixel = theImage.getpixel((col, row))
-                differenceHash |= 1 * (pixel >= previousPixel)
-                previousPixel = pixel
-
-            row += 1
-
-            for col in range(7, -1, -1):
-                differenceHash <<= 1
-                pixel = theImage.getpixel((col, row))
-                differenceHash |= 1 * (pixel >= previousPixel)
-                previousPixel = pixel
-
-        return differenceHash
-
     @staticmethod
     def convertDateFormat(timestamp):
 
         return str(time.strftime('%B %d, %Y - %H:%M:%S', time.localtime(timestamp)))
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detects reposted images on reddit')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='run the bot, the default')
+    cluster = commands.add_parser(
+        'cluster', help="group subreddits' indexed images into clusters of near duplicates, most posted first")
+    cluster.add_argument('subreddits', nargs='+', metavar='subreddit', help='clustered together, so across subreddits')
+    distance = cluster.add_mutually_exclusive_group()
+    distance.add_argument('--threshold', type=int, default=90,
+                          help='similarity over which images are duplicates, as in report_match_threshold')
+    distance.add_argument('--radius', type=int, help='most differing hash bits between duplicates instead')
+    cluster.add_argument('--format', default='csv', choices=['csv', 'json'],
+                         help='a CSV row per image or a JSON line per cluster')
+    cluster.add_argument('--output', default='-', help='file to write, - for stdout')
+    cluster.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes searching for pairs')
+    cluster.add_argument('--min-posts', type=int, default=2, help='smallest cluster written, in posts')
+    cluster.add_argument('--top', type=int, help='only write this many of the biggest clusters')
+    args = parser.parse_args(argv)
+
+    if args.command == 'cluster':
+        radius = args.radius if args.radius is not None else similarityToRadius(args.threshold)
+        output = stdout if args.output == '-' else open(args.output, 'w', newline='')
+        try:
+            RepostSentinel().cluster(args.subreddits, radius, output, args.format, args.workers, args.min_posts,
+                                     args.top)
+        finally:
+            if output is not stdout:
+                output.close()
+    else:
+        RepostSentinel().start()
+
+
 if __name__ == '__main__':
-    RepostSentinel().start()
+    main()
@@ -0,0 +1,263 @@
+import datetime
+import re
+import time
+
+from psycopg2 import sql
+
+# Partitioned tables, each subreddit gets a '<table>_<subname>' partition
+# split into '<table>_<subname>_pYYYYMM' periods
+MEDIA = 'media'
+ARCHIVE = 'mediaarchive'
+
+PERIOD_SUFFIX = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+# Months since year 0 of the start of the period a timestamp falls in
+def periodIndex(timestamp, months):
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return (date.year * 12 + date.month - 1) // months * months
+
+
+def monthStart(index):
+    return datetime.datetime(index // 12, index % 12 + 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+
+class Retention:
+    # Maintenance of Media, run per subreddit on a runtime task. Keeps
+    # Media partitioned by subreddit and by periods of the submissions'
+    # creation time, archives or drops the periods that fell out of the
+    # subreddit's retention window along with the expired rows of the
+    # period the window starts in, and moves rows that can't be a useful
+    # repost parent out of Media: every exact duplicate of an image but the
+    # oldest, whose ref_count counts them, and media of deleted posts.
+    # Media of blacklisted posts is never moved, rows of theirs older than
+    # the window stay in the subreddit's default partition.
+    # Archived rows go to MediaArchive, partitioned the same way and
+    # optionally on a cheaper tablespace. Whole periods are moved between
+    # the two by detaching and attaching them, not by copying rows.
+
+    def __init__(self, db, logger, months=12, archive=True, tablespace=None):
+        self.db = db
+        self.logger = logger
+        self.months = months
+        self.archive = archive
+        self.tablespace = tablespace
+
+    # Maintain every subreddit, returns the subnames whose live Media changed
+    def run(self, subredditSettings):
+        changed = []
+        for settings in subredditSettings:
+            try:
+                if self.db.run(lambda cur: self.maintain(cur, settings), 'media_maintenance'):
+                    changed.append(settings.subname)
+            except Exception as e:
+                self.logger.error('Media maintenance of r/{0} failed - {1}'.format(settings.subname, e))
+        return changed
+
+    # One subreddit in one transaction, skipped while another worker has it
+    def maintain(self, cur, settings):
+        cur.execute('SELECT pg_try_advisory_xact_lock(hashtext(%s))', ('media_maintenance:' + settings.subname,))
+        if not cur.fetchone()[0]:
+            return False
+
+        cutoff = None
+        if settings.retentionDays is not None:
+            cutoff = time.time() - settings.retentionDays * 86400
+
+        media = self.partitionSubreddit(cur, MEDIA, settings.subname)
+        self.createPeriods(cur, media, cutoff)
+        expired = self.expirePeriods(cur, media, settings.subname, cutoff)
+        trimmed = self.expireRows(cur, settings.subname, cutoff)
+        moved = self.compact(cur, settings.subname)
+        return bool(expired or trimmed or moved)
+
+    @staticmethod
+    def exists(cur, table):
+        cur.execute('SELECT to_regclass(%s) IS NOT NULL', (table,))
+        return cur.fetchone()[0]
+
+    # The subreddit's partition of parent, created the first time with its
+    # rows moved over from the default partition
+    def partitionSubreddit(self, cur, parent, subname):
+        table = '{0}_{1}'.format(parent, subname.lower())
+        if self.exists(cur, table):
+            return table
+
+        default = parent + '_default'
+        # Nothing else may add rows for the subreddit to the default
+        # partition until the new one is attached
+        cur.execute(sql.SQL('LOCK TABLE {0} IN SHARE ROW EXCLUSIVE MODE').format(sql.Identifier(default)))
+        cur.execute(sql.SQL('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE (created)').format(
+            sql.Identifier(table), sql.Identifier(parent)))
+        cur.execute(sql.SQL('CREATE TABLE {0} PARTITION OF {1} DEFAULT{2}').format(
+            sql.Identifier(table + '_default'), sql.Identifier(table), self.tablespaceClause(parent)))
+        cur.execute(sql.SQL(
+            'WITH moved AS (DELETE FROM {0} WHERE subreddit=%s RETURNING *) INSERT INTO {1} SELECT * FROM moved'
+        ).format(sql.Identifier(default), sql.Identifier(table)), (subname,))
+        moved = cur.rowcount
+        cur.execute(sql.SQL('ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES IN (%s)').format(
+            sql.Identifier(parent), sql.Identifier(table)), (subname,))
+        self.logger.info('Partitioned {0} for r/{1}, moved {2} rows'.format(parent, subname, moved))
+        return table
+
+    def tablespaceClause(self, table):
+        if table.startswith(ARCHIVE) and self.tablespace:
+            return sql.SQL(' TABLESPACE {0}').format(sql.Identifier(self.tablespace))
+        return sql.SQL('')
+
+    # {partition name: (start, end)} of the periods of a subreddit's table
+    def periods(self, cur, table):
+        cur.execute(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass',
+            (table,))
+        periods = {}
+        for name, in cur.fetchall():
+            match = PERIOD_SUFFIX.search(name)
+            if match and name.startswith(table):
+                index = int(match.group(1)) * 12 + int(match.group(2)) - 1
+                periods[name] = (monthStart(index), monthStart(index + self.months))
+        return periods
+
+    def periodName(self, table, index):
+        return '{0}_p{1:04d}{2:02d}'.format(table, index // 12, index % 12 + 1)
+
+    # Create the periods holding rows in the default partition, the current
+    # period and the next, so new rows always have a period waiting. Periods
+    # that ended before cutoff aren't created, their rows are expired or
+    # kept in the default partition.
+    def createPeriods(self, cur, table, cutoff=None):
+        cur.execute(sql.SQL(
+            'SELECT DISTINCT (EXTRACT(YEAR FROM t) * 12 + EXTRACT(MONTH FROM t) - 1)::INTEGER / %s * %s '
+            "FROM (SELECT to_timestamp(created) AT TIME ZONE 'UTC' AS t FROM {0}) timestamps"
+        ).format(sql.Identifier(table + '_default')), (self.months, self.months))
+        current = periodIndex(time.time(), self.months)
+        wanted = {index for index, in cur.fetchall()} | {current, current + self.months}
+        if cutoff is not None:
+            wanted = {index for index in wanted if monthStart(index + self.months) > cutoff}
+
+        for index in sorted(wanted):
+            name = self.periodName(table, index)
+            if self.exists(cur, name):
+                continue
+            cur.execute(sql.SQL('CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS){2}').format(
+                sql.Identifier(name), sql.Identifier(table), self.tablespaceClause(table)))
+            self.attachPeriod(cur, table, name, monthStart(index), monthStart(index + self.months))
+
+    # Attach a period partition, first moving any of its rows out of the
+    # table's default partition
+    def attachPeriod(self, cur, table, partition, start, end):
+        cur.execute(sql.SQL(
+            'WITH moved AS (DELETE FROM {0} WHERE created >= %s AND created < %s RETURNING *) '
+            'INSERT INTO {1} SELECT * FROM moved'
+        ).format(sql.Identifier(table + '_default'), sql.Identifier(partition)), (start, end))
+        cur.execute(sql.SQL('ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM (%s) TO (%s)').format(
+            sql.Identifier(table), sql.Identifier(partition)), (start, end))
+
+    # Archive or drop the periods entirely older than cutoff
+    def expirePeriods(self, cur, media, subname, cutoff):
+        if cutoff is None:
+            return []
+        periods = self.periods(cur, media)
+        expired = sorted(name for name, (start, end) in periods.items() if end <= cutoff)
+        if not expired:
+            return []
+
+        archive = self.partitionSubreddit(cur, ARCHIVE, subname) if self.archive else None
+        archivePeriods = self.periods(cur, archive) if archive else {}
+        for name in expired:
+            start, end = periods[name]
+            cur.execute(sql.SQL('ALTER TABLE {0} DETACH PARTITION {1}').format(
+                sql.Identifier(media), sql.Identifier(name)))
+            # Blacklisted media goes back to Media, into the default partition
+            cur.execute(sql.SQL(
+                'WITH kept AS (DELETE FROM {0} m USING Submissions s WHERE s.id = m.submission_id '
+                'AND s.blacklist RETURNING m.*) INSERT INTO Media SELECT * FROM kept'
+            ).format(sql.Identifier(name)))
+            if archive is None:
+                cur.execute(sql.SQL('DROP TABLE {0}').format(sql.Identifier(name)))
+                continue
+
+            target = archive + name[len(media):]
+            if target in archivePeriods:
+                # Compacted rows already started this period of the archive
+                cur.execute(sql.SQL('INSERT INTO {0} SELECT * FROM {1}').format(
+                    sql.Identifier(target), sql.Identifier(name)))
+                cur.execute(sql.SQL('DROP TABLE {0}').format(sql.Identifier(name)))
+                continue
+            cur.execute(sql.SQL('ALTER TABLE {0} RENAME TO {1}').format(sql.Identifier(name), sql.Identifier(target)))
+            if self.tablespace:
+                cur.execute(sql.SQL('ALTER TABLE {0} SET TABLESPACE {1}').format(
+                    sql.Identifier(target), sql.Identifier(self.tablespace)))
+            self.attachPeriod(cur, archive, target, start, end)
+
+        self.logger.info('{0} {1} expired periods of r/{2}: {3}'.format(
+            'Archived' if archive else 'Dropped', len(expired), subname, ', '.join(expired)))
+        return expired
+
+    # Rows older than cutoff left in the oldest live period, which also
+    # holds rows still inside the window, and in the default partition are
+    # moved row by row. Returns the number of rows moved.
+    def expireRows(self, cur, subname, cutoff):
+        if cutoff is None:
+            return 0
+        cur.execute(sql.SQL(
+            'WITH moved AS ('
+            'DELETE FROM Media m WHERE subreddit=%s AND created < %s AND NOT EXISTS ('
+            'SELECT 1 FROM Submissions s WHERE s.id = m.submission_id AND s.blacklist) RETURNING *'
+            '){0} SELECT count(*) FROM moved'
+        ).format(self.archiveClause(cur, subname)), (subname, cutoff))
+        moved = cur.fetchone()[0]
+        if moved:
+            self.logger.info('{0} {1} expired rows of r/{2}'.format(
+                'Archived' if self.archive else 'Dropped', moved, subname))
+        return moved
+
+    # CTE copying the rows of a 'moved' CTE to MediaArchive, empty when
+    # moved rows are dropped
+    def archiveClause(self, cur, subname):
+        if not self.archive:
+            return sql.SQL('')
+        self.partitionSubreddit(cur, ARCHIVE, subname)
+        return sql.SQL(', archived AS (INSERT INTO MediaArchive SELECT * FROM moved)')
+
+    # Move exact duplicate images and media of deleted posts out of Media,
+    # returns the number of rows moved
+    def compact(self, cur, subname):
+        archived = self.archiveClause(cur, subname)
+
+        # The oldest row of each hash is kept and counts the others, rows of
+        # blacklisted posts stay for the exact match check of enforcement
+        cur.execute(sql.SQL(
+            'WITH duplicates AS ('
+            'SELECT m.submission_id, m.frame_number, m.hash, m.created, COALESCE(s.blacklist, FALSE) AS blacklist, '
+            'row_number() OVER (PARTITION BY m.hash ORDER BY m.created, m.submission_id, m.frame_number) AS rank '
+            'FROM Media m LEFT JOIN Submissions s ON s.id = m.submission_id '
+            'WHERE m.subreddit=%(subname)s AND m.frame_count=1 AND m.hash IN ('
+            'SELECT hash FROM Media WHERE subreddit=%(subname)s AND frame_count=1 GROUP BY hash HAVING count(*) > 1)'
+            '), moved AS ('
+            'DELETE FROM Media m USING duplicates d WHERE m.subreddit=%(subname)s AND d.rank > 1 AND NOT d.blacklist '
+            'AND m.submission_id=d.submission_id AND m.frame_number=d.frame_number AND m.hash=d.hash '
+            'AND m.created=d.created RETURNING m.*'
+            '){0}, counted AS ('
+            'UPDATE Media m SET ref_count = m.ref_count + c.refs '
+            'FROM (SELECT hash, sum(ref_count) AS refs FROM moved GROUP BY hash) c, duplicates d '
+            'WHERE m.subreddit=%(subname)s AND d.rank = 1 AND d.hash = c.hash '
+            'AND m.submission_id=d.submission_id AND m.frame_number=d.frame_number AND m.hash=d.hash '
+            'AND m.created=d.created'
+            ') SELECT count(*) FROM moved'
+        ).format(archived), {'subname': subname})
+        duplicates = cur.fetchone()[0]
+
+        cur.execute(sql.SQL(
+            'WITH moved AS ('
+            'DELETE FROM Media m USING Submissions s WHERE m.subreddit=%(subname)s AND s.id = m.submission_id '
+            'AND s.deleted AND s.blacklist IS NOT TRUE RETURNING m.*'
+            '){0} SELECT count(*) FROM moved'
+        ).format(archived), {'subname': subname})
+        deleted = cur.fetchone()[0]
+
+        if duplicates or deleted:
+            self.logger.info('Compacted r/{0}: {1} exact duplicates, {2} rows of deleted posts'.format(
+                subname, duplicates, deleted))
+        return duplicates + deleted
@@ -0,0 +1,251 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import praw
+import prawcore
+import requests
+import urllib3.exceptions
+
+from HashIndex import DEFAULT_MATCHER
+from Metrics import CYCLE_SECONDS
+
+# praw 7 renamed APIException, praw 8 dropped the old name
+RedditAPIException = getattr(praw.exceptions, 'RedditAPIException', None) or praw.exceptions.APIException
+
+# Message logged for each kind of reddit failure, most specific first
+REDDIT_ERRORS = (
+    (prawcore.exceptions.InvalidToken, 'API Token Error. Likely on reddits end. Issue self-resolves.'),
+    (prawcore.exceptions.BadJSON, 'PRAW didn\'t get good JSON, probably reddit sending bad data due to site issues.'),
+    ((prawcore.exceptions.ResponseException,
+      prawcore.exceptions.RequestException,
+      prawcore.exceptions.ServerError,
+      urllib3.exceptions.TimeoutError,
+      requests.exceptions.Timeout), 'HTTP Requests Error. Likely on reddits end due to site issues.'),
+    (RedditAPIException, 'PRAW/Reddit API Error'),
+    (praw.exceptions.ClientException, 'PRAW Client Error'),
+)
+REDDIT_EXCEPTIONS = tuple(itertools.chain.from_iterable(
+    types if isinstance(types, tuple) else (types,) for types, message in REDDIT_ERRORS))
+
+# Enforcement actions failing with these won't succeed on a retry
+PERMANENT_ERRORS = (
+    prawcore.exceptions.Forbidden,
+    prawcore.exceptions.NotFound,
+    RedditAPIException,
+    praw.exceptions.ClientException,
+)
+
+# Attempts at an enforcement action before it's dropped
+ENFORCE_ATTEMPTS = 5
+# Seconds between polls of the combined submission streams
+STREAM_INTERVAL = 5
+# Seconds between checks whether the hash index snapshot is due
+SNAPSHOT_CHECK_INTERVAL = 300
+
+
+def describeError(e):
+    for types, message in REDDIT_ERRORS:
+        if isinstance(e, types):
+            return message
+    return 'General Exception'
+
+
+class Backoff:
+    # Exponential delay with jitter, kept per task so one failing task
+    # backs off without holding up the others
+
+    def __init__(self, base=5, cap=300):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def reset(self):
+        self.failures = 0
+
+    def next(self):
+        self.failures += 1
+        delay = min(self.cap, self.base * 2 ** (self.failures - 1))
+        return random.uniform(delay / 2, delay)
+
+
+class RateLimiter:
+    # Spreads requests over what is left of reddit's quota window. Shared by
+    # every praw instance in the process since the quota is per account.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.resetAt = 0
+        self.nextRequest = 0
+
+    # Block until the next request is allowed
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.nextRequest)
+            interval = 0
+            if self.remaining is not None and start < self.resetAt:
+                if self.remaining < 1:
+                    start = self.resetAt
+                else:
+                    interval = (self.resetAt - start) / self.remaining
+                self.remaining -= 1
+            self.nextRequest = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+    # Take the quota from a response's X-Ratelimit headers
+    def update(self, headers):
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.remaining = float(remaining)
+            self.resetAt = time.time() + float(reset)
+
+
+class Runtime:
+    # Runs each subreddit's ingest, the stream reader, the mail checker,
+    # snapshot writes, Media maintenance and enforcement actions as
+    # independent asyncio tasks, each with its own backoff. praw and
+    # psycopg2 block, so task bodies run on a thread pool where every thread
+    # has its own praw instance.
+
+    def __init__(self, sentinel, workers=8, ingestInterval=30, mailInterval=60, settingsInterval=60,
+                 maintenanceInterval=86400):
+        self.sentinel = sentinel
+        self.logger = sentinel.logger
+        self.ingestInterval = ingestInterval
+        self.mailInterval = mailInterval
+        self.settingsInterval = settingsInterval
+        self.maintenanceInterval = maintenanceInterval
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='task')
+        # Streams hold on to the praw instance that opened them, so they're
+        # always read from the same thread
+        self.streamExecutor = ThreadPoolExecutor(1, thread_name_prefix='stream')
+        self.local = threading.local()
+        self.settings = {}
+        self.tasks = {}
+        self.loop = None
+        self.enforcements = None
+        self.settingsChanged = None
+
+    # praw isn't thread safe, every executor thread gets its own instance
+    def reddit(self):
+        r = getattr(self.local, 'reddit', None)
+        if r is None:
+            r = self.local.reddit = self.sentinel.connectReddit()
+        return r
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.enforcements = asyncio.Queue()
+        self.tasks['enforce'] = asyncio.ensure_future(self.enforce())
+
+        # Reschedule as soon as settings or this worker's leases change, and
+        # every settingsInterval regardless
+        self.settingsChanged = asyncio.Event()
+        for source in (self.sentinel.settingsCache, self.sentinel.leases):
+            if source is not None:
+                source.listeners.append(lambda: self.loop.call_soon_threadsafe(self.settingsChanged.set))
+
+        backoff = Backoff()
+        while True:
+            self.settingsChanged.clear()
+            try:
+                await self.loop.run_in_executor(self.executor, self.sentinel.refreshSettings)
+                self.schedule()
+                backoff.reset()
+                delay = self.settingsInterval
+            except Exception as e:
+                delay = backoff.next()
+                self.logger.error('{0} - loading settings failed, retrying in {1:.0f}s - {2}'.format(
+                    describeError(e), delay, e))
+            try:
+                await asyncio.wait_for(self.settingsChanged.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    # Start tasks for new subreddits and cancel those of removed ones
+    def schedule(self):
+        self.settings = {settings.subname: settings for settings in self.sentinel.shardSettings()}
+        streamMode = self.sentinel.config.get('STREAM_MODE', False)
+
+        wanted = {}
+        for subname, settings in self.settings.items():
+            if settings.imported is False:
+                self.sentinel.ingestFull(settings)
+            # NULL imported is neither imported nor queued for a backfill,
+            # it's left alone like the stream does
+            elif settings.imported and not streamMode:
+                wanted['ingest ' + subname] = lambda subname=subname: self.periodic(
+                    'ingest', lambda: self.sentinel.ingestNew(self.reddit(), self.settings[subname]),
+                    self.ingestInterval)
+        if streamMode:
+            wanted['stream'] = lambda: self.periodic(
+                'stream', lambda: self.sentinel.ingestStream(self.reddit()), STREAM_INTERVAL, self.streamExecutor)
+        if self.sentinel.leases is None or self.sentinel.leases.ownsMail():
+            wanted['mail'] = lambda: self.periodic(
+                'mail', lambda: self.sentinel.checkMail(self.reddit()), self.mailInterval)
+        if self.sentinel.config.get('SNAPSHOT_PATH') and self.sentinel.config.get('MATCHER', DEFAULT_MATCHER) != 'sql':
+            wanted['snapshot'] = lambda: self.periodic(
+                'snapshot', self.sentinel.writeSnapshot, SNAPSHOT_CHECK_INTERVAL)
+        if self.maintenanceInterval:
+            wanted['maintenance'] = lambda: self.periodic(
+                'maintenance', self.sentinel.maintainMedia, self.maintenanceInterval)
+
+        for name in [name for name in self.tasks if name != 'enforce' and name not in wanted]:
+            self.logger.info('Stopping task {0}'.format(name))
+            self.tasks.pop(name).cancel()
+        for name, task in wanted.items():
+            if name not in self.tasks:
+                self.logger.info('Starting task {0}'.format(name))
+                self.tasks[name] = asyncio.ensure_future(task())
+
+    # Run work every interval seconds, backing off while it fails
+    async def periodic(self, kind, work, interval, executor=None):
+        backoff = Backoff()
+        while True:
+            started = time.perf_counter()
+            try:
+                await self.loop.run_in_executor(executor or self.executor, work)
+                CYCLE_SECONDS.observe(time.perf_counter() - started, task=kind)
+                backoff.reset()
+                delay = interval
+            except Exception as e:
+                delay = backoff.next()
+                self.logger.warning('{0} - {1} task failed, retrying in {2:.0f}s - {3}'.format(
+                    describeError(e), kind, delay, e))
+            await asyncio.sleep(delay)
+
+    # Queue action(r) to run on the enforcement task, callable from any thread
+    def submit(self, description, action):
+        self.loop.call_soon_threadsafe(self.enforcements.put_nowait, (description, action))
+
+    # Run queued enforcement actions in order, retrying each with backoff
+    async def enforce(self):
+        backoff = Backoff()
+        while True:
+            description, action = await self.enforcements.get()
+            for attempt in itertools.count(1):
+                try:
+                    await self.loop.run_in_executor(self.executor, lambda: action(self.reddit()))
+                    backoff.reset()
+                    break
+                except PERMANENT_ERRORS as e:
+                    self.logger.error('{0} - giving up on {1} - {2}'.format(describeError(e), description, e))
+                    break
+                except Exception as e:
+                    if attempt >= ENFORCE_ATTEMPTS:
+                        self.logger.error('{0} - giving up on {1} after {2} attempts - {3}'.format(
+                            describeError(e), description, attempt, e))
+                        break
+                    delay = backoff.next()
+                    self.logger.warning('{0} - {1} failed, retrying in {2:.0f}s - {3}'.format(
+                        describeError(e), description, delay, e))
+                    await asyncio.sleep(delay)
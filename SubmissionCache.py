@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Current reddit state of a submission as shown in match reports
+SubmissionState = namedtuple('SubmissionState', ['score', 'comments', 'status'])
+
+
+class SubmissionCache:
+    # TTL + LRU cache of the reddit state of repost parents. Misses are
+    # fetched together with one r.info call.
+
+    def __init__(self, maxSize=10000, ttl=600):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # {submission id: SubmissionState} for the given ids, ids reddit doesn't
+    # return are left out
+    def get(self, r, submissionIds):
+        now = time.time()
+        states = {}
+        misses = []
+        with self.lock:
+            for submissionId in submissionIds:
+                entry = self.entries.get(submissionId)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(submissionId)
+                    states[submissionId] = entry[1]
+                else:
+                    misses.append(submissionId)
+
+        if not misses:
+            return states
+
+        fetched = {}
+        for submission in r.info(fullnames=['t3_{0}'.format(submissionId) for submissionId in misses]):
+            fetched[submission.id] = self.state(submission)
+
+        with self.lock:
+            for submissionId, state in fetched.items():
+                self.entries[submissionId] = (now + self.ttl, state)
+                self.entries.move_to_end(submissionId)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+        states.update(fetched)
+        return states
+
+    @staticmethod
+    def state(submission):
+        status = 'Active'
+        if submission.removed or submission.banned_by:
+            status = 'Removed'
+        elif submission.author is None:
+            # praw gives deleted posts no author
+            status = 'Deleted'
+        return SubmissionState(int(submission.score), int(submission.num_comments), status)
@@ -0,0 +1,150 @@
+import select
+import threading
+import time
+
+from HashIndex import similarityToRadius
+
+# Columns read from SubredditSettings, by name so a schema change fails
+# loudly instead of shifting positions
+COLUMNS = (
+    'subname', 'imported', 'min_width', 'min_height', 'min_pixels', 'min_size',
+    'report_match_threshold', 'report_match_message', 'remove_match_threshold', 'remove_match_message',
+    'report_indirect', 'remove_indirect', 'remove_indirect_message', 'media_retention_days'
+)
+
+# Channel the SubredditSettings trigger notifies with the changed subname
+CHANNEL = 'subreddit_settings'
+
+# Media 200px or smaller on a side was never indexed, kept as the default
+# when a subreddit doesn't set its own minimum
+DEFAULT_MIN_DIMENSION = 201
+
+# Seconds between reconnects of the notification listener
+LISTEN_RETRY_DELAY = 30
+
+
+class SubredditSettings:
+    # One row of SubredditSettings, with the values derived from it that
+    # are checked for every submission worked out once up front. NULL
+    # thresholds disable reporting or removal, no match is over 100%.
+
+    __slots__ = (
+        'subname', 'imported', 'minWidth', 'minHeight', 'minPixels', 'minSize',
+        'reportThreshold', 'reportMessage', 'removeThreshold', 'removeMessage',
+        'reportIndirect', 'removeIndirect', 'removeIndirectMessage',
+        'retentionDays', 'reportRadius', 'removeRadius', 'matchRadius'
+    )
+
+    def __init__(self, subname, imported=None, minWidth=None, minHeight=None, minPixels=None, minSize=None,
+                 reportThreshold=None, reportMessage=None, removeThreshold=None, removeMessage=None,
+                 reportIndirect=None, removeIndirect=None, removeIndirectMessage=None, retentionDays=None):
+        self.subname = subname
+        self.imported = imported
+        self.minWidth = int(minWidth) if minWidth is not None else DEFAULT_MIN_DIMENSION
+        self.minHeight = int(minHeight) if minHeight is not None else DEFAULT_MIN_DIMENSION
+        self.minPixels = int(minPixels or 0)
+        # Not applied, previews are hashed so the downloaded size says
+        # nothing about the original file
+        self.minSize = minSize
+        self.reportThreshold = reportThreshold if reportThreshold is not None else 100
+        self.reportMessage = reportMessage
+        self.removeThreshold = removeThreshold if removeThreshold is not None else 100
+        self.removeMessage = removeMessage
+        self.reportIndirect = reportIndirect
+        self.removeIndirect = removeIndirect
+        self.removeIndirectMessage = removeIndirectMessage
+        # Days of media kept for matching, None keeps all of it
+        self.retentionDays = retentionDays
+
+        self.reportRadius = similarityToRadius(self.reportThreshold)
+        self.removeRadius = similarityToRadius(self.removeThreshold)
+        # Only hashes within the widest threshold are pulled from the index
+        self.matchRadius = max(self.reportRadius, self.removeRadius)
+
+    @classmethod
+    def fromRow(cls, row):
+        return cls(*row)
+
+    # Whether media of this size is big enough to index
+    def accepts(self, width, height):
+        return width >= self.minWidth and height >= self.minHeight and width * height >= self.minPixels
+
+    def __repr__(self):
+        return 'SubredditSettings({0})'.format(self.subname)
+
+
+class SettingsCache:
+    # All SubredditSettings rows held in memory. A trigger on the table
+    # notifies CHANNEL with the subname of every changed row and a listener
+    # thread reloads just that row, so nothing polls the table. Everything
+    # is reloaded whenever the listener (re)connects in case notifications
+    # were missed while it was down.
+
+    def __init__(self, db, logger):
+        self.db = db
+        self.logger = logger
+        self.settings = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # Called from the listener thread after settings change
+        self.listeners = []
+
+    def start(self):
+        connection = self.db.listen(CHANNEL)
+        self.reload()
+        self.thread = threading.Thread(target=self.listen, args=(connection,), name='settings', daemon=True)
+        self.thread.start()
+
+    # Every subreddit's settings, ordered by subname
+    def all(self):
+        with self.lock:
+            return [self.settings[subname] for subname in sorted(self.settings)]
+
+    def get(self, subname):
+        with self.lock:
+            return self.settings.get(subname)
+
+    def reload(self):
+        rows = self.db.fetchall('SELECT {0} FROM SubredditSettings'.format(', '.join(COLUMNS)))
+        settings = {row[0]: SubredditSettings.fromRow(row) for row in rows}
+        with self.lock:
+            self.settings = settings
+        self.logger.info('Loaded settings for {0} subreddits'.format(len(settings)))
+        self.changed()
+
+    def reloadSubreddit(self, subname):
+        row = self.db.fetchone(
+            'SELECT {0} FROM SubredditSettings WHERE subname=%s'.format(', '.join(COLUMNS)), (subname,))
+        with self.lock:
+            if row is None:
+                self.settings.pop(subname, None)
+            else:
+                self.settings[subname] = SubredditSettings.fromRow(row)
+        self.logger.info('Reloaded settings for r/{0}'.format(subname))
+        self.changed()
+
+    def changed(self):
+        for listener in self.listeners:
+            listener()
+
+    def listen(self, connection):
+        while True:
+            try:
+                if connection is None:
+                    connection = self.db.listen(CHANNEL)
+                    self.reload()
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                changed = set()
+                while connection.notifies:
+                    changed.add(connection.notifies.pop(0).payload)
+                for subname in changed:
+                    self.reloadSubreddit(subname)
+            except Exception as e:
+                self.logger.error('Settings listener failed, reconnecting in {0}s - {1}'.format(
+                    LISTEN_RETRY_DELAY, e))
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                time.sleep(LISTEN_RETRY_DELAY)
@@ -0,0 +1,102 @@
+# Check the fast difference hash against the original getpixel
+# implementation on random images and time both. The golden hashes stored
+# hashes depend on are checked by tests/test_imagehash.py.
+#
+# Usage:
+#   python3 benchmarks/dhash.py --images 2000
+import argparse
+import os
+import random
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageHash import RESAMPLE, differenceHash, differenceHashBatch
+
+
+# The hashing function as it was on RepostSentinel, with Image.ANTIALIAS
+# spelled as the LANCZOS filter it aliased. tests/test_imagehash.py keeps
+# the same copy to check the golden hashes.
+def legacyDifferenceHash(theImage):
+
+    theImage = theImage.convert("L")
+    theImage = theImage.resize((8, 8), RESAMPLE)
+    previousPixel = theImage.getpixel((0, 7))
+    differenceHash = 0
+
+    for row in range(0, 8, 2):
+
+        for col in range(8):
+            differenceHash <<= 1
+            pixel = theImage.getpixel((col, row))
+            differenceHash |= 1 * (pixel >= previousPixel)
+            previousPixel = pixel
+
+        row += 1
+
+        for col in range(7, -1, -1):
+            differenceHash <<= 1
+            pixel = theImage.getpixel((col, row))
+            differenceHash |= 1 * (pixel >= previousPixel)
+            previousPixel = pixel
+
+    return differenceHash
+
+
+def randomImage(rng):
+    mode = rng.choice(['RGB', 'RGBA', 'L', 'P'])
+    width = rng.randint(16, 800)
+    height = rng.randint(16, 800)
+    img = Image.frombytes('RGB', (16, 16), bytes(rng.getrandbits(8) for _ in range(16 * 16 * 3)))
+    img = img.resize((width, height), Image.BILINEAR)
+    return img.convert(mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and benchmark the difference hash')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    images = [randomImage(rng) for _ in range(args.images)]
+
+    started = time.perf_counter()
+    legacy = [legacyDifferenceHash(img) for img in images]
+    legacyTime = time.perf_counter() - started
+
+    started = time.perf_counter()
+    fast = [differenceHash(img) for img in images]
+    fastTime = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = differenceHashBatch(images)
+    batchTime = time.perf_counter() - started
+
+    if fast != legacy or batch != legacy:
+        mismatches = sum(1 for a, b, c in zip(legacy, fast, batch) if not a == b == c)
+        sys.exit('{0} of {1} hashes differ from the legacy implementation'.format(mismatches, len(images)))
+
+    print('{0} images, all hashes identical to the legacy implementation'.format(len(images)))
+    print('full hash including grayscale conversion and resize:')
+    for name, elapsed in (('legacy', legacyTime), ('fast', fastTime), ('batch', batchTime)):
+        print('{0:>8} {1:>10.1f} us/image'.format(name, elapsed / len(images) * 1e6))
+
+    # Hashing already reduced thumbnails isolates the bit extraction that
+    # used to be 64 getpixel calls
+    thumbnails = [img.convert('L').resize((8, 8), RESAMPLE) for img in images]
+    print('bit extraction from 8x8 thumbnails:')
+    for name, hasher in (('legacy', lambda imgs: [legacyDifferenceHash(img) for img in imgs]),
+                         ('fast', lambda imgs: [differenceHash(img) for img in imgs]),
+                         ('batch', differenceHashBatch)):
+        started = time.perf_counter()
+        hasher(thumbnails)
+        elapsed = time.perf_counter() - started
+        print('{0:>8} {1:>10.1f} us/image'.format(name, elapsed / len(images) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Compare the original per-row loop from enforceSubmission with the
+# vectorized numpy scan and the multi-index on synthetic hash sets.
+#
+# Usage:
+#   python3 benchmarks/matcher.py --sizes 10000 1000000 10000000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from HashIndex import HashArray, MultiIndexHashes, similarityToRadius
+
+
+# The matching loop as it was in enforceSubmission, hashes are the decimal
+# strings stored in Media
+def legacySearch(rows, mediaHash, threshold):
+    matches = []
+    for row in rows:
+        if len(matches) > 9:
+            break
+        mediaSimilarity = int(((64 - bin(mediaHash ^ int(row[0])).count('1')) * 100.0) / 64.0)
+        if mediaSimilarity > threshold:
+            matches.append(row[1])
+    return matches
+
+
+# Random hashes with a few near duplicates of each query planted in
+def generateHashes(size, queries, rng):
+    hashes = [rng.getrandbits(64) for _ in range(size)]
+    for query in queries:
+        for _ in range(5):
+            flipped = query
+            for bit in rng.sample(range(64), rng.randint(0, 6)):
+                flipped ^= 1 << bit
+            hashes[rng.randrange(size)] = flipped
+    return hashes
+
+
+def timeQueries(search, queries):
+    started = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - started) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hash matchers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--threshold', type=int, default=88)
+    parser.add_argument('--max-legacy', type=int, default=10000000,
+                        help='skip the legacy loop above this many hashes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    radius = similarityToRadius(args.threshold)
+    print('threshold {0}% -> radius {1} bits, {2} queries per size'.format(args.threshold, radius, args.queries))
+    print('{0:>10} {1:>10} {2:>12} {3:>12}'.format('hashes', 'matcher', 'build s', 'query ms'))
+
+    for size in args.sizes:
+        queries = [rng.getrandbits(64) for _ in range(args.queries)]
+        generated = generateHashes(size, queries, rng)
+
+        if size <= args.max_legacy:
+            rows = [(str(mediaHash), str(i)) for i, mediaHash in enumerate(generated)]
+            perQuery = timeQueries(lambda query: legacySearch(rows, query, args.threshold), queries)
+            print('{0:>10} {1:>10} {2:>12} {3:>12.3f}'.format(size, 'legacy', '-', perQuery * 1000))
+            del rows
+
+        for name, matcher in (('numpy', HashArray), ('multiindex', MultiIndexHashes)):
+            started = time.perf_counter()
+            hashes = matcher(capacity=size)
+            for i, mediaHash in enumerate(generated):
+                hashes.add(mediaHash, str(i))
+            # The multi-index is built by the first search
+            hashes.search(queries[0], radius, 10)
+            built = time.perf_counter() - started
+            perQuery = timeQueries(lambda query: hashes.search(query, radius, 10), queries)
+            print('{0:>10} {1:>10} {2:>12.2f} {3:>12.3f}'.format(size, name, built, perQuery * 1000))
+            del hashes
+
+
+if __name__ == '__main__':
+    main()
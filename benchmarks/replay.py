@@ -0,0 +1,340 @@
+# Replay generated submissions through ingestNew and enforceSubmission end
+# to end, against a stand-in for reddit, a local image server and a
+# throwaway Postgres database, and report throughput, detection latency
+# and how accurately reposts were reported.
+#
+# Every original image gets a random number of reposts later in the
+# timeline, each a resized, recompressed, brightened, cropped or mirrored
+# copy.
+# Submissions are posted to the fake subreddit in rounds of --batch and
+# ingestNew runs after each round, detection latency is the time from a
+# repost being posted to it being reported.
+#
+# Usage:
+#   python3 benchmarks/replay.py --db-host localhost --db-user postgres --posts 2000
+import argparse
+import functools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import psycopg2.extensions
+from PIL import Image, ImageEnhance, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Database import Database
+from HashIndex import DEFAULT_MATCHER, MATCHERS, HashIndex, SqlHashIndex
+from ImageHash import flipHashes
+from MediaCache import MediaCache
+from MediaFetcher import MediaFetcher
+from RepostSentinel import RepostSentinel
+from SubmissionCache import SubmissionCache
+from SubredditSettings import SubredditSettings
+
+SUBREDDIT = 'replay'
+DB_CREATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'postgres', 'DbCreate.sql')
+
+
+# ----------- Image corpus ----------- #
+
+# A smooth random image, distinct ones are far apart in dHash space
+def originalImage(rng, size):
+    grid = Image.new('RGB', (12, 9))
+    grid.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(12 * 9)])
+    return grid.resize(size, Image.BICUBIC)
+
+
+# A near duplicate the way reposts usually are
+def repostImage(rng, original):
+    transform = rng.choice(('resize', 'brighten', 'crop', 'mirror', 'recompress'))
+    if transform == 'resize':
+        scale = rng.uniform(0.5, 0.9)
+        return original.resize((int(original.width * scale), int(original.height * scale)), Image.BILINEAR)
+    if transform == 'brighten':
+        return ImageEnhance.Brightness(original).enhance(rng.uniform(0.85, 1.15))
+    if transform == 'crop':
+        dx = int(original.width * rng.uniform(0, 0.03))
+        dy = int(original.height * rng.uniform(0, 0.03))
+        return original.crop((dx, dy, original.width - dx, original.height - dy))
+    if transform == 'mirror':
+        return ImageOps.mirror(original)
+    return original
+
+
+# [(submission id, file name, id of the original or None)] in posting order
+def generateCorpus(directory, posts, repostRate, rng):
+    timeline = []
+    originals = []
+    for number in range(posts):
+        submissionId = 'r{0:05d}'.format(number)
+        fileName = submissionId + '.jpg'
+        if originals and rng.random() < repostRate:
+            originalId, original = rng.choice(originals)
+            image = repostImage(rng, original)
+            timeline.append((submissionId, fileName, originalId))
+        else:
+            image = originalImage(rng, (rng.randrange(400, 1200), rng.randrange(400, 1200)))
+            originals.append((submissionId, image))
+            timeline.append((submissionId, fileName, None))
+        image.save(os.path.join(directory, fileName), quality=rng.randrange(60, 95))
+    return timeline
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serveDirectory(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ----------- Fake reddit ----------- #
+
+class FakeModeration:
+    def __init__(self, thing):
+        self.thing = thing
+
+    def remove(self, spam=False):
+        self.thing.removed = True
+        self.thing.reddit.actions.append(('remove', self.thing.id, time.perf_counter()))
+
+
+class FakeComment:
+    def __init__(self, reddit, parent, body):
+        self.reddit = reddit
+        self.id = 'c' + parent.id
+        self.fullname = 't1_' + self.id
+        self.body = body
+        self.removed = False
+        self.mod = FakeModeration(self)
+
+    def distinguish(self, how='yes', sticky=False):
+        pass
+
+
+class FakeSubmission:
+    def __init__(self, reddit, submissionId, url, created):
+        self.reddit = reddit
+        self.id = submissionId
+        self.fullname = 't3_' + submissionId
+        self.url = url
+        self.is_self = False
+        self.created = self.created_utc = created
+        self.author = 'user_' + submissionId
+        self.title = 'Submission ' + submissionId
+        self.num_comments = 0
+        self.score = 1
+        self.removed = False
+        self.banned_by = None
+        self.removal_reason = None
+        self.subreddit = SUBREDDIT
+        self.mod = FakeModeration(self)
+
+    def report(self, reason):
+        self.reddit.actions.append(('report', self.id, time.perf_counter()))
+
+    def reply(self, body):
+        self.reddit.actions.append(('reply', self.id, time.perf_counter()))
+        return FakeComment(self.reddit, self, body)
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+
+    def new(self, limit=100):
+        return iter(self.reddit.posted[::-1][:limit])
+
+
+class FakeReddit:
+    # Stands in for praw.Reddit. Posted submissions show up in the new
+    # listing, reports, replies and removals are recorded with the time
+    # they were made.
+
+    def __init__(self):
+        self.posted = []
+        self.submissions = {}
+        self.actions = []
+
+    def post(self, submission):
+        self.posted.append(submission)
+        self.submissions[submission.id] = submission
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def submission(self, id):
+        return self.submissions[id]
+
+    def info(self, fullnames):
+        return [self.submissions[fullname[3:]] for fullname in fullnames if fullname[3:] in self.submissions]
+
+
+# ----------- Throwaway database ----------- #
+
+def createDatabase(args, name):
+    connection = psycopg2.connect(dbname=args.db_maintenance, user=args.db_user, host=args.db_host,
+                                  password=args.db_pass)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cur:
+        cur.execute('CREATE DATABASE {0}'.format(name))
+    connection.close()
+
+    connection = psycopg2.connect(dbname=name, user=args.db_user, host=args.db_host, password=args.db_pass)
+    with connection:
+        with connection.cursor() as cur:
+            cur.execute(open(DB_CREATE).read())
+    connection.close()
+
+
+def dropDatabase(args, name):
+    connection = psycopg2.connect(dbname=args.db_maintenance, user=args.db_user, host=args.db_host,
+                                  password=args.db_pass)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cur:
+        cur.execute('DROP DATABASE IF EXISTS {0}'.format(name))
+    connection.close()
+
+
+# ----------- Replay ----------- #
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def replay(args, config, baseUrl, timeline):
+    sentinel = RepostSentinel(config)
+    sentinel.setup_logging()
+    sentinel.logger.setLevel(args.log_level)
+
+    sentinel.db = Database(config, sentinel.logger)
+    sentinel.db.connect()
+    sentinel.prepareStatements()
+    if args.matcher == 'sql':
+        sentinel.hashIndex = SqlHashIndex(sentinel.logger)
+    else:
+        sentinel.hashIndex = HashIndex(sentinel.logger, args.matcher)
+    sentinel.hashIndex.load(sentinel.db)
+    sentinel.mediaFetcher = MediaFetcher(
+        flipHashes,
+        fetchWorkers=args.fetch_workers,
+        hashWorkers=args.hash_workers,
+        cache=MediaCache(sentinel.db, sentinel.logger) if args.media_cache else None,
+        logger=sentinel.logger
+    )
+    sentinel.parentCache = SubmissionCache()
+    settings = SubredditSettings(SUBREDDIT, True, 0, 0, 0, 0, args.threshold, '', None, '', False, False, '')
+
+    reddit = FakeReddit()
+    postedAt = {}
+    started = time.perf_counter()
+    for offset in range(0, len(timeline), args.batch):
+        for submissionId, fileName, originalId in timeline[offset:offset + args.batch]:
+            reddit.post(FakeSubmission(reddit, submissionId, baseUrl + fileName, 1000000.0 + len(reddit.posted)))
+            postedAt[submissionId] = time.perf_counter()
+        sentinel.ingestNew(reddit, settings)
+    elapsed = time.perf_counter() - started
+    sentinel.mediaFetcher.shutdown()
+    sentinel.db.close()
+
+    reportedAt = {}
+    for action, submissionId, at in reddit.actions:
+        if action == 'report':
+            reportedAt.setdefault(submissionId, at)
+
+    reposts = {submissionId for submissionId, fileName, originalId in timeline if originalId is not None}
+    reported = set(reportedAt)
+    truePositives = len(reported & reposts)
+    latencies = [reportedAt[submissionId] - postedAt[submissionId] for submissionId in reported & reposts]
+
+    return {
+        'posts': len(timeline),
+        'reposts': len(reposts),
+        'seconds': elapsed,
+        'posts_per_second': len(timeline) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'true_positives': truePositives,
+        'false_positives': len(reported - reposts),
+        'false_negatives': len(reposts - reported),
+        'precision': truePositives / len(reported) if reported else float('nan'),
+        'recall': truePositives / len(reposts) if reposts else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay generated submissions through the bot end to end')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--repost-rate', type=float, default=0.2,
+                        help='share of submissions that repost an earlier image')
+    parser.add_argument('--batch', type=int, default=50, help='submissions posted between ingestNew runs')
+    parser.add_argument('--threshold', type=int, default=88, help='report_match_threshold of the subreddit')
+    parser.add_argument('--matcher', default=DEFAULT_MATCHER, choices=list(MATCHERS) + ['sql'])
+    parser.add_argument('--fetch-workers', type=int, default=16)
+    parser.add_argument('--hash-workers', type=int, default=4)
+    parser.add_argument('--media-cache', action='store_true', help='use the MediaCache table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-user', default='postgres')
+    parser.add_argument('--db-pass', default='')
+    parser.add_argument('--db-maintenance', default='postgres',
+                        help='existing database to connect to while creating and dropping the throwaway one')
+    parser.add_argument('--keep-db', action='store_true', help="don't drop the throwaway database afterwards")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON for regression tracking')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    if args.batch > 200:
+        parser.error('--batch can be at most 200, the most ingestNew reads from new')
+
+    rng = random.Random(args.seed)
+    corpus = tempfile.mkdtemp(prefix='replay_')
+    dbName = 'repost_replay_{0}'.format(os.getpid())
+    try:
+        timeline = generateCorpus(corpus, args.posts, args.repost_rate, rng)
+        server = serveDirectory(corpus)
+        baseUrl = 'http://127.0.0.1:{0}/'.format(server.server_port)
+
+        createDatabase(args, dbName)
+        config = {
+            'DB_NAME': dbName,
+            'DB_USER': args.db_user,
+            'DB_HOST': args.db_host,
+            'DB_PASS': args.db_pass,
+        }
+        try:
+            results = replay(args, config, baseUrl, timeline)
+        finally:
+            if not args.keep_db:
+                dropDatabase(args, dbName)
+        server.shutdown()
+    finally:
+        shutil.rmtree(corpus, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+        return
+    print('{0} posts, {1} reposts, matcher {2}'.format(results['posts'], results['reposts'], args.matcher))
+    print('throughput  {0:.1f} posts/s ({1:.1f}s)'.format(results['posts_per_second'], results['seconds']))
+    print('latency     p50 {0:.0f} ms, p99 {1:.0f} ms'.format(results['latency_p50_ms'], results['latency_p99_ms']))
+    print('precision   {0:.3f} ({1} false positives)'.format(results['precision'], results['false_positives']))
+    print('recall      {0:.3f} ({1} missed)'.format(results['recall'], results['false_negatives']))
+
+
+if __name__ == '__main__':
+    main()
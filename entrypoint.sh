@@ -26,4 +26,4 @@ if [ ! -f "config.yml" ]; then
 fi
 
 
-python3 RepostSentinel.py
\ No newline at end of file
+python3 RepostSentinel.py "$@"
\ No newline at end of file
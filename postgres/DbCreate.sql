@@ -13,7 +13,10 @@ CREATE TABLE SubredditSettings (
 	remove_match_message TEXT,
 	report_indirect BOOLEAN,
 	remove_indirect BOOLEAN,
-	remove_indirect_message TEXT
+	remove_indirect_message TEXT,
+	-- Days of Media kept for matching, older partitions are archived or
+	-- dropped by the maintenance job. NULL keeps everything.
+	media_retention_days INTEGER
 );
 
 INSERT INTO SubredditSettings(
@@ -46,6 +49,23 @@ INSERT INTO SubredditSettings(
     ''
 );
 
+-- Running bots cache the settings, tell them which subreddit changed
+CREATE OR REPLACE FUNCTION notify_subreddit_settings() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP <> 'INSERT' THEN
+		PERFORM pg_notify('subreddit_settings', OLD.subname);
+	END IF;
+	IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.subname <> OLD.subname) THEN
+		PERFORM pg_notify('subreddit_settings', NEW.subname);
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER subreddit_settings_notify
+AFTER INSERT OR UPDATE OR DELETE ON SubredditSettings
+FOR EACH ROW EXECUTE FUNCTION notify_subreddit_settings();
+
 
 
 DROP TABLE IF EXISTS Submissions;
@@ -68,10 +88,80 @@ CREATE TABLE Submissions (
 
 
 
+DROP TABLE IF EXISTS IngestState;
+
+-- Newest submission ingestNew has seen per subreddit
+CREATE TABLE IngestState (
+	subname VARCHAR(21) PRIMARY KEY,
+	last_seen_id VARCHAR(10),
+	last_seen_utc DOUBLE PRECISION
+);
+
+
+
+DROP TABLE IF EXISTS BackfillCheckpoint;
+
+-- Progress of each top listing while importing a subreddit
+CREATE TABLE BackfillCheckpoint (
+	subname VARCHAR(21),
+	listing VARCHAR(10),
+	last_fullname VARCHAR(16),
+	completed BOOLEAN,
+	PRIMARY KEY (subname, listing)
+);
+
+
+
+DROP TABLE IF EXISTS Worker;
+
+-- Workers sharing the subreddits, rows expire when heartbeats stop
+CREATE TABLE Worker (
+	worker_id VARCHAR(128) PRIMARY KEY,
+	heartbeat TIMESTAMP WITH TIME ZONE
+);
+
+
+
+DROP TABLE IF EXISTS WorkerLease;
+
+-- Which worker handles each subreddit ('r/<subname>') and the inbox ('mail')
+CREATE TABLE WorkerLease (
+	resource VARCHAR(32) PRIMARY KEY,
+	worker_id VARCHAR(128),
+	expires TIMESTAMP WITH TIME ZONE
+);
+
+
+
+DROP TABLE IF EXISTS MediaCache;
+
+-- Hash results keyed by normalized url ('url:...') and by content digest
+-- ('sha256:...') so repeat media isn't downloaded and decoded again
+CREATE TABLE MediaCache (
+	key VARCHAR(256) PRIMARY KEY,
+	hash BIGINT,
+	width DOUBLE PRECISION,
+	height DOUBLE PRECISION,
+	file_size DOUBLE PRECISION,
+	phash BIGINT,
+	-- (dHash, pHash) of the flips, in the order ImageHash.flipHashes gives them
+	flip_hashes BIGINT[],
+	flip_phashes BIGINT[],
+	last_used DOUBLE PRECISION
+);
+
+CREATE INDEX media_cache_last_used_idx ON MediaCache (last_used);
+
+
+
 DROP TABLE IF EXISTS Media;
 
+-- Partitioned by subreddit and then by created, the maintenance job in
+-- Retention.py creates the partitions. Rows of subreddits it hasn't got to
+-- yet land in media_default.
 CREATE TABLE Media (
-	hash VARCHAR(32),
+	-- 64 bit dHash stored as a signed bigint, values >= 2^63 wrap negative
+	hash BIGINT,
 	submission_id VARCHAR(10),
 	subreddit VARCHAR(21),
 	frame_number INTEGER,
@@ -80,5 +170,31 @@ CREATE TABLE Media (
 	frame_height DOUBLE PRECISION,
 	total_pixels DOUBLE PRECISION,
 	file_size DOUBLE PRECISION,
-	PRIMARY KEY (submission_id, frame_number, hash)
-);
+	-- 64 bit pHash of single images, checked for the rows the dHash shortlists
+	phash BIGINT,
+	-- Insertion order, hash index snapshots record the highest seq they hold
+	seq BIGSERIAL,
+	-- Creation time of the submission, the time partitions are split on
+	created DOUBLE PRECISION,
+	-- Exact duplicates in the subreddit collapsed into this row, itself included
+	ref_count INTEGER NOT NULL DEFAULT 1,
+	PRIMARY KEY (submission_id, frame_number, hash, subreddit, created)
+) PARTITION BY LIST (subreddit);
+
+CREATE TABLE media_default PARTITION OF Media DEFAULT;
+
+-- Matching only ever looks at one subreddit's single or multi frame media.
+-- Submissions.id and Media.submission_id lookups are covered by the primary keys.
+CREATE INDEX media_subreddit_frame_count_idx ON Media (subreddit, frame_count);
+-- Rows added since a hash index snapshot are read by seq on startup.
+CREATE INDEX media_seq_idx ON Media (seq);
+
+
+
+DROP TABLE IF EXISTS MediaArchive;
+
+-- Media past its subreddit's retention window and rows compacted out of
+-- Media, never matched against but still there to query
+CREATE TABLE MediaArchive (LIKE Media) PARTITION BY LIST (subreddit);
+
+CREATE TABLE mediaarchive_default PARTITION OF MediaArchive DEFAULT;
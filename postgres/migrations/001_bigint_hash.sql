@@ -0,0 +1,18 @@
+-- Convert Media.hash from the decimal VARCHAR representation to a signed
+-- BIGINT. Unsigned 64 bit hashes >= 2^63 are wrapped into the negative range,
+-- matching toSigned() in HashIndex.py.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/001_bigint_hash.sql
+
+BEGIN;
+
+ALTER TABLE Media ALTER COLUMN hash TYPE BIGINT USING (
+	CASE
+		WHEN hash::NUMERIC >= 9223372036854775808 THEN hash::NUMERIC - 18446744073709551616
+		ELSE hash::NUMERIC
+	END
+)::BIGINT;
+
+CREATE INDEX IF NOT EXISTS media_subreddit_frame_count_idx ON Media (subreddit, frame_count);
+
+COMMIT;
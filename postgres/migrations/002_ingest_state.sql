@@ -0,0 +1,10 @@
+-- Track the newest submission ingestNew has seen per subreddit so it can
+-- stop at the first already-seen post.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/002_ingest_state.sql
+
+CREATE TABLE IF NOT EXISTS IngestState (
+	subname VARCHAR(21) PRIMARY KEY,
+	last_seen_id VARCHAR(10),
+	last_seen_utc DOUBLE PRECISION
+);
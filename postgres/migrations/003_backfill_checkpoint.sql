@@ -0,0 +1,12 @@
+-- Per listing progress of subreddit imports so an interrupted backfill
+-- resumes instead of starting over.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/003_backfill_checkpoint.sql
+
+CREATE TABLE IF NOT EXISTS BackfillCheckpoint (
+	subname VARCHAR(21),
+	listing VARCHAR(10),
+	last_fullname VARCHAR(16),
+	completed BOOLEAN,
+	PRIMARY KEY (subname, listing)
+);
@@ -0,0 +1,14 @@
+-- Cache of hash results by normalized url and content digest.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/004_media_cache.sql
+
+CREATE TABLE IF NOT EXISTS MediaCache (
+	key VARCHAR(256) PRIMARY KEY,
+	hash BIGINT,
+	width DOUBLE PRECISION,
+	height DOUBLE PRECISION,
+	file_size DOUBLE PRECISION,
+	last_used DOUBLE PRECISION
+);
+
+CREATE INDEX IF NOT EXISTS media_cache_last_used_idx ON MediaCache (last_used);
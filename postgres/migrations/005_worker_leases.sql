@@ -0,0 +1,14 @@
+-- Worker heartbeats and subreddit leases for running several workers.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/005_worker_leases.sql
+
+CREATE TABLE IF NOT EXISTS Worker (
+	worker_id VARCHAR(128) PRIMARY KEY,
+	heartbeat TIMESTAMP WITH TIME ZONE
+);
+
+CREATE TABLE IF NOT EXISTS WorkerLease (
+	resource VARCHAR(32) PRIMARY KEY,
+	worker_id VARCHAR(128),
+	expires TIMESTAMP WITH TIME ZONE
+);
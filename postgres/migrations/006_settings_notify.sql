@@ -0,0 +1,23 @@
+-- Notify running bots when SubredditSettings change so they don't have to
+-- poll the table.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/006_settings_notify.sql
+
+-- Running bots cache the settings, tell them which subreddit changed
+CREATE OR REPLACE FUNCTION notify_subreddit_settings() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP <> 'INSERT' THEN
+		PERFORM pg_notify('subreddit_settings', OLD.subname);
+	END IF;
+	IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.subname <> OLD.subname) THEN
+		PERFORM pg_notify('subreddit_settings', NEW.subname);
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subreddit_settings_notify ON SubredditSettings;
+
+CREATE TRIGGER subreddit_settings_notify
+AFTER INSERT OR UPDATE OR DELETE ON SubredditSettings
+FOR EACH ROW EXECUTE FUNCTION notify_subreddit_settings();
@@ -0,0 +1,8 @@
+-- Perceptual hash of single images, compared against the flips of new
+-- posts for the parents the dHash index shortlists. Rows indexed before
+-- this are matched on their dHash alone.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/007_phash.sql
+
+ALTER TABLE Media ADD COLUMN IF NOT EXISTS phash BIGINT;
+ALTER TABLE MediaCache ADD COLUMN IF NOT EXISTS phash BIGINT;
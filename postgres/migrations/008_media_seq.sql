@@ -0,0 +1,9 @@
+-- Insertion sequence on Media so a hash index snapshot can record the last
+-- row it holds and startup only reads the rows after it. Adding the column
+-- numbers the existing rows and rewrites the table, run it while the bot
+-- is stopped.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/008_media_seq.sql
+
+ALTER TABLE Media ADD COLUMN IF NOT EXISTS seq BIGSERIAL;
+CREATE INDEX IF NOT EXISTS media_seq_idx ON Media (seq);
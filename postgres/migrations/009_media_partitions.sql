@@ -0,0 +1,52 @@
+-- Partition Media by subreddit, add the columns retention and compaction
+-- work with, and create MediaArchive for the rows they move out of Media.
+-- The per subreddit and per period partitions are created afterwards by
+-- the bot's maintenance job, until then everything stays in media_default.
+-- Copies the whole table, run it while the bot is stopped.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/009_media_partitions.sql
+
+BEGIN;
+
+ALTER TABLE SubredditSettings ADD COLUMN IF NOT EXISTS media_retention_days INTEGER;
+
+ALTER TABLE Media RENAME TO MediaUnpartitioned;
+ALTER INDEX IF EXISTS media_subreddit_frame_count_idx RENAME TO mediaunpartitioned_subreddit_frame_count_idx;
+ALTER INDEX IF EXISTS media_seq_idx RENAME TO mediaunpartitioned_seq_idx;
+
+CREATE TABLE Media (
+	hash BIGINT,
+	submission_id VARCHAR(10),
+	subreddit VARCHAR(21),
+	frame_number INTEGER,
+	frame_count DOUBLE PRECISION,
+	frame_width DOUBLE PRECISION,
+	frame_height DOUBLE PRECISION,
+	total_pixels DOUBLE PRECISION,
+	file_size DOUBLE PRECISION,
+	phash BIGINT,
+	seq BIGINT NOT NULL DEFAULT nextval('media_seq_seq'),
+	created DOUBLE PRECISION,
+	ref_count INTEGER NOT NULL DEFAULT 1,
+	PRIMARY KEY (submission_id, frame_number, hash, subreddit, created)
+) PARTITION BY LIST (subreddit);
+
+CREATE TABLE media_default PARTITION OF Media DEFAULT;
+
+-- Keep the seq values snapshots were written against
+INSERT INTO Media(hash, submission_id, subreddit, frame_number, frame_count, frame_width, frame_height,
+                  total_pixels, file_size, phash, seq, created)
+SELECT m.hash, m.submission_id, m.subreddit, m.frame_number, m.frame_count, m.frame_width, m.frame_height,
+       m.total_pixels, m.file_size, m.phash, m.seq, coalesce(s.timestamp, 0)
+FROM MediaUnpartitioned m LEFT JOIN Submissions s ON s.id = m.submission_id;
+
+ALTER SEQUENCE media_seq_seq OWNED BY Media.seq;
+DROP TABLE MediaUnpartitioned;
+
+CREATE INDEX media_subreddit_frame_count_idx ON Media (subreddit, frame_count);
+CREATE INDEX media_seq_idx ON Media (seq);
+
+CREATE TABLE MediaArchive (LIKE Media) PARTITION BY LIST (subreddit);
+CREATE TABLE mediaarchive_default PARTITION OF MediaArchive DEFAULT;
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- dHash and pHash of the horizontal, vertical and both way flips of cached
+-- images, so cache hits can still be matched as mirrored reposts. Entries
+-- cached before this are treated as misses and hashed again.
+--
+-- Usage: psql -d repost_sentinel -f postgres/migrations/010_media_cache_flips.sql
+
+ALTER TABLE MediaCache ADD COLUMN IF NOT EXISTS flip_hashes BIGINT[];
+ALTER TABLE MediaCache ADD COLUMN IF NOT EXISTS flip_phashes BIGINT[];
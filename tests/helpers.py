@@ -0,0 +1,100 @@
+import logging
+import os
+import unittest
+from types import SimpleNamespace
+
+import psycopg2
+import psycopg2.extensions
+
+from Database import Database
+
+DB_CREATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'postgres', 'DbCreate.sql')
+
+# Postgres the database tests create a throwaway database on, they're
+# skipped unless TEST_DB_HOST is set
+TEST_DB = {
+    'DB_HOST': os.environ.get('TEST_DB_HOST'),
+    'DB_USER': os.environ.get('TEST_DB_USER', 'postgres'),
+    'DB_PASS': os.environ.get('TEST_DB_PASS', ''),
+}
+
+
+class FakeDatabase:
+    # Stands in for Database. A query is answered by the handler in answers
+    # whose key is its prepared statement name or appears in its text, run
+    # by the handler for its name or else on no cursor. Writes are recorded.
+
+    def __init__(self, answers=None):
+        self.answers = dict(answers or {})
+        self.executed = []
+        self.values = []
+
+    def answer(self, query, params):
+        for key, handler in self.answers.items():
+            if key in query:
+                return handler(params)
+        return None
+
+    def fetchone(self, query, params=None):
+        return self.answer(query, params)
+
+    def fetchall(self, query, params=None):
+        return self.answer(query, params) or []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def run(self, work, name='transaction'):
+        if name in self.answers:
+            return self.answers[name](None)
+        return work(None)
+
+    def executeValues(self, cur, query, rows, pageSize=1000):
+        self.values.extend(rows)
+
+
+# A praw Submission as listings send it, fields override the defaults
+def fakeSubmission(submissionId='abc', **fields):
+    submission = SimpleNamespace(
+        id=submissionId,
+        fullname='t3_' + submissionId,
+        subreddit=SimpleNamespace(display_name='pics'),
+        created_utc=0.0,
+        title='title',
+        url='https://i.redd.it/{0}.jpg'.format(submissionId),
+        author='someone',
+        removed=False,
+        removal_reason=None,
+        banned_by=None,
+        score=1,
+        num_comments=0,
+    )
+    vars(submission).update(fields)
+    submission.created = fields.get('created', submission.created_utc)
+    return submission
+
+
+class DatabaseTestCase(unittest.TestCase):
+    # Runs each test against a fresh database created from DbCreate.sql,
+    # self.db is a connected Database
+
+    def setUp(self):
+        if not TEST_DB['DB_HOST']:
+            self.skipTest('TEST_DB_HOST is not set')
+        self.dbName = 'repostsentinel_test_{0}'.format(os.getpid())
+        self.maintenance('DROP DATABASE IF EXISTS {0}')
+        self.maintenance('CREATE DATABASE {0}')
+        self.addCleanup(self.maintenance, 'DROP DATABASE IF EXISTS {0}')
+
+        self.db = Database(dict(TEST_DB, DB_NAME=self.dbName), logging.getLogger('test'), retries=1)
+        self.db.connect()
+        self.addCleanup(self.db.close)
+        self.db.run(lambda cur: cur.execute(open(DB_CREATE).read()))
+
+    def maintenance(self, statement):
+        connection = psycopg2.connect(dbname='postgres', user=TEST_DB['DB_USER'], host=TEST_DB['DB_HOST'],
+                                      password=TEST_DB['DB_PASS'])
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cur:
+            cur.execute(statement.format(self.dbName))
+        connection.close()
@@ -0,0 +1,81 @@
+import random
+import unittest
+
+import numpy
+
+from Clusters import clusterHashes
+from HashIndex import TABLE_ENTRIES, binomial, planBlocks
+
+
+# Distinct hashes in chains of near duplicates, each a few random bits
+# away from the one before it, so clusters join through pairs of any
+# distance around the radius
+def chainedHashes(count, seed):
+    rng = random.Random(seed)
+    hashes = set()
+    while len(hashes) < count:
+        mediaHash = rng.getrandbits(64)
+        for _ in range(rng.randint(0, 5)):
+            hashes.add(mediaHash)
+            for bit in rng.sample(range(64), rng.randint(1, 6)):
+                mediaHash ^= 1 << bit
+        hashes.add(mediaHash)
+    return numpy.array(sorted(hashes)[:count], dtype=numpy.uint64)
+
+
+# The smallest index of every hash's cluster, checking all pairs
+def bruteForceRoots(hashes, radius):
+    values = [int(mediaHash) for mediaHash in hashes]
+    parent = list(range(len(values)))
+
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for i in range(len(values)):
+        for j in range(i + 1, len(values)):
+            if bin(values[i] ^ values[j]).count('1') <= radius:
+                a, b = find(i), find(j)
+                parent[max(a, b)] = min(a, b)
+    return numpy.array([find(item) for item in range(len(values))])
+
+
+class ClusterHashesTest(unittest.TestCase):
+
+    def assertClustersMatch(self, count, radius, workers=1):
+        hashes = chainedHashes(count, seed=count * 100 + radius)
+        roots = clusterHashes(hashes, radius, workers)
+        numpy.testing.assert_array_equal(roots, bruteForceRoots(hashes, radius))
+        # Some clusters, or the test proves nothing
+        self.assertLess(len(set(roots.tolist())), count)
+
+    def test_binary_search_lookup(self):
+        # Too few hashes for a direct table of block values
+        for radius in (1, 2, 4):
+            self.assertFalse(self.directTable(300, radius))
+            self.assertClustersMatch(300, radius)
+
+    def test_direct_table_lookup(self):
+        for count, radius in ((3000, 4), (300, 10)):
+            self.assertTrue(self.directTable(count, radius))
+            self.assertClustersMatch(count, radius)
+
+    def test_block_neighbours_on_worker_processes(self):
+        # Blocks of 10 or 11 bits, each searched within 1 bit
+        self.assertEqual({blockRadius for shift, width, blockRadius in planBlocks(1000, 10)}, {1})
+        self.assertClustersMatch(1000, 10, workers=2)
+
+    # Whether blockIndex gives every block of the plan a direct table
+    @staticmethod
+    def directTable(count, radius):
+        return all(1 << width <= TABLE_ENTRIES * count for shift, width, blockRadius in planBlocks(count, radius))
+
+    def test_binomial(self):
+        self.assertEqual([binomial(5, k) for k in range(6)], [1, 5, 10, 10, 5, 1])
+        self.assertEqual(binomial(64, 10), 151473214816)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import random
+import unittest
+from unittest import mock
+
+import numpy
+
+from HashIndex import HashArray, MappedHashes, MultiIndexHashes, nearest
+from HashSnapshot import ID_DTYPE
+
+
+# Random hashes with near duplicates of the queries and exact duplicates
+# among them, so results have ties
+def plantedHashes(count, queries, rng):
+    hashes = [rng.getrandbits(64) for _ in range(count)]
+    for query in queries:
+        for _ in range(20):
+            planted = query
+            for bit in rng.sample(range(64), rng.randint(0, 12)):
+                planted ^= 1 << bit
+            hashes[rng.randrange(count)] = planted
+            hashes[rng.randrange(count)] = planted
+    return hashes
+
+
+# The k closest (distance, submission id) pairs within radius, ties in
+# insertion order, checking every hash
+def bruteForceNearest(hashes, mediaHash, radius, limit=None):
+    matches = sorted((bin(value ^ mediaHash).count('1'), position) for position, value in enumerate(hashes))
+    matches = [(distance, str(position)) for distance, position in matches if distance <= radius]
+    return matches[:limit] if limit is not None else matches
+
+
+class NearestTest(unittest.TestCase):
+
+    def test_search_matches_brute_force(self):
+        rng = random.Random(3)
+        queries = [rng.getrandbits(64) for _ in range(10)]
+        hashes = plantedHashes(2000, queries, rng)
+        scanned = HashArray()
+        for i, mediaHash in enumerate(hashes):
+            scanned.add(mediaHash, str(i))
+        for query in queries:
+            for radius in (0, 4, 8, 12, 64):
+                for limit in (None, 1, 5, 20, 100):
+                    self.assertEqual(scanned.search(query, radius, limit),
+                                     bruteForceNearest(hashes, query, radius, limit))
+
+    def test_limit_inside_ties_keeps_oldest(self):
+        distances = numpy.array([3, 1, 2, 1, 2, 1, 0, 2, 1, 2] * 50, dtype=numpy.uint8)
+        for limit in range(1, 300, 7):
+            expected = sorted(range(len(distances)), key=lambda position: (distances[position], position))
+            expected = [position for position in expected if distances[position] <= 2][:limit]
+            self.assertEqual(nearest(distances, 2, limit).tolist(), expected)
+
+    def test_empty_and_negative_radius(self):
+        scanned = HashArray()
+        self.assertEqual(scanned.search(0, 10), [])
+        scanned.add(0, 'a')
+        self.assertEqual(scanned.search(0, -1), [])
+        self.assertEqual(scanned.search(0, 0, limit=1), [(0, 'a')])
+
+
+class MultiIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(5)
+        self.queries = [self.rng.getrandbits(64) for _ in range(10)]
+        self.hashes = plantedHashes(5000, self.queries, self.rng)
+        # Small enough for the test to index
+        patcher = mock.patch('HashIndex.MULTI_INDEX_MIN', 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertSameMatches(self, indexed, scanned, radii=(0, 3, 8, 10, 14)):
+        for query in self.queries:
+            for radius in radii:
+                for limit in (None, 10):
+                    self.assertEqual(indexed.search(query, radius, limit), scanned.search(query, radius, limit))
+
+    def test_matches_scan(self):
+        indexed = MultiIndexHashes()
+        scanned = HashArray()
+        for i, mediaHash in enumerate(self.hashes):
+            indexed.add(mediaHash, str(i))
+            scanned.add(mediaHash, str(i))
+        self.assertSameMatches(indexed, scanned)
+        self.assertIsNotNone(indexed.index)
+
+    def test_hashes_added_after_the_index_are_found(self):
+        indexed = MultiIndexHashes()
+        scanned = HashArray()
+        for i, mediaHash in enumerate(self.hashes):
+            indexed.add(mediaHash, str(i))
+            scanned.add(mediaHash, str(i))
+            # Searches now and then while the index falls behind and is rebuilt
+            if i % 700 == 0:
+                self.assertSameMatches(indexed, scanned, radii=(10,))
+        self.assertSameMatches(indexed, scanned)
+
+    def test_snapshot_group_matches_scan(self):
+        ids = numpy.array([str(i).encode('ascii') for i in range(len(self.hashes))], dtype=ID_DTYPE)
+        mapped = MappedHashes(numpy.array(self.hashes, dtype=numpy.uint64), ids)
+        mapped.indexed = True
+        scanned = HashArray()
+        for i, mediaHash in enumerate(self.hashes):
+            scanned.add(mediaHash, str(i))
+        self.assertSameMatches(mapped, scanned)
+        self.assertIsNotNone(mapped.index)
+
+
+if __name__ == '__main__':
+    unittest.main()
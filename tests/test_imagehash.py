@@ -0,0 +1,91 @@
+# Stored Media hashes were written by the original getpixel dHash as signed
+# BIGINTs. These pin the bit order and the signed wrap so a change to the
+# hashing or the conversions can't silently stop new posts matching old ones.
+import unittest
+
+from PIL import Image
+
+from HashIndex import toSigned, toUnsigned
+from ImageHash import RESAMPLE, differenceHash, differenceHashBatch, flipHashes
+
+
+# The hashing function as it was on RepostSentinel, with Image.ANTIALIAS
+# spelled as the LANCZOS filter it aliased. benchmarks/dhash.py times the
+# same copy.
+def legacyDifferenceHash(theImage):
+
+    theImage = theImage.convert("L")
+    theImage = theImage.resize((8, 8), RESAMPLE)
+    previousPixel = theImage.getpixel((0, 7))
+    differenceHash = 0
+
+    for row in range(0, 8, 2):
+
+        for col in range(8):
+            differenceHash <<= 1
+            pixel = theImage.getpixel((col, row))
+            differenceHash |= 1 * (pixel >= previousPixel)
+            previousPixel = pixel
+
+        row += 1
+
+        for col in range(7, -1, -1):
+            differenceHash <<= 1
+            pixel = theImage.getpixel((col, row))
+            differenceHash |= 1 * (pixel >= previousPixel)
+            previousPixel = pixel
+
+    return differenceHash
+
+
+# Deterministic images, the legacy implementation must keep producing
+# GOLDEN_HASHES for them or stored hashes stop matching
+def goldenImages():
+    return [
+        Image.linear_gradient('L').rotate(90).resize((320, 240)),
+        Image.linear_gradient('L').resize((240, 320)),
+        Image.radial_gradient('L').resize((500, 500)).convert('RGB'),
+        Image.effect_mandelbrot((400, 300), (-2, -1.2, 1, 1.2), 64),
+        Image.effect_mandelbrot((300, 400), (-0.8, -0.4, 0.2, 0.6), 128).convert('P'),
+    ]
+
+
+GOLDEN_HASHES = [
+    18410996206198128512,
+    9223372036854775807,
+    10308465835354591119,
+    16821778994852059316,
+    11529003938762153918,
+]
+
+# GOLDEN_HASHES as Media.hash stores them
+GOLDEN_SIGNED = [
+    -35747867511423104,
+    9223372036854775807,
+    -8138278238354960497,
+    -1624965078857492300,
+    -6917740134947397698,
+]
+
+
+class DifferenceHashTest(unittest.TestCase):
+
+    def test_legacy_matches_golden(self):
+        self.assertEqual([legacyDifferenceHash(img) for img in goldenImages()], GOLDEN_HASHES)
+
+    def test_fast_matches_golden(self):
+        self.assertEqual([differenceHash(img) for img in goldenImages()], GOLDEN_HASHES)
+
+    def test_batch_matches_golden(self):
+        self.assertEqual(differenceHashBatch(goldenImages()), GOLDEN_HASHES)
+
+    def test_unflipped_dhash_matches_golden(self):
+        self.assertEqual([flipHashes(img)[0][0] for img in goldenImages()], GOLDEN_HASHES)
+
+    def test_signed_wrap(self):
+        self.assertEqual([toSigned(mediaHash) for mediaHash in GOLDEN_HASHES], GOLDEN_SIGNED)
+        self.assertEqual([toUnsigned(mediaHash) for mediaHash in GOLDEN_SIGNED], GOLDEN_HASHES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import logging
+import unittest
+from types import SimpleNamespace
+
+from RepostSentinel import RepostSentinel
+from SubredditSettings import SubredditSettings
+from tests.helpers import FakeDatabase, fakeSubmission
+
+
+# Submissions as new lists them, newest first, created in name order
+def newest(*submissionIds):
+    return [fakeSubmission(submissionId, created_utc=float(ord(submissionId)))
+            for submissionId in sorted(submissionIds, reverse=True)]
+
+
+class IngestNewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.db = FakeDatabase({'IngestState': lambda params: self.watermark()})
+        self.sentinel.indexedSubmissions = lambda submissionIds: set(self.stored)
+        self.sentinel.skipSubmission = lambda submission, settings, indexed: submission.id in indexed
+        self.sentinel.fetchMedia = lambda submission, settings: []
+        self.sentinel.enforceSubmission = lambda *args: None
+        self.owned = True
+        self.sentinel.ownsSubreddit = lambda subname: self.owned
+        self.stored = []
+        self.sentinel.writeRecords = lambda records: self.stored.extend(record[1][0] for record in records)
+        self.settings = SubredditSettings('pics', imported=True)
+
+    # The last high-water mark written
+    def watermark(self):
+        executed = self.sentinel.db.executed
+        return executed[-1][1][1:] if executed else None
+
+    def ingest(self, submissions):
+        reddit = SimpleNamespace(subreddit=lambda name: SimpleNamespace(new=lambda limit: iter(submissions)))
+        self.sentinel.ingestNew(reddit, self.settings)
+
+    def test_batch_processed_oldest_first(self):
+        self.ingest(newest('a', 'b', 'c'))
+        self.assertEqual(self.stored, ['a', 'b', 'c'])
+        # The high-water mark is the newest submission
+        self.assertEqual(self.watermark(), ('c', float(ord('c'))))
+
+        self.ingest(newest('b', 'c', 'd'))
+        self.assertEqual(self.stored, ['a', 'b', 'c', 'd'])
+
+    def test_mark_stays_before_submissions_left_to_new_owner(self):
+        self.ingest(newest('a'))
+        # The lease moves away while the next batch downloads
+        self.owned = False
+        self.ingest(newest('a', 'b', 'c'))
+        self.assertEqual(self.stored, ['a'])
+        self.assertEqual(self.watermark(), ('a', float(ord('a'))))
+
+        # The new owner scans from the same mark
+        self.owned = True
+        self.ingest(newest('a', 'b', 'c'))
+        self.assertEqual(self.stored, ['a', 'b', 'c'])
+
+    def test_failed_write_is_scanned_again(self):
+        writeRecords = self.sentinel.writeRecords
+
+        def failOnB(records):
+            if records[0][1][0] == 'b':
+                raise RuntimeError('connection reset')
+            writeRecords(records)
+        self.sentinel.writeRecords = failOnB
+        self.ingest(newest('a', 'b', 'c'))
+        self.assertEqual(self.stored, ['a', 'c'])
+        self.assertEqual(self.watermark(), ('a', float(ord('a'))))
+
+        self.sentinel.writeRecords = writeRecords
+        self.ingest(newest('a', 'b', 'c'))
+        self.assertEqual(self.stored, ['a', 'c', 'b'])
+        self.assertEqual(self.watermark(), ('c', float(ord('c'))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import logging
+import unittest
+
+from LeaseManager import LeaseManager
+from tests.helpers import FakeDatabase
+
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def test_listeners_called_when_leases_change(self):
+        # Each rebalance gets the next set of leases
+        owned = [{'r/pics', 'mail'}, {'r/pics', 'mail'}, {'r/pics'}]
+        leases = LeaseManager(FakeDatabase({'lease_refresh': lambda cur: frozenset(owned.pop(0))}),
+                              logging.getLogger('test'), 'worker')
+        calls = []
+        leases.listeners.append(lambda: calls.append(leases.owned))
+
+        leases.refresh()
+        self.assertTrue(leases.ownsSubreddit('pics'))
+        self.assertTrue(leases.ownsMail())
+        self.assertEqual(len(calls), 1)
+
+        leases.refresh()
+        self.assertEqual(len(calls), 1)
+
+        leases.refresh()
+        self.assertFalse(leases.ownsMail())
+        self.assertFalse(leases.ownsSubreddit('funny'))
+        self.assertEqual(calls[-1], frozenset({'r/pics'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import logging
+import threading
+import unittest
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from HashIndex import HashIndex, toSigned
+from MediaFetcher import MediaInfo
+from RepostSentinel import RepostSentinel
+from SubredditSettings import SubredditSettings
+from tests.helpers import FakeDatabase, fakeSubmission
+
+
+class ImageCandidatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.hashIndex = HashIndex()
+        self.settings = SubredditSettings('pics', imported=True)
+
+    def candidates(self, parentPhash, mediaInfo, radius=3):
+        self.sentinel.hashIndex.add('pics', 0x0f0f0f0f0f0f0f0f, 'parent')
+        phashes = {'parent': parentPhash}
+        self.sentinel.db = FakeDatabase({'select_phashes': lambda params: [
+            (parentId, toSigned(phashes[parentId])) for parentId in params[0] if phashes.get(parentId) is not None
+        ]})
+        return self.sentinel.imageCandidates(self.settings, mediaInfo, radius)
+
+    def mirrored(self, phash=0x1111):
+        # A mirror of the parent, its horizontal flip has the parent's dHash
+        return MediaInfo(0xf0f0f0f0f0f0f0f0, 100, 100, 1000, phash=phash,
+                         flips=((0x0f0f0f0f0f0f0f0f, 0x2222), (0, 0), (0, 0)))
+
+    def test_flip_counts_for_parent_without_phash(self):
+        self.assertEqual(self.candidates(None, self.mirrored()), {'parent': 0})
+
+    def test_flip_needs_phash_when_parent_has_one(self):
+        self.assertEqual(self.candidates(0x2222, self.mirrored()), {'parent': 0})
+        self.sentinel.hashIndex = HashIndex()
+        self.assertEqual(self.candidates(0xffffffffffff0000, self.mirrored()), {})
+
+    def test_unrelated_parent_not_matched(self):
+        unrelated = MediaInfo(0x123456789abcdef0, 100, 100, 1000, phash=0x1111,
+                              flips=((0x0fedcba987654321, 0x2222), (0, 0), (0, 0)))
+        self.assertEqual(self.candidates(None, unrelated), {})
+
+
+class BlacklistMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.hashIndex = HashIndex()
+        self.sentinel.hashIndex.add('pics', 0x0f0f0f0f0f0f0f0f, 'parent')
+        self.sentinel.parentCache = SimpleNamespace(get=lambda r, parentIds: {})
+        self.removed = []
+        self.sentinel.removeSubmission = lambda r, submissionId, subname: self.removed.append(submissionId)
+        self.sentinel.replyRemoval = lambda r, submissionId, message: None
+        # Default thresholds, nothing is reported or removed as a repost
+        self.settings = SubredditSettings('pics', imported=True)
+
+    def enforce(self, mediaHash, blacklisted=True):
+        parent = ('parent', 'pics', 0.0, 'someone', 'title', 'url', 0, 0, False, False, None, blacklisted, True)
+        self.sentinel.db = FakeDatabase({'select_submissions': lambda params: [parent]})
+        mediaInfo = MediaInfo(mediaHash, 1000, 1000, 1000)
+        mediaData = (mediaHash, 'abc', 'pics', 1, 1, 1000, 1000, 1000000, 1000, None, 0.0)
+        self.sentinel.enforceSubmission(None, fakeSubmission('abc'), self.settings, mediaData, [mediaInfo])
+
+    def test_hash_a_bit_off_blacklisted_parent_is_removed(self):
+        # Hashed at reduced scale, one bit away from the parent's full decode
+        self.enforce(0x0f0f0f0f0f0f0f0e)
+        self.assertEqual(self.removed, ['abc'])
+
+    def test_parent_not_blacklisted(self):
+        self.enforce(0x0f0f0f0f0f0f0f0f, blacklisted=False)
+        self.assertEqual(self.removed, [])
+
+    def test_hash_further_off_is_not_removed(self):
+        self.enforce(0x0f0f0f0f0f0f0f0c)
+        self.assertEqual(self.removed, [])
+
+
+class FrameMatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.hashIndex = HashIndex()
+        self.settings = SubredditSettings('pics', imported=True)
+        self.frames = [0x1111 << (16 * i) for i in range(4)]
+
+    def parent(self, parentId, frameHashes):
+        for frameHash in frameHashes:
+            self.sentinel.hashIndex.add('pics', frameHash, parentId, True)
+
+    def test_half_the_frames_match(self):
+        # Two of four frames, one of them a bit off
+        self.parent('half', [self.frames[0], self.frames[1] ^ 1])
+        self.parent('quarter', [self.frames[2]])
+        self.assertEqual(self.sentinel.frameMatches(self.settings, [self.frames], 3), [(0, 'half')])
+
+    def test_distance_is_the_mean_over_matching_frames(self):
+        self.parent('close', self.frames)
+        self.parent('further', [frameHash ^ 0b11 for frameHash in self.frames[:3]])
+        self.assertEqual(self.sentinel.frameMatches(self.settings, [self.frames], 3), [(0, 'close'), (2, 'further')])
+
+    def test_match_ratio_is_configurable(self):
+        self.sentinel.config['FRAME_MATCH_RATIO'] = 1.0
+        self.parent('most', self.frames[:3])
+        self.assertEqual(self.sentinel.frameMatches(self.settings, [self.frames], 3), [])
+
+    def test_single_images_are_not_matched(self):
+        self.sentinel.hashIndex.add('pics', self.frames[0], 'image')
+        self.assertEqual(self.sentinel.frameMatches(self.settings, [self.frames[:1]], 3), [])
+
+
+class GalleryAnimationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.hashIndex = HashIndex()
+        self.sentinel.ownsSubreddit = lambda subname: True
+        self.enforced = []
+        self.sentinel.enforceSubmission = lambda r, submission, settings, mediaData, mediaHashes: \
+            self.enforced.append((mediaData, mediaHashes))
+        self.settings = SubredditSettings('pics', imported=True)
+
+    @staticmethod
+    def animation(*frames):
+        future = Future()
+        future.set_result(MediaInfo(frames[0], 1000, 1000, 1000, frames=list(frames)))
+        return SimpleNamespace(width=None, height=None), future
+
+    def test_every_animation_is_kept_and_matched(self):
+        first = (0x1111, 0x2222, 0x3333)
+        second = (0x0f0f0f0f0f0f0f0f, 0xf0f0f0f0f0f0f0f0)
+        for frameHash in first:
+            self.sentinel.hashIndex.add('pics', frameHash, 'parent', True)
+        mediaRows, submission = self.sentinel.buildRecord(
+            None, fakeSubmission('abc'), self.settings, True, [self.animation(*first), self.animation(*second)])
+
+        self.assertEqual([(row[0], row[3], row[4]) for row in mediaRows],
+                         [(0x1111, 1, 3), (0x2222, 2, 3), (0x3333, 3, 3),
+                          (0x0f0f0f0f0f0f0f0f, 4, 2), (0xf0f0f0f0f0f0f0f0, 5, 2)])
+        mediaData, mediaHashes = self.enforced[0]
+        self.assertEqual(mediaHashes, [list(first), list(second)])
+        # The parent matches the first animation though not the second
+        self.assertEqual(self.sentinel.frameMatches(self.settings, mediaHashes, 3), [(0, 'parent')])
+
+
+class HashIndexLockTest(unittest.TestCase):
+
+    def test_search_not_blocked_by_other_subreddit(self):
+        index = HashIndex()
+        index.add('pics', 1, 'a')
+        index.add('funny', 1, 'b')
+        result = []
+        # A long search of pics holds only its own group
+        with index.groupLocks[('pics', False)]:
+            thread = threading.Thread(target=lambda: result.extend(index.search('funny', 1, 0)))
+            thread.start()
+            thread.join(5)
+        self.assertEqual(result, [(0, 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from MediaCache import contentKey, urlKey
+
+
+class UrlKeyTest(unittest.TestCase):
+
+    def test_scheme_www_and_host_case_are_dropped(self):
+        key = urlKey('https://i.imgur.com/abc.jpg')
+        for url in ('http://i.imgur.com/abc.jpg', 'https://www.i.imgur.com/abc.jpg', 'HTTPS://I.Imgur.com/abc.jpg',
+                    ' https://i.imgur.com/abc.jpg\n'):
+            self.assertEqual(urlKey(url), key)
+        self.assertEqual(key, 'url:i.imgur.com/abc.jpg')
+
+    def test_query_dropped_on_static_hosts(self):
+        self.assertEqual(urlKey('https://i.redd.it/abc.jpg?1'), urlKey('https://i.redd.it/abc.jpg'))
+        self.assertEqual(urlKey('https://i.reddituploads.com/abc?fit=max&s=1'), 'url:i.reddituploads.com/abc')
+
+    def test_query_kept_elsewhere(self):
+        self.assertEqual(urlKey('https://example.com/image?id=1'), 'url:example.com/image?id=1')
+        self.assertNotEqual(urlKey('https://example.com/image?id=1'), urlKey('https://example.com/image?id=2'))
+
+    def test_path_case_is_kept(self):
+        self.assertNotEqual(urlKey('https://i.imgur.com/AbC.jpg'), urlKey('https://i.imgur.com/abc.jpg'))
+
+    def test_fragment_is_dropped(self):
+        self.assertEqual(urlKey('https://example.com/image.png#top'), 'url:example.com/image.png')
+
+
+class ContentKeyTest(unittest.TestCase):
+
+    def test_digest_of_the_bytes(self):
+        self.assertEqual(contentKey(b''),
+                         'sha256:e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855')
+        self.assertEqual(contentKey(memoryview(b'image')), contentKey(b'image'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import io
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from ImageHash import flipHashes
+from MediaFetcher import MediaFetcher
+
+
+# A GIF of count solid frames, frame i at gray level 10 * i, each shown for
+# duration milliseconds
+def animation(count, duration=400):
+    frames = [Image.new('L', (64, 64), 10 * i) for i in range(count)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    buffer.seek(0)
+    return buffer
+
+
+class SubmitTest(unittest.TestCase):
+
+    def test_hash_pool_failure_resolves_future(self):
+        fetcher = MediaFetcher(flipHashes, fetchWorkers=1, hashWorkers=1)
+        fetcher.fetch = lambda url: (io.BytesIO(b'image'), [])
+        fetcher.hashPool.shutdown()
+        try:
+            future = fetcher.submit('https://i.redd.it/example.jpg')
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+        finally:
+            fetcher.shutdown()
+
+
+class SampleFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fetcher = MediaFetcher(flipHashes, fetchWorkers=1, hashWorkers=1, maxFrames=16, frameInterval=1000)
+        self.addCleanup(self.fetcher.shutdown)
+
+    def sampled(self, buffer):
+        return [frame.getpixel((0, 0)) // 10 for frame in self.fetcher.sampleFrames(Image.open(buffer))]
+
+    def test_one_frame_per_interval(self):
+        # Frames start every 400ms, the first at or after each second since
+        # the last sample is taken
+        self.assertEqual(self.sampled(animation(10)), [0, 3, 6, 9])
+
+    def test_at_most_max_frames(self):
+        self.fetcher.maxFrames = 3
+        self.assertEqual(self.sampled(animation(20, duration=1000)), [0, 1, 2])
+
+    def test_decoding_stops_at_the_cap(self):
+        with mock.patch('MediaFetcher.MAX_DECODED_FRAMES', 5):
+            self.assertEqual(self.sampled(animation(20)), [0, 3])
+
+    def test_animation_hashes_every_sampled_frame(self):
+        mediaInfo = self.fetcher.decode(animation(10))
+        self.assertEqual(len(mediaInfo.frames), 4)
+        self.assertEqual(mediaInfo.hash, mediaInfo.frames[0])
+        self.assertIsNone(mediaInfo.phash)
+
+    def test_single_sample_is_hashed_as_an_image(self):
+        # Two frames within one interval, only the first is sampled
+        mediaInfo = self.fetcher.decode(animation(2))
+        self.assertEqual(mediaInfo.frames, ())
+        self.assertIsNotNone(mediaInfo.phash)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from MediaResolver import MediaSource, resolveMedia
+
+
+class LazySubmission:
+    # Stands in for a lazy praw Submission, reading an attribute reddit
+    # didn't send would make praw fetch the submission again
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name):
+        raise AssertionError('{0} was fetched lazily'.format(name))
+
+
+class ResolveMediaTest(unittest.TestCase):
+
+    def test_plain_link_reads_only_listing_fields(self):
+        submission = LazySubmission(url='https://i.redd.it/abc.jpg')
+        self.assertEqual(resolveMedia(submission), [MediaSource('https://i.redd.it/abc.jpg', None, None)])
+
+    def test_preview_is_used_when_sent(self):
+        submission = LazySubmission(url='https://i.redd.it/abc.jpg', preview={'images': [{
+            'source': {'url': 'https://preview.redd.it/abc.jpg?s=1', 'width': 1000, 'height': 800},
+            'resolutions': [{'url': 'https://preview.redd.it/abc.jpg?width=320&amp;s=2', 'width': 320,
+                             'height': 256}],
+        }]})
+        self.assertEqual(resolveMedia(submission, 300, 200),
+                         [MediaSource('https://preview.redd.it/abc.jpg?width=320&s=2', 1000, 800)])
+
+    def test_animated_gallery_item_uses_gif(self):
+        submission = LazySubmission(url='https://www.reddit.com/gallery/abc', is_gallery=True, gallery_data={
+            'items': [{'media_id': 'still'}, {'media_id': 'animated'}, {'media_id': 'video'}],
+        }, media_metadata={
+            'still': {'status': 'valid', 's': {'u': 'https://preview.redd.it/still.jpg?s=1', 'x': 800, 'y': 600},
+                      'p': [{'u': 'https://preview.redd.it/still.jpg?width=320&amp;s=2', 'x': 320, 'y': 240}]},
+            'animated': {'status': 'valid', 's': {'gif': 'https://i.redd.it/animated.gif',
+                                                  'mp4': 'https://preview.redd.it/animated.gif?format=mp4',
+                                                  'x': 500, 'y': 500},
+                         'p': [{'u': 'https://preview.redd.it/animated.gif?width=320&amp;s=3', 'x': 320, 'y': 320}]},
+            'video': {'status': 'valid', 's': {'mp4': 'https://preview.redd.it/video.gif?format=mp4',
+                                               'x': 500, 'y': 500}},
+        })
+        self.assertEqual(resolveMedia(submission, 300, 200), [
+            MediaSource('https://preview.redd.it/still.jpg?width=320&s=2', 800, 600),
+            MediaSource('https://i.redd.it/animated.gif', 500, 500),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import logging
+import time
+import unittest
+
+from HashIndex import HashIndex
+from RepostSentinel import RepostSentinel
+from Retention import Retention
+from SubredditSettings import SubredditSettings
+from tests.helpers import DatabaseTestCase, fakeSubmission
+
+DAY = 86400
+
+
+class RetentionTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(RetentionTest, self).setUp()
+        self.now = time.time()
+        self.settings = SubredditSettings('pics', imported=True, retentionDays=400)
+
+    # One single image post per (id, age in days, hash), with the
+    # Submissions flags given for some of them
+    def addPosts(self, posts, blacklisted=(), deleted=()):
+        submissions = []
+        media = []
+        for submissionId, age, mediaHash in posts:
+            created = self.now - age * DAY
+            submissions.append((submissionId, 'pics', created, 'someone', 'title', 'url', 0, 0,
+                                submissionId in deleted, False, None, submissionId in blacklisted, True))
+            media.append((mediaHash, submissionId, 'pics', 1, 1, created))
+        self.db.run(lambda cur: self.db.executeValues(cur, 'INSERT INTO Submissions VALUES %s', submissions))
+        self.db.run(lambda cur: self.db.executeValues(
+            cur, 'INSERT INTO Media(hash, submission_id, subreddit, frame_number, frame_count, created) VALUES %s',
+            media))
+
+    def ids(self, table):
+        return {row[0] for row in self.db.fetchall('SELECT submission_id FROM {0}'.format(table))}
+
+    def maintain(self, archive=True):
+        return Retention(self.db, logging.getLogger('test'), archive=archive).run([self.settings])
+
+    def test_expired_rows_are_archived(self):
+        # Whole periods, the period the window starts in and the current one
+        self.addPosts([('old', 1500, 1), ('older', 800, 2), ('edge', 405, 3), ('inside', 395, 4), ('new', 10, 5)])
+        self.assertEqual(self.maintain(), ['pics'])
+        self.assertEqual(self.ids('Media'), {'inside', 'new'})
+        self.assertEqual(self.ids('MediaArchive'), {'old', 'older', 'edge'})
+        # Nothing left to do
+        self.assertEqual(self.maintain(), [])
+
+    def test_expired_rows_are_dropped_without_archive(self):
+        self.addPosts([('old', 1500, 1), ('edge', 405, 3), ('new', 10, 5)])
+        self.maintain(archive=False)
+        self.assertEqual(self.ids('Media'), {'new'})
+        self.assertEqual(self.ids('MediaArchive'), set())
+
+    def test_blacklisted_media_is_kept_past_retention(self):
+        self.addPosts([('old', 1500, 1), ('edge', 405, 3), ('new', 10, 5)], blacklisted={'old', 'edge'})
+        self.maintain()
+        self.assertEqual(self.ids('Media'), {'old', 'edge', 'new'})
+        self.assertEqual(self.maintain(), [])
+        self.assertEqual(self.ids('Media'), {'old', 'edge', 'new'})
+
+    def test_exact_duplicates_are_folded_into_the_oldest(self):
+        self.addPosts([('first', 30, 7), ('second', 20, 7), ('third', 10, 7), ('other', 10, 8)])
+        self.maintain()
+        self.assertEqual(self.ids('Media'), {'first', 'other'})
+        self.assertEqual(self.ids('MediaArchive'), {'second', 'third'})
+        self.assertEqual(self.db.fetchone("SELECT ref_count FROM Media WHERE submission_id='first'"), (3,))
+
+    def test_blacklisted_duplicate_is_kept(self):
+        self.addPosts([('first', 30, 7), ('second', 20, 7), ('third', 10, 7)], blacklisted={'second'})
+        self.maintain()
+        self.assertEqual(self.ids('Media'), {'first', 'second'})
+        self.assertEqual(self.db.fetchone("SELECT ref_count FROM Media WHERE submission_id='first'"), (2,))
+
+    def test_media_of_deleted_posts_is_archived(self):
+        self.addPosts([('gone', 10, 1), ('kept', 10, 2), ('listed', 10, 3)],
+                      deleted={'gone', 'listed'}, blacklisted={'listed'})
+        self.maintain()
+        self.assertEqual(self.ids('Media'), {'kept', 'listed'})
+        self.assertEqual(self.ids('MediaArchive'), {'gone'})
+
+
+class BlacklistTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(BlacklistTest, self).setUp()
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.db = self.db
+        self.sentinel.prepareStatements()
+        self.sentinel.hashIndex = HashIndex()
+        self.sentinel.fetchMedia = lambda submission, settings: []
+        self.settings = SubredditSettings('pics', imported=True, retentionDays=30)
+
+    def test_post_past_retention_is_indexed(self):
+        submission = fakeSubmission('abc', created_utc=time.time() - 60 * DAY, is_self=False)
+        self.assertTrue(self.sentinel.skipSubmission(submission, self.settings))
+        self.sentinel.blacklistSubmission(None, submission, self.settings)
+        self.assertEqual(self.db.fetchone("SELECT blacklist FROM Submissions WHERE id='abc'"), (True,))
+
+    def test_archived_media_is_restored(self):
+        created = time.time() - 60 * DAY
+        self.db.execute('INSERT INTO Submissions(id, subreddit, timestamp, blacklist) '
+                        "VALUES('abc', 'pics', %s, FALSE)", (created,))
+        self.db.execute('INSERT INTO MediaArchive(hash, submission_id, subreddit, frame_number, frame_count, seq, '
+                        "created, ref_count) VALUES(42, 'abc', 'pics', 1, 1, 1000, %s, 1)", (created,))
+        self.sentinel.blacklistSubmission(None, fakeSubmission('abc', created_utc=created, is_self=False),
+                                          self.settings)
+        self.assertEqual(self.db.fetchall('SELECT submission_id FROM MediaArchive'), [])
+        self.assertEqual(self.sentinel.hashIndex.search('pics', 42, 0), [(0, 'abc')])
+        # A new seq, past any snapshot's watermark
+        self.assertNotEqual(self.db.fetchone("SELECT seq FROM Media WHERE submission_id='abc'"), (1000,))
+
+
+if __name__ == '__main__':
+    unittest.main()
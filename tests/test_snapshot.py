@@ -0,0 +1,95 @@
+import os
+import random
+import tempfile
+import unittest
+from collections import Counter
+
+from HashIndex import HashIndex, toSigned
+from HashSnapshot import HashSnapshot, writeSnapshot
+from tests.helpers import DatabaseTestCase
+
+
+class SnapshotTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.rng = random.Random(7)
+        self.posts = 0
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'hashes.snapshot')
+
+    # count single image posts and as many 3 frame animations in subreddit,
+    # seq taken from the sequence unless given
+    def addMedia(self, subreddit, count, seq=None):
+        rows = []
+        for _ in range(count):
+            self.posts += 1
+            rows.append((toSigned(self.rng.getrandbits(64)), 'i{0}'.format(self.posts), subreddit, 1, 1, 0.0))
+            for frame in range(1, 4):
+                rows.append((toSigned(self.rng.getrandbits(64)), 'a{0}'.format(self.posts), subreddit, frame, 3, 0.0))
+        columns = 'hash, submission_id, subreddit, frame_number, frame_count, created'
+        if seq is not None:
+            rows = [row + (seq,) for row in rows]
+            columns += ', seq'
+        self.db.run(lambda cur: self.db.executeValues(cur, 'INSERT INTO Media({0}) VALUES %s'.format(columns), rows))
+
+    # Every (subreddit, animated, hash, submission id) the index holds
+    def contents(self, index):
+        held = Counter()
+        for (subreddit, animated), hashes in index.subreddits.items():
+            for distance, submissionId in hashes.search(0, 64):
+                held[(subreddit, animated, submissionId)] += 1
+        return held
+
+    def test_snapshot_and_overlap_load_everything(self):
+        self.addMedia('pics', 50)
+        self.addMedia('funny', 20)
+        # An insert still in flight as the snapshot is written, it commits
+        # later with a seq below the watermark
+        inFlight = self.db.fetchone("SELECT nextval(pg_get_serial_sequence('media', 'seq'))")[0]
+        self.addMedia('pics', 10)
+        self.assertTrue(writeSnapshot(self.db, self.path))
+
+        snapshot = HashSnapshot(self.path)
+        self.assertEqual(snapshot.watermark, self.db.fetchone('SELECT max(seq) FROM Media')[0])
+        self.assertEqual(len(snapshot), 320)
+        self.assertEqual(set(snapshot.groups), {('pics', False), ('pics', True), ('funny', False), ('funny', True)})
+
+        self.addMedia('pics', 5, seq=inFlight)
+        self.addMedia('pics', 5)
+        self.addMedia('gifs', 5)
+
+        layered = HashIndex()
+        layered.load(self.db, snapshot=snapshot)
+        full = HashIndex()
+        full.load(self.db)
+        self.assertEqual(self.contents(layered), self.contents(full))
+        self.assertEqual(sum(self.contents(full).values()), 380)
+
+    def test_shard_loads_its_subreddits(self):
+        self.addMedia('pics', 10)
+        self.addMedia('funny', 10)
+        writeSnapshot(self.db, self.path)
+        self.addMedia('funny', 5)
+
+        layered = HashIndex()
+        layered.load(self.db, ['funny'], snapshot=HashSnapshot(self.path))
+        full = HashIndex()
+        full.load(self.db, ['funny'])
+        self.assertEqual(self.contents(layered), self.contents(full))
+        self.assertEqual({subreddit for subreddit, animated in layered.subreddits}, {'funny'})
+
+
+class SnapshotFileTest(unittest.TestCase):
+
+    def test_other_file_is_rejected(self):
+        with tempfile.NamedTemporaryFile() as handle:
+            handle.write(b'\0' * 64)
+            handle.flush()
+            with self.assertRaises(ValueError):
+                HashSnapshot(handle.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import logging
+import unittest
+from types import SimpleNamespace
+
+from RepostSentinel import RepostSentinel
+from SubredditSettings import SubredditSettings
+from tests.helpers import fakeSubmission
+
+
+class FakeReddit:
+    # Hands out streams from a list of scripts, one per stream created. A
+    # script is the items the stream yields, an exception is raised.
+
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+        self.created = 0
+
+    def subreddit(self, name):
+        return SimpleNamespace(stream=SimpleNamespace(submissions=self.stream))
+
+    def stream(self, pause_after=None):
+        self.created += 1
+        script = self.scripts.pop(0)
+
+        def generate():
+            for item in script:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            while True:
+                yield None
+        return generate()
+
+
+class IngestStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.shardSettings = lambda: [SubredditSettings('pics', imported=True)]
+        self.sentinel.indexedSubmissions = lambda submissionIds: set()
+        self.sentinel.skipSubmission = lambda submission, settings, indexed: False
+        self.sentinel.fetchMedia = lambda submission, settings: []
+        self.stored = []
+        self.sentinel.storeSubmission = lambda r, submission, settings, enforce, futures: self.stored.append(
+            submission.id)
+
+    def test_failed_stream_is_rebuilt(self):
+        reddit = FakeReddit([
+            [fakeSubmission('a'), RuntimeError('503 Service Unavailable')],
+            [fakeSubmission('b')],
+        ])
+        with self.assertRaises(RuntimeError):
+            self.sentinel.ingestStream(reddit)
+        # What was read before the failure is still indexed
+        self.assertEqual(self.stored, ['a'])
+
+        self.sentinel.ingestStream(reddit)
+        self.assertEqual(reddit.created, 2)
+        self.assertEqual(self.stored, ['a', 'b'])
+
+    def test_healthy_stream_is_reused(self):
+        reddit = FakeReddit([[fakeSubmission('a'), None, fakeSubmission('b')]])
+        self.sentinel.ingestStream(reddit)
+        self.sentinel.ingestStream(reddit)
+        self.assertEqual(reddit.created, 1)
+        self.assertEqual(self.stored, ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import logging
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from RepostSentinel import RepostSentinel
+from SubmissionCache import SubmissionCache, SubmissionState
+from tests.helpers import FakeDatabase, fakeSubmission
+
+
+def parentRow(submissionId, deleted, removed):
+    return (submissionId, 'pics', 1.0, 'someone', 'title', 'url', 0, 0, deleted, removed, None, False, True)
+
+
+class SubmissionStateTest(unittest.TestCase):
+
+    def test_deleted_post_has_no_author(self):
+        self.assertEqual(SubmissionCache.state(fakeSubmission(author=None)).status, 'Deleted')
+
+    def test_removed_post(self):
+        self.assertEqual(SubmissionCache.state(fakeSubmission(author=None, removed=True)).status, 'Removed')
+
+    def test_active_post(self):
+        self.assertEqual(SubmissionCache.state(fakeSubmission(author='someone')).status, 'Active')
+
+
+class SubmissionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('SubmissionCache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetched = []
+        # Reddit knows every id but 'gone'
+        self.reddit = SimpleNamespace(info=self.info)
+        self.cache = SubmissionCache(maxSize=2, ttl=60)
+
+    def info(self, fullnames):
+        submissionIds = [fullname[3:] for fullname in fullnames]
+        self.fetched.append(submissionIds)
+        return [fakeSubmission(submissionId, score=len(self.fetched))
+                for submissionId in submissionIds if submissionId != 'gone']
+
+    def test_misses_are_fetched_in_one_call(self):
+        states = self.cache.get(self.reddit, ['a', 'gone', 'b'])
+        self.assertEqual(self.fetched, [['a', 'gone', 'b']])
+        self.assertEqual(states, {'a': SubmissionState(1, 0, 'Active'), 'b': SubmissionState(1, 0, 'Active')})
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.get(self.reddit, ['a'])
+        self.now += 59
+        self.assertEqual(self.cache.get(self.reddit, ['a'])['a'].score, 1)
+        self.now += 1
+        self.assertEqual(self.cache.get(self.reddit, ['a'])['a'].score, 2)
+        self.assertEqual(self.fetched, [['a'], ['a']])
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get(self.reddit, ['a', 'b'])
+        # A hit makes a the most recently used, so c evicts b
+        self.cache.get(self.reddit, ['a'])
+        self.cache.get(self.reddit, ['c'])
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+        self.cache.get(self.reddit, ['a', 'b'])
+        self.assertEqual(self.fetched, [['a', 'b'], ['c'], ['b']])
+
+
+class UpdateParentStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sentinel = RepostSentinel(config={})
+        self.sentinel.logger = logging.getLogger('test')
+        self.sentinel.db = FakeDatabase()
+
+    def test_only_changed_parents_are_written(self):
+        mediaParents = {
+            'a': parentRow('a', False, False),
+            'b': parentRow('b', True, False),
+            'c': parentRow('c', None, None),
+        }
+        parentStates = {
+            'a': SubmissionState(5, 2, 'Deleted'),
+            'b': SubmissionState(5, 2, 'Deleted'),
+            'c': SubmissionState(5, 2, 'Active'),
+        }
+        self.sentinel.updateParentStatus(mediaParents, parentStates)
+        self.assertEqual(self.sentinel.db.values, [('a', True, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()